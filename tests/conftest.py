@@ -0,0 +1,23 @@
+import pytest
+import usmelt
+from usmelt.emulator import TG5012AEmulator
+
+
+@pytest.fixture
+def emulator():
+    """A TG5012A emulator served on a local TCP port"""
+    emu = TG5012AEmulator()
+    emu.port = emu.serve_tcp()
+    yield emu
+    emu.close()
+
+
+@pytest.fixture
+def pg(emulator):
+    """A TG5012A connected to the emulator, with the shadow state cache on
+
+    auto_local is off, as returning to local clears the cache.
+    """
+    pg = usmelt.TG5012A(address='127.0.0.1', port=emulator.port, auto_local=False, cache=True)
+    yield pg
+    pg.close()
@@ -0,0 +1,42 @@
+import pytest
+from usmelt.error_check import EveryCommand, BatchError
+from usmelt.emulator import ERR_CONFLICT
+
+
+def test_check_batch_attributes_the_failing_command():
+    cmds = ["PULSWID 2e-05", "HILVL -3", "PULSDLY 1e-05"]
+    with pytest.raises(BatchError) as info:
+        EveryCommand().check_batch(cmds, ["0", str(ERR_CONFLICT), "0"])
+    assert info.value.index == 1
+    assert info.value.command == "HILVL -3"
+    assert info.value.error == ERR_CONFLICT
+    assert info.value.commands == ["HILVL -3"]
+
+
+def test_check_batch_reports_the_first_error():
+    with pytest.raises(BatchError) as info:
+        EveryCommand().check_batch(["HILVL -3", "LOLVL 9"], [str(ERR_CONFLICT), str(ERR_CONFLICT)])
+    assert info.value.index == 0
+
+
+def test_check_batch_without_errors():
+    EveryCommand().check_batch(["PULSWID 2e-05", "PULSDLY 1e-05"], ["0", "0"])
+
+
+def test_batch_error_on_the_instrument(pg, emulator):
+    pg.error_check = EveryCommand()
+    lines = emulator.lines_received
+    with pytest.raises(BatchError) as info:
+        with pg.batch():
+            pg.pulse_width(20e-6)
+            # Not above the low level of -2.5 V
+            pg.high(-3)
+            pg.pulse_delay(10e-6)
+    assert info.value.index == 1
+    assert info.value.command.startswith("HILVL")
+    assert info.value.error == ERR_CONFLICT
+    # The commands around the failing one were still applied, in a single round trip
+    assert emulator.channels[1]["PULSWID"] == 20e-6
+    assert emulator.channels[1]["HILVL"] == 2.5
+    assert emulator.channels[1]["PULSDLY"] == 10e-6
+    assert emulator.lines_received == lines + 1
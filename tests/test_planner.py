@@ -0,0 +1,104 @@
+import pytest
+from usmelt.planner import plan, apply_config
+from usmelt.emulator import DEFAULT_CHANNEL
+from usmelt.tg5012a import _LINKED_SETTINGS
+
+SHOT = {'WAVE': 'PULSE', 'PULSWID': 20e-6, 'HILVL': 5, 'OUTPUT': 'ON'}
+# The whole state of a channel. The cache only remembers the last of linked
+# settings such as HILVL and LOLVL, so tracking needs them in the configuration.
+FULL_SHOT = dict(DEFAULT_CHANNEL, **SHOT, LOLVL=0, AMPL=5, DCOFFS=2.5)
+
+
+def prime(pg, ch2=None):
+    """Set every channel setting, so that the cache knows the settings which are not linked"""
+    apply_config(pg, {1: dict(DEFAULT_CHANNEL), 2: dict(DEFAULT_CHANNEL, **(ch2 or {}))}, use_coupling=False)
+
+
+def test_tracking_for_identical_channels(pg, emulator):
+    cmds = apply_config(pg, {1: dict(FULL_SHOT), 2: dict(FULL_SHOT)}, end_channel=1)
+    assert cmds[0] == ("TRACKING", "EQUAL")
+    assert ("CHN", 2) not in cmds
+    assert emulator.globals["TRACKING"] == "EQUAL"
+    assert emulator.channels[1]["PULSWID"] == 20e-6
+    assert emulator.channels[2] == emulator.channels[1]
+
+
+def test_tracking_with_known_settings(pg, emulator):
+    prime(pg)
+    linked = {m: FULL_SHOT[m] for group in _LINKED_SETTINGS for m in group}
+    config = dict(linked, WAVE='PULSE', OUTPUT='ON')
+    cmds = apply_config(pg, {1: dict(config), 2: dict(config)}, end_channel=1)
+    assert cmds[0] == ("TRACKING", "EQUAL")
+    assert emulator.channels[2] == emulator.channels[1]
+
+
+def test_no_tracking_when_trigger_source_differs(pg, emulator):
+    # Channel 2 is triggered by channel 1, which tracking would undo
+    prime(pg, {'TRGSRC': 'CRC'})
+    config = {m: v for m, v in FULL_SHOT.items() if m != 'TRGSRC'}
+    cmds = apply_config(pg, {1: dict(config), 2: dict(config)}, end_channel=1)
+    assert ("TRACKING", "EQUAL") not in cmds
+    assert emulator.globals["TRACKING"] == "OFF"
+    assert emulator.channels[2]["TRGSRC"] == "CRC"
+    assert emulator.channels[2]["PULSWID"] == 20e-6
+    pg.trigger()
+    assert emulator.triggers == {1: 1, 2: 1}
+
+
+def test_no_tracking_when_the_state_is_unknown(pg, emulator):
+    cmds = apply_config(pg, {1: dict(SHOT), 2: dict(SHOT)})
+    assert ("TRACKING", "EQUAL") not in cmds
+    assert emulator.globals["TRACKING"] == "OFF"
+
+
+def test_tracking_off_for_different_channels(pg, emulator):
+    apply_config(pg, {1: dict(FULL_SHOT), 2: dict(FULL_SHOT)})
+    cmds = apply_config(pg, {1: {'PULSWID': 10e-6}, 2: {'PULSWID': 30e-6}})
+    assert cmds[0] == ("TRACKING", "OFF")
+    assert emulator.globals["TRACKING"] == "OFF"
+    assert emulator.channels[1]["PULSWID"] == 10e-6
+    assert emulator.channels[2]["PULSWID"] == 30e-6
+
+
+def test_no_commands_for_known_settings(pg):
+    prime(pg)
+    apply_config(pg, {1: dict(SHOT), 2: {'PULSWID': 30e-6}})
+    assert apply_config(pg, {1: dict(SHOT), 2: {'PULSWID': 30e-6}}) == []
+
+
+def test_amplitude_coupling_sends_levels_once(pg, emulator):
+    config = {1: {'HILVL': 5, 'LOLVL': 0}, 2: {'HILVL': 5, 'LOLVL': 0}}
+    cmds = apply_config(pg, config, end_channel=1)
+    assert cmds[0] == ("AMPLCPLNG", "ON")
+    assert [m for m, v in cmds].count("HILVL") == 1
+    assert ("CHN", 2) not in cmds
+    assert emulator.globals["AMPLCPLNG"] == "ON"
+    assert emulator.channels[1]["HILVL"] == 5
+    assert pg.known_state()['global']["AMPLCPLNG"] == "ON"
+
+
+def test_no_coupling_for_part_of_the_coupled_settings():
+    # Coupling would also copy LOLVL, which the configuration leaves out
+    cmds = plan({1: {'HILVL': 5}, 2: {'HILVL': 5}})
+    assert all(m != "AMPLCPLNG" for m, v in cmds)
+
+
+def test_no_coupling_when_it_costs_more():
+    # One setting per channel: the switch would not save a command
+    cmds = plan({1: {'FREQ': 1e3}, 2: {'FREQ': 1e3}})
+    assert all(m not in ("FRQCPLSWT", "FRQCPLTYP", "FRQCPLRAT") for m, v in cmds)
+
+
+def test_coupling_switched_off_for_different_values():
+    known = {'global': {'AMPLCPLNG': 'ON'}}
+    cmds = plan({1: {'HILVL': 5, 'LOLVL': 0}, 2: {'HILVL': 3, 'LOLVL': 0}}, known, channel=1)
+    assert cmds[0] == ("AMPLCPLNG", "OFF")
+    assert cmds[1:] == [("HILVL", 5), ("LOLVL", 0), ("CHN", 2), ("HILVL", 3), ("LOLVL", 0)]
+
+
+@pytest.mark.parametrize("use_coupling", [True, False])
+def test_channel_switches(use_coupling):
+    # Start on the selected channel and end on the one to trigger
+    cmds = plan({1: {'PULSWID': 10e-6}, 2: {'PULSWID': 30e-6}}, channel=2, end_channel=1,
+                use_coupling=use_coupling)
+    assert cmds == [("PULSWID", 30e-6), ("CHN", 1), ("PULSWID", 10e-6)]
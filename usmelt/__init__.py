@@ -1,5 +1,34 @@
 from .tg5012a import TG5012A
+from .tg5012a import TG5012ACommands
+from .commands import Setting
+from .commands import SETTINGS
+from .error_check import InstrumentError
+from .error_check import BatchError
+from .error_check import InstrumentTimeout
+from .error_check import ErrorCheck
+from .error_check import EveryCommand
+from .error_check import Deferred
+from .error_check import StatusByte
+from .async_tg5012a import AsyncTG5012A
+from .recipes import RecipeStore
+from .supervisor import Supervisor
+from .broker import Broker
+from .client import TG5012AClient
+from .group import TG5012AGroup
+from .group import GroupError
+from .planner import plan
+from .planner import apply_config
+from .sweep import Sweep
+from .sweep import ShotResult
+from .arb import Waveform
+from .repetition import RepetitionRate
+from .monitor import Monitor
+from .journal import Journal
+from .journal import read_journal
+from .log import configure_logging
+from .log import JsonFormatter
 from .discovery import discover
 from .discovery import DeviceInfo
+from .discovery import probe_ports
 
 __version__ = '0.1.0'
\ No newline at end of file
@@ -0,0 +1,131 @@
+"""
+Arbitrary waveforms, for pulse sequences timed by the instrument itself.
+
+A sequence of pulses is turned into a waveform, uploaded to one of the
+arbitrary waveform memories of the TG5012A and played once per trigger::
+
+    wave = Waveform.from_pulses([(0, 50e-6, 2.0), (60e-6, 20e-6, 5.0), (90e-6, 200e-6, 1.0)])
+    slot = pg.upload_waveform(wave)
+    apply_config(pg, {1: wave.config(slot)}, end_channel=1)
+    pg.trigger()
+"""
+import array
+import hashlib
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Waveform memories of the instrument, ARB1 to ARB4
+ARB_SLOTS = (1, 2, 3, 4)
+ARB_MIN_POINTS = 2
+ARB_MAX_POINTS = 131072
+# The DAC has 14 bits, sent as 16 bit words from -32768 to 32767
+ARB_BITS = 14
+_SCALE = 2 ** (ARB_BITS - 1) - 1
+_SHIFT = 2 ** (16 - ARB_BITS)
+
+
+class Waveform:
+    """
+    An arbitrary waveform, played once over duration seconds.
+
+    Parameters
+    ----------
+    samples: sequence of float
+        The waveform, from -1 for low to 1 for high, evenly spaced in time.
+    duration: float
+        How long the waveform lasts, in seconds.
+    high: float
+        The output level for a sample of 1, in volts.
+    low: float
+        The output level for a sample of -1, in volts.
+    """
+    def __init__(self, samples, duration, high=1.0, low=-1.0):
+        if not ARB_MIN_POINTS <= len(samples) <= ARB_MAX_POINTS:
+            raise ValueError("A waveform needs between %d and %d points, not %d" % (ARB_MIN_POINTS, ARB_MAX_POINTS, len(samples)))
+        if high <= low:
+            raise ValueError("The high level of a waveform must be above its low level")
+        self.samples = samples
+        self.duration = duration
+        self.high = high
+        self.low = low
+        self._codes = None
+
+    @classmethod
+    def from_pulses(cls, pulses, duration=None, points=8192, base=0.0):
+        """
+        Builds the waveform of a sequence of rectangular pulses.
+
+        pulses is a list of (start, width, level) tuples, in seconds and volts.
+        Between the pulses the output is at base volts. Where pulses overlap
+        the later one in the list wins. duration defaults to the end of the
+        last pulse. Edges are placed on the nearest of the points samples, so
+        the timing resolution is duration / points.
+        """
+        if not pulses:
+            raise ValueError("A waveform needs at least one pulse")
+        end = max(start + width for start, width, level in pulses)
+        if duration is None:
+            duration = end
+        if any(start < 0 for start, width, level in pulses) or end > duration * (1 + 1e-9):
+            raise ValueError("Pulses must lie between 0 and %g s" % (duration))
+        levels = [base] + [level for start, width, level in pulses]
+        high, low = max(levels), min(levels)
+        if high == low:
+            raise ValueError("The pulses must have a level different from base")
+        dt = duration / points
+
+        def scale(v):
+            return 2.0 * (v - low) / (high - low) - 1.0
+
+        if np is not None:
+            samples = np.full(points, scale(base))
+        else:
+            samples = [scale(base)] * points
+        for start, width, level in pulses:
+            i0 = int(round(start / dt))
+            i1 = min(points, int(round((start + width) / dt)))
+            if i1 <= i0:
+                raise ValueError("Pulse at %g s of %g s is shorter than the resolution of %g s" % (start, width, dt))
+            samples[i0:i1] = [scale(level)] * (i1 - i0) if np is None else scale(level)
+        return cls(samples, duration, high, low)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def codes(self):
+        """The samples quantized to the resolution of the instrument, as 16 bit integers"""
+        if self._codes is None:
+            if np is not None:
+                codes = np.rint(np.clip(np.asarray(self.samples, dtype=float), -1, 1) * _SCALE) * _SHIFT
+                self._codes = codes.astype('>i2')
+            else:
+                self._codes = array.array('h', [int(round(max(-1.0, min(1.0, s)) * _SCALE)) * _SHIFT
+                                                for s in self.samples])
+        return self._codes
+
+    def data(self):
+        """The samples as sent to the instrument, two bytes per point, high byte first"""
+        codes = self.codes()
+        if np is not None:
+            return codes.tobytes()
+        codes = array.array('h', codes)
+        if sys.byteorder == 'little':
+            codes.byteswap()
+        return codes.tobytes()
+
+    def digest(self):
+        """A hash of the quantized samples, identifying the waveform in the instrument memory"""
+        return hashlib.sha1(self.data()).hexdigest()[:16]
+
+    def config(self, slot, trigger="MAN"):
+        """
+        The channel settings which play the waveform in slot once per trigger,
+        in the configuration format of ``usmelt.planner``.
+        """
+        return {'WAVE': 'ARB', 'ARBLOAD': 'ARB%d' % (slot), 'PER': self.duration,
+                'HILVL': self.high, 'LOLVL': self.low,
+                'BST': 'NCYC', 'BSTCOUNT': 1, 'TRGSRC': trigger}
@@ -0,0 +1,441 @@
+import asyncio
+import contextvars
+import os
+import serial
+import time
+from .tg5012a import TG5012ACommands, pg_logger, COMMAND_TIMEOUTS, _ERROR_QUERIES, _split_responses
+from .commands import format_value
+from .error_check import InstrumentError, InstrumentTimeout, EveryCommand, make_error_check
+
+
+class _SerialStream:
+    """Line oriented access to a serial port through a non-blocking file descriptor.
+
+    Only works on platforms where the event loop can watch serial ports,
+    e.g. Linux.
+    """
+    def __init__(self, ser):
+        self.ser = ser
+        self.fd = ser.fileno()
+        os.set_blocking(self.fd, False)
+        self._buffer = bytearray()
+
+    async def _wait(self, add, remove):
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        add(self.fd, lambda: fut.done() or fut.set_result(None))
+        try:
+            await fut
+        finally:
+            remove(self.fd)
+
+    async def write(self, data):
+        loop = asyncio.get_running_loop()
+        view = memoryview(data)
+        while view:
+            try:
+                n = os.write(self.fd, view)
+            except BlockingIOError:
+                n = 0
+            view = view[n:]
+            if view:
+                await self._wait(loop.add_writer, loop.remove_writer)
+
+    async def readline(self, terminator):
+        loop = asyncio.get_running_loop()
+        while True:
+            i = self._buffer.find(terminator)
+            if i >= 0:
+                line = bytes(self._buffer[:i + len(terminator)])
+                del self._buffer[:i + len(terminator)]
+                return line
+            await self._wait(loop.add_reader, loop.remove_reader)
+            try:
+                data = os.read(self.fd, 4096)
+            except BlockingIOError:
+                continue
+            if not data:
+                raise ConnectionError("Serial port closed")
+            self._buffer += data
+
+    async def close(self):
+        self.ser.close()
+
+
+class _SocketStream:
+    """Line oriented access to the LAN port through asyncio streams"""
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    async def write(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def readline(self, terminator):
+        return await self.reader.readuntil(terminator)
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+class AsyncTG5012A(TG5012ACommands):
+    """
+    asyncio control of the Aim TTi TG5012A function generator.
+
+    Offers the same commands as ``TG5012A``, but all of them are coroutines.
+    Use ``AsyncTG5012A.open()`` to connect::
+
+        pg = await AsyncTG5012A.open(address='t539639.local')
+        await pg.channel(1)
+        await pg.pulse_width(20e-6)
+        await pg.trigger()
+
+    Requests from concurrent tasks are queued and sent one at a time, in the order
+    they were made. Cancelling a request which is still queued removes it from the queue.
+    Once a request is on the wire it is completed, including its error check,
+    so that the responses stay in sync with the commands. A request which does
+    not complete within its timeout raises an ``InstrumentTimeout``, and late
+    responses are then discarded like ``TG5012A`` does.
+    ``deadline()`` is a plain ``with`` block, which bounds the requests awaited in it
+    by the same task.
+
+    error_check can be True, False or ``EveryCommand()``. The other ``ErrorCheck``
+    strategies raise a ValueError. The shadow state cache of ``TG5012A`` is not available.
+    """
+    def __init__(self, stream, auto_local=True, error_check=True, local_delay=0.5, timeout=1.0):
+        """Wraps an already connected stream. Use ``AsyncTG5012A.open()`` instead."""
+        self.terminator = b'\n'
+        self.stream = stream
+        self.auto_local = auto_local
+        self.error_check = error_check
+        self.local_delay = local_delay
+        self.timeout = timeout
+        self._user_deadline = contextvars.ContextVar('deadline', default=None)
+        self._lock = asyncio.Lock()
+        self._batch = None
+        # The task queuing the current batch, and an event set whenever no batch is open
+        self._batch_owner = None
+        self._batch_closed = asyncio.Event()
+        self._batch_closed.set()
+        self._local_handle = None
+        # The ID of the instrument, which ends the discarding of late responses
+        self._idn = None
+        self._idn_pending = 0
+        self._resync_needed = False
+
+    @property
+    def error_check(self):
+        """The ``ErrorCheck`` strategy in use, or None if errors are not checked"""
+        return self._error_check
+
+    @error_check.setter
+    def error_check(self, error_check):
+        error_check = make_error_check(error_check)
+        if error_check is not None and not isinstance(error_check, EveryCommand):
+            raise ValueError("AsyncTG5012A only supports error_check True, False or EveryCommand()")
+        self._error_check = error_check
+
+    @classmethod
+    async def open(cls, serial_port=None, address='t539639.local', port=9221, **kwargs):
+        """Connects to a TG5012A function generator using the given serial_port or LAN address and port
+
+        The remaining keyword arguments are passed to the constructor.
+        """
+        if serial_port is not None:
+            ser = serial.Serial(port=serial_port, timeout=0)
+            if(ser.is_open != True):
+                raise ConnectionError("Serial port failed to open")
+            stream = _SerialStream(ser)
+            where = serial_port
+        else:
+            reader, writer = await asyncio.open_connection(address, port)
+            stream = _SocketStream(reader, writer)
+            where = "%s:%d" % (address, port)
+        try:
+            pg = cls(stream, **kwargs)
+            pg._idn = await pg.id()
+            pg_logger.info(pg._idn)
+            pg_logger.info("Successfully connected to TG5012A on %s" % (where))
+        except:
+            await stream.close()
+            raise
+        return pg
+
+    async def close(self):
+        """Close the connection."""
+        if self._local_handle is not None:
+            self._local_handle.cancel()
+            self._local_handle = None
+        async with self._lock:
+            await self.stream.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    # Convenience functions
+    async def pulse(self, freq=1, width=0.1, rise = 10e-9, fall = 10e-9, high=1, low=0, delay = 0, phase=0, output = "ON"):
+        """Sets the output to a pulse with the given parameters"""
+        async with self.batch():
+            await self.wave("PULSE")
+            await self.frequency(freq)
+            await self.pulse_width(width)
+            await self.pulse_rise(rise)
+            await self.pulse_fall(fall)
+            await self.pulse_delay(delay)
+            await self.high(high)
+            await self.low(low)
+            await self.phase(phase)
+            await self.output(output)
+
+    def batch(self):
+        """Queue set commands and send them to the instrument in one go.
+
+        Works like ``TG5012A.batch()``, as an ``async with`` block. Only the
+        task which opened the batch queues into it. Requests from other tasks
+        wait for the batch to be sent.
+        """
+        return _Batch(self)
+
+    async def _wait_for_batch(self):
+        """Wait until no other task has a batch open"""
+        while self._batch is not None and self._batch_owner is not asyncio.current_task():
+            await self._batch_closed.wait()
+
+    async def _serialized(self, command, timeout, fn, *args):
+        """Run fn(*args) as command once all previous requests are done"""
+        # Waiting for the lock can be cancelled, which drops the request
+        await self._lock.acquire()
+        if self._local_handle is not None:
+            self._local_handle.cancel()
+            self._local_handle = None
+        try:
+            inner = asyncio.ensure_future(self._with_deadline(command, timeout, fn, *args))
+        except:
+            self._lock.release()
+            raise
+        def done(task):
+            self._lock.release()
+            if not task.cancelled():
+                # Avoid warnings about exceptions of cancelled callers never being retrieved
+                task.exception()
+        inner.add_done_callback(done)
+        # Once on the wire the request always completes
+        return await asyncio.shield(inner)
+
+    async def _with_deadline(self, command, timeout, fn, *args):
+        """Run fn(*args) as one command, which has to complete within timeout seconds"""
+        if self._resync_needed:
+            await self._resync()
+        if timeout is None:
+            timeout = self.command_timeout(command)
+        user_end = self._user_deadline.get()
+        if user_end is not None:
+            timeout = min(timeout, user_end - time.monotonic())
+            if timeout <= 0:
+                raise InstrumentTimeout(command, 0)
+        try:
+            return await asyncio.wait_for(fn(*args), timeout)
+        except asyncio.TimeoutError:
+            if "*IDN?" in command:
+                # Its late response would end the resynchronization too early
+                self._idn_pending += 1
+            try:
+                await self._resync()
+            except InstrumentTimeout as e:
+                # Tried again before the next command
+                pg_logger.warning("Could not resynchronize with the instrument: %s" % (e))
+            raise InstrumentTimeout(command, timeout) from None
+
+    async def _resync(self):
+        """Discard late responses, so that the next response read belongs to the next command
+
+        Works like ``TG5012A._resync()``.
+        """
+        self._resync_needed = True
+        if self._idn is None:
+            # Not connected yet, nothing to compare with
+            self._resync_needed = False
+            return
+        try:
+            await asyncio.wait_for(self._discard_late(), self.timeout)
+        except asyncio.TimeoutError:
+            raise InstrumentTimeout("*IDN?", self.timeout) from None
+        self._resync_needed = False
+
+    async def _discard_late(self):
+        await self.write("*IDN?")
+        self._idn_pending += 1
+        while self._idn_pending > 0:
+            if await self.read() == self._idn:
+                self._idn_pending -= 1
+
+    def command_timeout(self, cmd):
+        """The time allowed by default for cmd, in seconds"""
+        return max(self.timeout, COMMAND_TIMEOUTS.get(cmd.split(' ')[0], 0))
+
+    async def query(self, cmd, timeout=None):
+        """Send the query cmd and return the response
+
+        timeout replaces the default time allowed for the query, in seconds.
+        """
+        await self._wait_for_batch()
+        if self._batch:
+            await self._flush_batch()
+        return await self._serialized(cmd, timeout, self._query, cmd, True)
+
+    async def query_many(self, cmds, timeout=None):
+        """Send several queries back-to-back and return their responses in order"""
+        cmds = list(cmds)
+        if not cmds:
+            return []
+        await self._wait_for_batch()
+        if self._batch:
+            await self._flush_batch()
+        if timeout is None:
+            timeout = max(self.command_timeout(cmd) for cmd in cmds)
+        return await self._serialized(';'.join(cmds), timeout, self._query_many, cmds)
+
+    async def _query_many(self, cmds):
+        await self.write(';'.join(cmds))
+        ret = _split_responses(await self.read())
+        if len(ret) != len(cmds):
+            if self._error_check is not None:
+                # Unknown queries are reported as command errors in EER?
+                kind, err = 'execution', int(await self._query("EER?", False))
+                if err == 0:
+                    kind, err = 'query', int(await self._query("QER?", False))
+                if err != 0:
+                    raise InstrumentError(kind, err, cmds)
+            raise ValueError("Expected %d responses to %s but got %d" % (len(cmds), ';'.join(cmds), len(ret)))
+        if self._error_check is not None:
+            pg_logger.info("%s returned %s", ';'.join(cmds), ';'.join(ret))
+            err = await self._query("QER?", False)
+            if int(err) != 0:
+                raise InstrumentError('query', int(err), cmds)
+        if self.auto_local:
+            await self._auto_local()
+        return ret
+
+    async def set(self, cmd, value=None, timeout=None):
+        """Send the set command cmd with the given value, if any
+
+        timeout replaces the default time allowed for the command, in seconds.
+        """
+        if(value is not None):
+            cmd = cmd + ' ' + format_value(value)
+        await self._wait_for_batch()
+        if self._batch is not None and cmd != "LOCAL":
+            self._batch.append(cmd)
+            return None
+        return await self._serialized(cmd, timeout, self._set, cmd, True)
+
+    async def _query(self, cmd, schedule_local):
+        await self.write(cmd)
+        ret = await self.read()
+        if cmd not in _ERROR_QUERIES and self._error_check is not None:
+            pg_logger.info("%s returned %s", cmd, ret)
+            err = await self._query("QER?", False)
+            if int(err) != 0:
+                raise InstrumentError('query', int(err), [cmd])
+        if(self.auto_local and schedule_local and cmd != "LOCAL" and cmd not in _ERROR_QUERIES):
+            await self._auto_local()
+        return ret
+
+    async def _set(self, cmd, schedule_local):
+        ret = await self.write(cmd)
+        if(cmd != "LOCAL"):
+            # Don't log all the LOCAL commands to avoid flooding the log file
+            pg_logger.info(cmd)
+        # Reading the error registers after LOCAL would put the instrument back in remote mode
+        if self._error_check is not None and cmd != "LOCAL":
+            err = await self._query("EER?", False)
+            if int(err) != 0:
+                raise InstrumentError('execution', int(err), [cmd])
+        if(self.auto_local and schedule_local and cmd != "LOCAL"):
+            await self._auto_local()
+        return ret
+
+    async def _flush_batch(self):
+        """Send the commands queued in the current batch, once all previous requests are done"""
+        # The batch gets the time of its slow commands on top of the default
+        timeout = self.timeout + sum(COMMAND_TIMEOUTS.get(cmd.split(' ')[0], 0) for cmd in self._batch)
+        await self._serialized("BATCH", timeout, self._send_batch)
+
+    async def _send_batch(self):
+        cmds = self._batch
+        if not cmds:
+            return
+        self._batch = []
+        if self._error_check is not None:
+            await self.write(self._error_check.format_batch(cmds))
+        else:
+            await self.write(';'.join(cmds))
+        for cmd in cmds:
+            pg_logger.info(cmd)
+        if self._error_check is not None:
+            self._error_check.check_batch(cmds, await self._read_responses(len(cmds)))
+        if self.auto_local:
+            await self._auto_local()
+
+    async def _auto_local(self):
+        """Return the instrument to local mode, immediately or once the bus is idle"""
+        if self.local_delay <= 0:
+            await self._set("LOCAL", False)
+            return
+        loop = asyncio.get_running_loop()
+        self._local_handle = loop.call_later(self.local_delay, self._idle_local)
+
+    def _idle_local(self):
+        self._local_handle = None
+        task = asyncio.ensure_future(self.local())
+        task.add_done_callback(lambda t: t.cancelled() or t.exception() is None or
+                               pg_logger.warning("Idle LOCAL failed: %s" % (t.exception())))
+
+    async def write(self, str):
+        """Write str to the instrument encoded as ascii as terminated"""
+        pg_logger.debug(str)
+        bytes = str.encode('ascii') + self.terminator
+        await self.stream.write(bytes)
+        return len(bytes)
+
+    async def read(self):
+        """Read line from the instrument"""
+        return (await self.stream.readline(self.terminator)).decode('ascii').strip()
+
+    async def _read_responses(self, n):
+        """Read n responses, whether they come on one line separated by ';' or on several lines"""
+        ret = []
+        while len(ret) < n:
+            ret += _split_responses(await self.read())
+        return ret
+
+
+class _Batch:
+    def __init__(self, pg):
+        self.pg = pg
+        self.outer = False
+
+    async def __aenter__(self):
+        await self.pg._wait_for_batch()
+        if self.pg._batch is None:
+            self.pg._batch = []
+            self.pg._batch_owner = asyncio.current_task()
+            self.pg._batch_closed.clear()
+            self.outer = True
+        return self.pg
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if not self.outer:
+            return
+        try:
+            if exc_type is None:
+                await self.pg._flush_batch()
+        finally:
+            self.pg._batch = None
+            self.pg._batch_owner = None
+            self.pg._batch_closed.set()
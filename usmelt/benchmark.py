@@ -0,0 +1,242 @@
+"""
+Throughput and latency benchmarks of the ``TG5012A`` driver against the emulator.
+
+Every combination of error checking strategy, return to local mode and
+transport is measured, and the results written as JSON so that they can be
+compared between versions::
+
+    python -m usmelt.benchmark --output before.json
+    # change the driver
+    python -m usmelt.benchmark --output after.json --compare before.json
+
+With ``--compare`` the exit status is 1 if any result got worse by more than
+the tolerance, so it can gate changes.
+"""
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from . import __version__
+from .tg5012a import TG5012A
+from .error_check import Deferred, StatusByte
+from .emulator import TG5012AEmulator
+from .planner import apply_config
+
+# Configuration applied on start up, as by usmelt_gui.py
+INIT_CONFIG = {
+    1: {'WAVE': 'PULSE', 'PULSPER': 10e-3, 'HILVL': 1, 'LOLVL': 0, 'PULSRISE': 10e-9, 'PULSFALL': 10e-9,
+        'PULSDLY': 0, 'BST': 'NCYC', 'BSTCOUNT': 1, 'TRGSRC': 'MAN', 'OUTPUT': 'OFF'},
+    2: {'WAVE': 'PULSE', 'PULSPER': 10e-3, 'HILVL': 1, 'LOLVL': 0, 'PULSRISE': 10e-9, 'PULSFALL': 10e-9,
+        'PULSDLY': 0, 'BST': 'NCYC', 'BSTCOUNT': 1, 'TRGSRC': 'CRC', 'OUTPUT': 'OFF'},
+}
+
+ERROR_CHECKS = {
+    'off': lambda: False,
+    'every': lambda: True,
+    'deferred': Deferred,
+    'status': StatusByte,
+}
+
+# local_delay of each auto_local mode, None for auto_local off
+AUTO_LOCAL = {
+    'off': None,
+    'idle': 0.5,
+    'each': 0,
+}
+
+TRANSPORTS = ('tcp', 'pty')
+
+# Results where a larger value is better, the others are times or counts
+_HIGHER_IS_BETTER = ('ops_per_s',)
+
+
+def _melt_config(i):
+    width = (20 + i % 5) * 1e-6
+    return {1: {'OUTPUT': 'ON', 'PULSWID': width, 'HILVL': 5, 'PULSDLY': 0},
+            2: {'OUTPUT': 'ON', 'PULSWID': width / 2, 'HILVL': 5, 'PULSDLY': 1e-6}}
+
+
+def _latencies(pg, name, fn, n):
+    """Time n calls of fn(i) as the operation name, returning a result record"""
+    times = []
+    for i in range(n):
+        start = time.perf_counter()
+        with pg.metrics.operation(name):
+            fn(i)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    stats = pg.metrics.operations[name]
+    return {'median_s': statistics.median(times), 'p90_s': times[int(0.9 * (len(times) - 1))],
+            'round_trips': stats['round_trips'] / stats['count']}
+
+
+def _throughput(pg, fn, n):
+    """Time n calls of fn(i), returning a result record with the calls per second"""
+    writes = pg.metrics.writes
+    start = time.perf_counter()
+    for i in range(n):
+        fn(i)
+    seconds = time.perf_counter() - start
+    return {'ops_per_s': n / seconds, 'round_trips': (pg.metrics.writes - writes) / n}
+
+
+def run_case(pg, n):
+    """Runs the benchmarks on pg, returning the results by benchmark name"""
+    ret = {}
+    # Different values each time, so that nothing could be skipped
+    ret['set'] = _throughput(pg, lambda i: pg.pulse_width(1e-5 + i * 1e-9), n)
+    ret['query'] = _throughput(pg, lambda i: pg.query("PULSWID?"), n)
+    ret['pulse'] = _latencies(pg, 'pulse', lambda i: pg.pulse(width=1e-4 + i * 1e-9, rise=10e-9, fall=10e-9),
+                              max(1, n // 10))
+    ret['init'] = _latencies(pg, 'init', lambda i: (pg.invalidate_cache(), apply_config(pg, INIT_CONFIG, use_coupling=False)),
+                             max(1, n // 10))
+    ret['melt'] = _latencies(pg, 'melt', lambda i: (apply_config(pg, _melt_config(i), end_channel=1), pg.trigger()), n)
+    pg.trigger_src("MAN")
+    # Armed once, as by the GUI, so that only the trigger is timed
+    pg.arm(_melt_config(0), 1)
+    ret['melt_armed'] = _latencies(pg, 'melt_armed', lambda i: (pg.arm(_melt_config(0), 1), pg.fire()), n)
+    pg.disarm()
+    if pg.error_check is not None:
+        pg.check_errors()
+    return ret
+
+
+def run(n=200, transports=TRANSPORTS, error_checks=ERROR_CHECKS, auto_locals=AUTO_LOCAL, latency=0.0, baudrate=None,
+        progress=None):
+    """
+    Runs the benchmarks for every combination of the options.
+
+    Parameters
+    ----------
+    n: int
+        Number of commands or operations timed for each benchmark.
+    transports: list of str
+        Any of ``'tcp'`` and ``'pty'``. The pseudo-terminal needs a Unix system.
+    error_checks: list of str
+        Keys of ``ERROR_CHECKS``.
+    auto_locals: list of str
+        Keys of ``AUTO_LOCAL``.
+    latency: float
+        Time the emulator takes for each command, in seconds.
+    baudrate: int or None
+        Serial line rate emulated by the emulator.
+    progress: callable
+        Called with a description of each combination before it runs.
+
+    Returns
+    -------
+    dict
+        The description of the run under ``'meta'`` and the results under
+        ``'results'``, one record per benchmark and combination.
+    """
+    results = []
+    if 'pty' in transports and not hasattr(os, 'openpty'):
+        transports = [t for t in transports if t != 'pty']
+    for transport, error_check, auto_local in itertools.product(transports, error_checks, auto_locals):
+        if progress is not None:
+            progress('transport=%s error_check=%s auto_local=%s' % (transport, error_check, auto_local))
+        # A fresh emulator each time, so every combination starts from the same state
+        emulator = TG5012AEmulator(latency=latency, baudrate=baudrate)
+        if transport == 'tcp':
+            kwargs = {'address': '127.0.0.1', 'port': emulator.serve_tcp()}
+        else:
+            kwargs = {'serial_port': emulator.serve_pty()}
+        local_delay = AUTO_LOCAL[auto_local]
+        try:
+            pg = TG5012A(auto_local=local_delay is not None, local_delay=local_delay or 0,
+                         error_check=ERROR_CHECKS[error_check](), **kwargs)
+            try:
+                for name, record in run_case(pg, n).items():
+                    results.append(dict(record, benchmark=name, transport=transport,
+                                        error_check=error_check, auto_local=auto_local))
+            finally:
+                pg.close()
+        finally:
+            emulator.close()
+    meta = {'version': __version__, 'python': platform.python_version(), 'platform': platform.platform(),
+            'time': time.time(), 'n': n, 'latency': latency, 'baudrate': baudrate}
+    return {'meta': meta, 'results': results}
+
+
+def _key(record):
+    return (record['benchmark'], record['transport'], record['error_check'], record['auto_local'])
+
+
+def compare(old, new, tolerance=0.2):
+    """
+    Compares two results of ``run()``.
+
+    Returns a list of (key, field, old value, new value, ratio, regressed) for
+    every value found in both, where ratio is new over old and regressed is
+    True if it got worse by more than tolerance. Round trips are compared
+    exactly, as they do not depend on the machine.
+    """
+    old_records = {_key(r): r for r in old['results']}
+    ret = []
+    for record in new['results']:
+        key = _key(record)
+        if key not in old_records:
+            continue
+        for field, value in record.items():
+            before = old_records[key].get(field)
+            if not isinstance(value, (int, float)) or not isinstance(before, (int, float)):
+                continue
+            ratio = value / before if before else float('inf') if value else 1.0
+            if field == 'round_trips':
+                regressed = value > before
+            elif field in _HIGHER_IS_BETTER:
+                regressed = ratio < 1 - tolerance
+            else:
+                regressed = ratio > 1 + tolerance
+            ret.append((key, field, before, value, ratio, regressed))
+    return ret
+
+
+def _table(results):
+    lines = ['%-11s %-4s %-9s %-5s %12s %12s %12s %8s' % ('benchmark', 'link', 'errors', 'local',
+                                                          'ops/s', 'median ms', 'p90 ms', 'trips')]
+    for r in results:
+        lines.append('%-11s %-4s %-9s %-5s %12s %12s %12s %8.2f' % (
+            r['benchmark'], r['transport'], r['error_check'], r['auto_local'],
+            '%.0f' % r['ops_per_s'] if 'ops_per_s' in r else '',
+            '%.3f' % (r['median_s'] * 1e3) if 'median_s' in r else '',
+            '%.3f' % (r['p90_s'] * 1e3) if 'p90_s' in r else '',
+            r['round_trips']))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark the TG5012A driver against the emulator.')
+    parser.add_argument('-n', type=int, default=200, help='commands or operations timed per benchmark')
+    parser.add_argument('--transport', nargs='+', default=list(TRANSPORTS), choices=TRANSPORTS)
+    parser.add_argument('--error-check', nargs='+', default=list(ERROR_CHECKS), choices=list(ERROR_CHECKS))
+    parser.add_argument('--auto-local', nargs='+', default=list(AUTO_LOCAL), choices=list(AUTO_LOCAL))
+    parser.add_argument('--latency', type=float, default=0.0, help='emulated processing time per command, in seconds')
+    parser.add_argument('--baudrate', type=int, default=None, help='emulated serial line rate')
+    parser.add_argument('--output', default=None, help='write the results to this JSON file')
+    parser.add_argument('--compare', default=None, help='compare with the results in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative change allowed by --compare')
+    args = parser.parse_args()
+    result = run(args.n, args.transport, args.error_check, args.auto_local, args.latency, args.baudrate,
+                 progress=lambda text: print(text, file=sys.stderr))
+    print(_table(result['results']))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=1)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        for field in ('n', 'latency', 'baudrate'):
+            if baseline['meta'].get(field) != result['meta'][field]:
+                print('Warning: %s was %s in %s, now %s' % (field, baseline['meta'].get(field), args.compare,
+                                                            result['meta'][field]))
+        changes = compare(baseline, result, args.tolerance)
+        regressions = [c for c in changes if c[5]]
+        for key, field, before, value, ratio, regressed in regressions:
+            print('REGRESSION %s %s: %.6g -> %.6g (x%.2f)' % ('/'.join(key), field, before, value, ratio))
+        print('%d values compared, %d regressions' % (len(changes), len(regressions)))
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,287 @@
+"""
+A broker process which owns the connection to a TG5012A and shares it with many clients.
+
+Clients connect over a localhost TCP socket, usually through ``TG5012AClient``,
+and exchange one JSON object per line with the broker:
+
+    {"id": 1, "op": "set", "cmd": "PULSWID", "value": "2e-05"}
+    {"id": 1, "result": null}
+
+Run it with ``python -m usmelt.broker``.
+"""
+import json
+import queue
+import socket
+import socketserver
+import threading
+import time
+from .tg5012a import TG5012A, pg_logger, _CHANNEL_INDEPENDENT
+from .error_check import InstrumentError, InstrumentTimeout, BatchError
+
+DEFAULT_PORT = 9222
+
+_STOP = object()
+
+
+def _mergeable(item):
+    """Set requests with a value can be sent together with those of other clients.
+
+    Actions such as *TRG are never merged.
+    """
+    return item is not _STOP and item[1].get('op') == 'set' and item[1].get('value') is not None
+
+
+def _encode_error(e):
+    ret = {'type': type(e).__name__, 'message': str(e)}
+    if isinstance(e, InstrumentError):
+        ret.update(kind=e.kind, error=e.error, commands=e.commands)
+    if isinstance(e, BatchError):
+        ret.update(command=e.command, index=e.index)
+    if isinstance(e, InstrumentTimeout):
+        ret.update(command=e.command, timeout=e.timeout)
+    return ret
+
+
+class _Session:
+    """A connected client, with the channel it has selected"""
+    def __init__(self, wfile, name):
+        self.wfile = wfile
+        self.name = name
+        self.channel = None
+        self.events = set()
+        self._lock = threading.Lock()
+
+    def send(self, message):
+        data = (json.dumps(message) + '\n').encode('utf-8')
+        with self._lock:
+            try:
+                self.wfile.write(data)
+                self.wfile.flush()
+            except OSError:
+                # The client went away, its handler cleans up
+                pass
+
+
+class Broker:
+    """
+    Serves one ``TG5012A`` to many clients.
+
+    Requests from all the clients are run one at a time by a single thread, in
+    the order they arrive. Set commands from different clients that arrive
+    together are sent as one batch. Each client keeps its own selected channel,
+    which the broker selects before running the client's commands. With the
+    shadow state cache of pg enabled, which is recommended, redundant channel
+    switches and settings are then not sent.
+
+    Clients can subscribe to ``'shot'`` events, published after each ``*TRG``.
+
+    Parameters
+    ----------
+    pg: TG5012A
+        The instrument to share.
+    host: str
+        Address to listen on. Keep it on localhost, the protocol has no authentication.
+    port: int
+        TCP port to listen on, 0 to pick a free one.
+    max_batch: int
+        Maximum number of set requests sent together.
+    """
+    def __init__(self, pg, host='127.0.0.1', port=DEFAULT_PORT, max_batch=64):
+        self.pg = pg
+        self.max_batch = max_batch
+        self.requests = queue.Queue()
+        self.sessions = []
+        self._sessions_lock = threading.Lock()
+        self._idn = None
+        broker = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                broker._serve(self.rfile, self.wfile, "%s:%d" % self.client_address)
+
+        class Server(socketserver.ThreadingTCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self.server = Server((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self._executor = threading.Thread(target=self.run, daemon=True)
+        self._executor.start()
+
+    def serve_forever(self):
+        """Serve clients until shutdown() is called"""
+        pg_logger.info("Broker listening on port %d" % (self.port))
+        self.server.serve_forever()
+
+    def start(self):
+        """Serve clients on a background thread"""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self.port
+
+    def shutdown(self):
+        """Stop serving and stop running requests"""
+        self.server.shutdown()
+        self.server.server_close()
+        self.requests.put(_STOP)
+        self._executor.join()
+
+    def publish(self, event, **data):
+        """Send an event to the clients subscribed to it"""
+        message = dict(data, event=event)
+        with self._sessions_lock:
+            sessions = [s for s in self.sessions if event in s.events]
+        for s in sessions:
+            s.send(message)
+
+    def _serve(self, rfile, wfile, name):
+        session = _Session(wfile, name)
+        with self._sessions_lock:
+            self.sessions.append(session)
+        pg_logger.info("Broker client %s connected" % (name))
+        try:
+            for line in rfile:
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    session.send({'id': None, 'error': {'type': 'ValueError', 'message': 'Malformed request'}})
+                    continue
+                if request.get('op') == 'subscribe':
+                    # Does not touch the instrument, so it does not wait for the queue
+                    session.events.update(request.get('events', []))
+                    session.send({'id': request.get('id'), 'result': None})
+                    continue
+                self.requests.put((session, request))
+        finally:
+            with self._sessions_lock:
+                self.sessions.remove(session)
+            pg_logger.info("Broker client %s disconnected" % (name))
+
+    def run(self):
+        """Run the queued requests, one group at a time"""
+        item = None
+        while True:
+            if item is None:
+                item = self.requests.get()
+            if item is _STOP:
+                return
+            group = [item]
+            item = None
+            if _mergeable(group[0]):
+                while len(group) < self.max_batch:
+                    try:
+                        item = self.requests.get_nowait()
+                    except queue.Empty:
+                        item = None
+                        break
+                    if not _mergeable(item):
+                        break
+                    group.append(item)
+                    item = None
+            self._run_group(group)
+
+    def _run_group(self, group):
+        if len(group) > 1:
+            try:
+                with self.pg.batch():
+                    for session, request in group:
+                        self._set(session, request['cmd'], request.get('value'))
+            except InstrumentError:
+                # Find out whose command failed. Set commands can safely be sent again.
+                for item in group:
+                    self._run_group([item])
+                return
+            except Exception as e:
+                for session, request in group:
+                    session.send({'id': request.get('id'), 'error': _encode_error(e)})
+                return
+            for session, request in group:
+                session.send({'id': request.get('id'), 'result': None})
+            return
+        session, request = group[0]
+        try:
+            result = self._execute(session, request)
+        except Exception as e:
+            session.send({'id': request.get('id'), 'error': _encode_error(e)})
+            return
+        session.send({'id': request.get('id'), 'result': result})
+
+    def _execute(self, session, request):
+        op = request.get('op')
+        if op == 'set':
+            self._set(session, request['cmd'], request.get('value'))
+            self._shots(session, [request['cmd']])
+            return None
+        if op == 'batch':
+            cmds = request['cmds']
+            with self.pg.batch():
+                for cmd, value in cmds:
+                    self._set(session, cmd, value)
+            self._shots(session, [cmd for cmd, value in cmds])
+            return None
+        if op == 'query':
+            return self._query(session, request['cmd'])
+        if op == 'query_many':
+            self._select(session, request['cmds'])
+            return self.pg.query_many(request['cmds'])
+        if op == 'check_errors':
+            self.pg.check_errors()
+            return None
+        if op == 'known_state':
+            state = self.pg.known_state()
+            state['channel'] = int(session.channel) if session.channel is not None else state['channel']
+            return state
+        if op == 'stats':
+            return self.pg.stats()
+        raise ValueError("Unknown broker request %s" % (op))
+
+    def _select(self, session, cmds):
+        """Select the channel of session before commands which depend on it"""
+        if session.channel is not None and any(c.split(' ')[0] not in _CHANNEL_INDEPENDENT for c in cmds):
+            self.pg.channel(session.channel)
+
+    def _set(self, session, cmd, value):
+        if cmd == "CHN" and value is not None:
+            # Only selected on the instrument once the client sends a command for it
+            session.channel = str(value)
+            return
+        self._select(session, [cmd])
+        self.pg.set(cmd, value)
+
+    def _query(self, session, cmd):
+        if cmd == "CHN?" and session.channel is not None:
+            return session.channel
+        if cmd == "*IDN?":
+            # Every client asks for it when connecting
+            if self._idn is None:
+                self._idn = self.pg.query(cmd)
+            return self._idn
+        self._select(session, [cmd])
+        return self.pg.query(cmd)
+
+    def _shots(self, session, cmds):
+        for cmd in cmds:
+            if cmd == "*TRG":
+                self.publish('shot', time=time.time(), client=session.name)
+
+
+if __name__ == '__main__':
+    import argparse
+    from .discovery import discover
+    parser = argparse.ArgumentParser(description='Share a TG5012A with several clients.')
+    parser.add_argument('--serial-port', default=None, help='serial port of the instrument, found with discover() if not given')
+    parser.add_argument('--address', default=None, help='LAN address of the instrument, instead of a serial port')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='TCP port to serve clients on')
+    args = parser.parse_args()
+    if args.address is not None:
+        pg = TG5012A(address=args.address, cache=True)
+    else:
+        serial_port = args.serial_port or discover(['TG5012A'])['TG5012A'].device
+        pg = TG5012A(serial_port=serial_port, cache=True)
+    broker = Broker(pg, port=args.port)
+    print('Serving TG5012A on 127.0.0.1:%d' % (broker.port))
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
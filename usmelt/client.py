@@ -0,0 +1,241 @@
+import builtins
+import concurrent.futures
+import contextlib
+import contextvars
+import itertools
+import json
+import socket
+import threading
+import time
+from .tg5012a import TG5012ACommands, pg_logger, COMMAND_TIMEOUTS, _locked
+from .error_check import InstrumentError, BatchError, InstrumentTimeout
+from .metrics import Metrics
+from .broker import DEFAULT_PORT
+
+
+def _decode_error(error):
+    kind = error.get('type')
+    if kind == 'BatchError':
+        return BatchError(error['command'], error['index'], error['error'])
+    if kind == 'InstrumentError':
+        return InstrumentError(error['kind'], error['error'], error['commands'], error['message'])
+    if kind == 'InstrumentTimeout':
+        return InstrumentTimeout(error['command'], error['timeout'])
+    cls = getattr(builtins, kind, None)
+    if isinstance(cls, type) and issubclass(cls, Exception):
+        return cls(error['message'])
+    return RuntimeError("%s: %s" % (kind, error['message']))
+
+
+class TG5012AClient(TG5012ACommands):
+    """
+    Control of a TG5012A shared through a ``usmelt.broker`` process.
+
+    Offers the same commands as ``TG5012A``, so it can replace it::
+
+        pg = TG5012AClient()
+        pg.channel(1)
+        pg.pulse_width(20e-6)
+        pg.trigger()
+
+    The channel selected with ``channel()`` belongs to this client, other
+    clients of the broker keep their own. Errors reported by the instrument
+    raise the same exceptions as with ``TG5012A``.
+
+    The broker owns the error checking, the return to local mode and the
+    shadow state cache, so none of these are set here. ``metrics`` counts
+    the requests made to the broker.
+
+    The client offers the setting commands, queries, batches and deadlines of
+    ``TG5012A``, but not ``arm()``, ``fire()``, ``disarm()`` or
+    ``upload_waveform()``, which rely on the instrument being left alone
+    between calls and so need a ``TG5012A`` of their own.
+
+    A request which gets no answer within its timeout raises an
+    ``InstrumentTimeout``. The time allowed includes the wait for the requests
+    of other clients, which the broker runs first.
+    """
+    def __init__(self, address='127.0.0.1', port=DEFAULT_PORT, timeout=5.0):
+        """Connects to the broker at the given address and port
+
+        timeout is the time allowed by default for each request, in seconds.
+        """
+        self.sock = socket.create_connection((address, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.timeout = timeout
+        self._user_deadline = contextvars.ContextVar('deadline', default=None)
+        self.metrics = Metrics()
+        self._batch = None
+        self._ids = itertools.count()
+        self._pending = {}
+        self._callbacks = {}
+        self._closed = None
+        # Held by a batch until it is sent, so that other threads wait instead of joining it
+        self._lock = threading.RLock()
+        self._pending_lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+        pg_logger.info("Connected to the TG5012A broker on %s:%d" % (address, port))
+
+    def close(self):
+        """Close the connection to the broker."""
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def subscribe(self, event, callback):
+        """Call callback with the data of each event of the given kind, e.g. ``'shot'``
+
+        The callbacks run on the thread reading from the broker, so they
+        should return quickly and not send commands themselves.
+        """
+        self._callbacks.setdefault(event, []).append(callback)
+        self._request('subscribe', events=[event])
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Queue set commands and have the broker send them in one go.
+
+        Works like ``TG5012A.batch()``. The broker runs the whole batch
+        before the commands of any other client.
+        """
+        with self._lock:
+            if self._batch is not None:
+                yield self
+                return
+            self._batch = []
+            try:
+                yield self
+                self._flush_batch()
+            finally:
+                self._batch = None
+
+    def _acquire(self):
+        """Take the lock held by batches, for the methods wrapped with ``_locked``"""
+        self._lock.acquire()
+
+    def _flush_batch(self):
+        cmds = self._batch
+        if not cmds:
+            return
+        self._batch = []
+        # The batch gets the time of its slow commands on top of the default
+        timeout = self.timeout + sum(COMMAND_TIMEOUTS.get(cmd.split(' ')[0], 0) for cmd, value in cmds)
+        self._request('batch', timeout, cmds=cmds)
+
+    def stats(self):
+        """Returns the command counters and latencies of the instrument, see ``Metrics.snapshot()``"""
+        return self._request('stats')
+
+    def known_state(self):
+        """Returns the settings known to be in place, as used by ``usmelt.planner``"""
+        state = self._request('known_state')
+        return {'channel': state['channel'], 1: state['1'], 2: state['2'], 'global': state['global']}
+
+    def check_errors(self):
+        """Raise any error which the error checking strategy of the broker has not yet reported"""
+        self._request('check_errors')
+
+    @_locked
+    def query(self, cmd, timeout=None):
+        """Send the query cmd and return the response
+
+        timeout replaces the default time allowed for the request, in seconds.
+        """
+        if self._batch:
+            self._flush_batch()
+        if timeout is None:
+            timeout = self.command_timeout(cmd)
+        return self._request('query', timeout, cmd=cmd)
+
+    @_locked
+    def query_many(self, cmds, timeout=None):
+        """Send several queries back-to-back and return their responses in order"""
+        cmds = list(cmds)
+        if not cmds:
+            return []
+        if self._batch:
+            self._flush_batch()
+        if timeout is None:
+            timeout = max(self.command_timeout(cmd) for cmd in cmds)
+        return self._request('query_many', timeout, cmds=cmds)
+
+    @_locked
+    def set(self, cmd, value=None, timeout=None):
+        """Send the set command cmd with the given value, if any
+
+        timeout replaces the default time allowed for the request, in seconds.
+        """
+        if self._batch is not None:
+            self._batch.append([cmd, value])
+            return None
+        if timeout is None:
+            timeout = self.command_timeout(cmd)
+        return self._request('set', timeout, cmd=cmd, value=value)
+
+    def command_timeout(self, cmd):
+        """The time allowed by default for cmd, in seconds, on top of the wait for other clients"""
+        return self.timeout + COMMAND_TIMEOUTS.get(cmd.split(' ')[0], 0)
+
+    def _request(self, op, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+        user_end = self._user_deadline.get()
+        if user_end is not None:
+            timeout = min(timeout, user_end - time.monotonic())
+        command = kwargs.get('cmd') or op
+        if timeout <= 0:
+            raise InstrumentTimeout(command, 0)
+        future = concurrent.futures.Future()
+        with self._pending_lock:
+            if self._closed is not None:
+                raise self._closed
+            request_id = next(self._ids)
+            self._pending[request_id] = future
+            data = (json.dumps(dict(kwargs, id=request_id, op=op)) + '\n').encode('utf-8')
+            self.metrics.record_write(len(data))
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                del self._pending[request_id]
+                raise
+        # Not future.result(timeout), which can not tell its own timeout from an InstrumentTimeout of the broker
+        if not concurrent.futures.wait([future], timeout).done:
+            # The broker may still run the request. Its late answer is dropped.
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+            raise InstrumentTimeout(command, timeout)
+        return future.result()
+
+    def _read_loop(self):
+        error = ConnectionError("Connection to the broker closed")
+        try:
+            for line in self.sock.makefile('rb'):
+                self.metrics.record_read(len(line))
+                message = json.loads(line)
+                if 'event' in message:
+                    for callback in self._callbacks.get(message['event'], []):
+                        try:
+                            callback(message)
+                        except Exception as e:
+                            pg_logger.warning("Callback for %s failed: %s" % (message['event'], e))
+                    continue
+                with self._pending_lock:
+                    future = self._pending.pop(message.get('id'), None)
+                if future is None:
+                    continue
+                if 'error' in message:
+                    future.set_exception(_decode_error(message['error']))
+                else:
+                    future.set_result(message.get('result'))
+        except (OSError, ValueError) as e:
+            error = ConnectionError("Connection to the broker lost: %s" % (e))
+        with self._pending_lock:
+            self._closed = error
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(error)
@@ -0,0 +1,232 @@
+"""
+The settings of the TG5012A, described in one table.
+
+Each entry of ``SETTINGS`` gives the mnemonic of a setting, its unit, the
+keywords or the range of values it accepts and the resolution of the
+instrument. The setting methods of ``TG5012ACommands`` are generated from it,
+the shadow state cache compares values with its resolutions, and the sweeps
+and the emulator check values against its ranges.
+"""
+from .arb import ARB_SLOTS
+
+_ON_OFF = ("ON", "OFF")
+
+
+def format_value(value):
+    """value as sent to the instrument, with floats in at most 12 significant digits"""
+    if isinstance(value, float):
+        return '%.12g' % (value)
+    return str(value)
+
+
+class Setting:
+    """
+    A setting of the instrument and the method which sets it.
+
+    Parameters
+    ----------
+    name: str
+        Name of the method of ``TG5012ACommands`` which sets it.
+    mnemonic: str
+        The command which sets it.
+    default:
+        Default value of the method argument.
+    doc: str
+        Docstring of the method.
+    choices: tuple of str
+        The keywords accepted, for settings which take a keyword.
+    limits: (float, float)
+        The range of values accepted, for numeric settings. Levels are those
+        into an open circuit, the widest the instrument allows.
+    keywords: tuple of str
+        Keywords which numeric settings accept as well.
+    integer: bool
+        True for numeric settings which only take integers.
+    resolution: float
+        Values closer than this are the same to the instrument.
+    unit: str
+        The unit of numeric settings.
+    scope: str
+        ``'channel'`` for settings of the selected channel, ``'global'`` for
+        those shared by both channels.
+    label: str
+        Name of the setting in error messages. Defaults to name.
+    """
+    def __init__(self, name, mnemonic, default, doc, choices=None, limits=None, keywords=(), integer=False,
+                 resolution=None, unit=None, scope='channel', label=None):
+        if (choices is None) == (limits is None):
+            raise ValueError("Setting %s needs either choices or limits" % (mnemonic))
+        self.name = name
+        self.mnemonic = mnemonic
+        self.default = default
+        self.doc = doc
+        self.choices = choices
+        self.limits = limits
+        self.keywords = keywords
+        self.integer = integer
+        self.resolution = resolution
+        self.unit = unit
+        self.scope = scope
+        self.label = label or name.replace('_', ' ')
+        self.format = self._compile()
+
+    def __repr__(self):
+        return 'Setting(%r, %r)' % (self.name, self.mnemonic)
+
+    def _compile(self):
+        """
+        Builds format(value), which raises a ValueError if the instrument would
+        not accept value and returns it as sent to the instrument otherwise.
+        """
+        if self.choices is not None:
+            choices = frozenset(self.choices)
+            message = "Invalid %s. It should be one of %s" % (self.label, list(self.choices))
+
+            def format(value):
+                if value not in choices:
+                    raise ValueError(message)
+                return value
+            return format
+
+        lo, hi = self.limits
+        keywords = frozenset(self.keywords)
+        integer = self.integer
+        message = "Invalid %s. It should be %s between %s and %s%s" % (
+            self.label, "an integer" if integer else "a number", format_value(lo), format_value(hi),
+            "".join(" or %s" % (k) for k in self.keywords))
+
+        def format(value):
+            if isinstance(value, str):
+                if value in keywords:
+                    return value
+                try:
+                    value = float(value)
+                except ValueError:
+                    raise ValueError(message) from None
+            try:
+                ok = lo <= value <= hi
+            except TypeError:
+                raise ValueError(message) from None
+            if not ok:
+                raise ValueError(message)
+            if integer:
+                if value != int(value):
+                    raise ValueError(message)
+                return '%d' % (value)
+            return format_value(float(value))
+        return format
+
+    def method(self):
+        """The method of ``TG5012ACommands`` which sets it"""
+        mnemonic = self.mnemonic
+        format = self.format
+
+        def method(self, set=self.default):
+            return self.set(mnemonic, format(set))
+        method.__name__ = self.name
+        method.__qualname__ = 'TG5012ACommands.%s' % (self.name)
+        method.__doc__ = self.doc
+        return method
+
+
+_SETTINGS = [
+    # Continuous Carrier Wave Commands
+    Setting("wave", "WAVE", "PULSE", "Sets the output waveform",
+            choices=("SINE", "SQUARE", "TRIANG", "RAMP", "PULSE", "NOISE", "ARB"), label="waveform"),
+    Setting("frequency", "FREQ", 1, "Sets the output frequency in Hz",
+            limits=(1e-6, 50e6), resolution=1e-6, unit="Hz"),
+    Setting("period", "PER", 1, "Sets the output period in seconds",
+            limits=(20e-9, 1e6), resolution=1e-10, unit="s"),
+    Setting("amplitude_range", "AMPLRNG", "AUTO", "Sets the output amplitude range",
+            choices=("AUTO", "HOLD")),
+    Setting("amplitude_unit", "AMPUNIT", "VPP", "Sets the output amplitude unit",
+            choices=("VPP", "VRMS", "DBM")),
+    Setting("amplitude", "AMPL", 1, "Sets the output amplitude, in volts",
+            limits=(0.02, 20), resolution=1e-4, unit="V"),
+    Setting("offset", "DCOFFS", 0, "Sets the DC offset, in volts",
+            limits=(-10, 10), resolution=1e-4, unit="V", label="DC offset"),
+    Setting("high", "HILVL", 1, "Sets the amplitude high level, in volts",
+            limits=(-9.99, 10), resolution=1e-4, unit="V", label="high level"),
+    Setting("low", "LOLVL", 0, "Sets the amplitude low level, in volts",
+            limits=(-10, 9.99), resolution=1e-4, unit="V", label="low level"),
+    Setting("output", "OUTPUT", "ON", "Sets the output on, off, normal or invert",
+            choices=("ON", "OFF", "NORMAL", "INVERT")),
+    Setting("output_load", "ZLOAD", 50, "Sets the output load, in Ohms",
+            limits=(1, 10000), keywords=("OPEN",), unit="Ohm"),
+    Setting("square_symmetry", "SQRSYMM", 50, "Sets the square wave symmetry, in percent",
+            limits=(0, 100), resolution=0.1, unit="%"),
+    Setting("ramp_symmetry", "RMPSYMM", 50, "Sets the ramp wave symmetry, in percent",
+            limits=(0, 100), resolution=0.1, unit="%"),
+    Setting("sync_output", "SYNCOUT", "OFF", "Sets the sync output on or off",
+            choices=_ON_OFF),
+    Setting("sync_type", "SYNCTYPE", "AUTO", "Sets the sync type",
+            choices=("AUTO", "CARRIER", "MODULATION", "SWEEP", "BURST", "TRIGGER")),
+    Setting("phase", "PHASE", 0, "Sets the output phase, in degrees",
+            limits=(-360, 360), resolution=0.1, unit="deg"),
+
+    # Pulse Generator Commands
+    Setting("pulse_frequency", "PULSFREQ", 1, "Sets the pulse frequency, in Hz",
+            limits=(1e-3, 25e6), resolution=1e-6, unit="Hz"),
+    Setting("pulse_period", "PULSPER", 1, "Sets the pulse period, in seconds",
+            limits=(40e-9, 2000), resolution=1e-10, unit="s"),
+    Setting("pulse_width", "PULSWID", 1, "Sets the pulse width, in seconds",
+            limits=(16e-9, 2000), resolution=1e-10, unit="s"),
+    Setting("pulse_symmetry", "PULSSYMM", 50, "Sets the pulse symmetry, in percent",
+            limits=(0, 100), resolution=0.1, unit="%"),
+    Setting("pulse_edge", "PULSEDGE", 0, """Set the pulse waveform edges (positive and negative edge) in seconds.
+        Value zero sets to the minimum value allowed.""",
+            limits=(0, 40e-6), resolution=1e-10, unit="s"),
+    Setting("pulse_range", "PULSRANGE", 1, """Set the pulse rise and fall range to 1, 2 or 3.
+        1 - sets the range from 5ns to 99.9ns
+        2 - sets the range from 100ns to 1.999us
+        3 - sets the range from 2us to 40us""",
+            limits=(1, 3), integer=True),
+    Setting("pulse_rise", "PULSRISE", 10e-9, "Sets the pulse rise time, in seconds",
+            limits=(5e-9, 40e-6), resolution=1e-10, unit="s"),
+    Setting("pulse_fall", "PULSFALL", 10e-9, "Sets the pulse fall time, in seconds",
+            limits=(5e-9, 40e-6), resolution=1e-10, unit="s"),
+    Setting("pulse_delay", "PULSDLY", 0, "Sets the pulse delay, in seconds",
+            limits=(0, 2000), resolution=1e-10, unit="s"),
+
+    # Dual-channel Function Commands
+    Setting("amplitude_coupling", "AMPLCPLNG", "ON", "Sets the amplitude coupling",
+            choices=_ON_OFF, scope='global'),
+    Setting("output_coupling", "OUTPUTCPLNG", "ON", "Sets the output coupling",
+            choices=_ON_OFF, scope='global'),
+    Setting("frequency_coupling", "FRQCPLSWT", "ON", "Sets the frequency coupling",
+            choices=_ON_OFF, scope='global'),
+    Setting("frequency_coupling_type", "FRQCPLTYP", "RATIO", "Sets the frequency coupling type",
+            choices=("RATIO", "OFFSET"), scope='global'),
+    Setting("frequency_coupling_ratio", "FRQCPLRAT", 1, "Sets the frequency coupling ratio",
+            limits=(1e-3, 1e3), scope='global'),
+    Setting("frequency_coupling_offset", "FRQCPLOFS", 0, "Sets the frequency coupling offset in Hz",
+            limits=(-50e6, 50e6), resolution=1e-6, unit="Hz", scope='global'),
+    Setting("pulse_frequency_coupling", "PLSFRQCPLSWT", "ON", "Sets the pulse frequency coupling",
+            choices=_ON_OFF, scope='global'),
+    Setting("pulse_frequency_coupling_type", "PLSFRQCPLTYP", "RATIO", "Sets the pulse frequency coupling type",
+            choices=("RATIO", "OFFSET"), scope='global'),
+    Setting("pulse_frequency_coupling_ratio", "PLSFRQCPLRAT", 1, "Sets the pulse frequency coupling ratio",
+            limits=(1e-3, 1e3), scope='global'),
+    Setting("pulse_frequency_coupling_offset", "PLSFRQCPLOFS", 0, "Sets the pulse frequency coupling offset in Hz",
+            limits=(-25e6, 25e6), resolution=1e-6, unit="Hz", scope='global'),
+    Setting("tracking", "TRACKING", "EQUAL", "Set channel tracking to OFF, EQUAL or INVERT",
+            choices=("OFF", "EQUAL", "INVERT"), scope='global'),
+
+    # Arbitrary Waveform Commands
+    Setting("arb_load", "ARBLOAD", "ARB1",
+            "Plays the arbitrary waveform ARB1 to ARB4, or a built-in one, on the channel",
+            choices=("DC", "SINC", "HAVERSINE", "CARDIAC", "EXPRISE", "LOGRISE", "EXPFALL", "LOGFALL",
+                     "GAUSSIAN", "LORENTZ", "DLORENTZ", "TRIANG") + tuple("ARB%d" % n for n in ARB_SLOTS),
+            label="arbitrary waveform"),
+    Setting("burst", "BST", "OFF", "Set burst to OFF, NCYC, GATED or INFINITE",
+            choices=("OFF", "NCYC", "GATED", "INFINITE")),
+    Setting("burst_count", "BSTCOUNT", 1, "Set burst count",
+            limits=(1, 1048575), integer=True),
+    Setting("trigger_src", "TRGSRC", "MAN", "Set trigger source to INT, EXT, CRC or MAN",
+            choices=("INT", "EXT", "CRC", "MAN"), label="source"),
+    Setting("trigger_period", "TRGPER", 1e-3, "Set the period of the internal trigger generator, in seconds",
+            limits=(1e-6, 500), resolution=1e-10, unit="s"),
+]
+
+# The settings by mnemonic, in the order of the manual
+SETTINGS = {s.mnemonic: s for s in _SETTINGS}
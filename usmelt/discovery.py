@@ -1,14 +1,22 @@
+import serial
 import serial.tools.list_ports as list_ports
+import concurrent.futures
 import configparser
 import logging
 
+# Text expected in the *IDN? response of each device
+SIGNATURES = {
+    'TG5012A': 'TG5012A',
+}
 
 
-def discover(devices = ['TG5012A'], config_file = 'usmelt.ini', save_config = True, load_config = True):
+
+def discover(devices = ['TG5012A'], config_file = 'usmelt.ini', save_config = True, load_config = True,
+             auto = True, signatures = None, timeout = 0.2):
     """
     Find the addresses of the specified devices by either 
-    loading them from a configuration file or by 
-    manually unplugging and plugging in the device.
+    loading them from a configuration file, by probing all the serial ports
+    or by manually unplugging and plugging in the device.
     
     Parameters
     ----------
@@ -25,6 +33,16 @@ def discover(devices = ['TG5012A'], config_file = 'usmelt.ini', save_config = Tr
     load_config: bool
         If True, load the addresses of the devices from the configuration file instead of searching for them again.
 
+    auto: bool
+        If True, look for the devices not in the configuration file with ``probe_ports()``
+        before falling back to the manual search.
+
+    signatures: dict
+        Text expected in the ``*IDN?`` response of each device, see ``probe_ports()``.
+
+    timeout: float
+        Time in seconds each port has to answer when probing.
+
     Returns
     -------
     dict
@@ -47,16 +65,93 @@ def discover(devices = ['TG5012A'], config_file = 'usmelt.ini', save_config = Tr
             if found_all:
                 return ret
         
-    print('Performing manual USB address search.')
     if ret is None:
         ret = {}
-    for d in devices:
-        if d not in ret or ret[d] is None:
-            ret[d] = discover_device(d)
+    missing = [d for d in devices if d not in ret or ret[d] is None]
+    if auto and missing:
+        found = probe_ports(missing, signatures, timeout)
+        for d in missing:
+            if found.get(d) is not None:
+                ret[d] = found[d]
+        missing = [d for d in missing if ret.get(d) is None]
+    if missing:
+        print('Performing manual USB address search.')
+    for d in missing:
+        ret[d] = discover_device(d)
     if save_config:
         write_config(ret, config_file)
     return ret
 
+def probe_ports(devices = ['TG5012A'], signatures = None, timeout = 0.2, ports = None):
+    """
+    Find the specified devices by asking every serial port for its ``*IDN?``.
+
+    All the ports are opened and queried concurrently, so the search takes
+    about timeout seconds regardless of the number of ports.
+    Ports which are busy or do not answer are skipped.
+
+    Parameters
+    ----------
+    devices: list of str
+        Names of the devices to search for.
+
+    signatures: dict
+        Maps each device name to the text expected in its ``*IDN?`` response.
+        Defaults to ``SIGNATURES``, and to the device name itself for the devices not in it.
+
+    timeout: float
+        Time in seconds each port has to answer.
+
+    ports: list of ListPortInfo
+        The ports to probe. Defaults to all of the ports from ``list_ports.comports()``.
+
+    Returns
+    -------
+    dict
+        The ``DeviceInfo`` of each device found. Devices not found, or found on
+        more than one port, are left out.
+    """
+    signatures = dict(SIGNATURES, **(signatures or {}))
+    if ports is None:
+        ports = list_ports.comports()
+        check_duplicate_ports(ports)
+    if not ports:
+        return {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(ports)) as pool:
+        answers = list(pool.map(lambda p: identify(p.device, timeout), ports))
+    ret = {}
+    for d in devices:
+        signature = signatures.get(d, d).upper()
+        matches = [p for p, idn in zip(ports, answers) if idn is not None and signature in idn.upper()]
+        if len(matches) == 1:
+            logging.debug('Found %s at %s' % (d, matches[0].device))
+            ret[d] = DeviceInfo(matches[0].device, matches[0].hwid)
+        elif len(matches) > 1:
+            logging.warning('Found %s on several ports:\n%s' % (d, format_devices_found(matches)))
+    return ret
+
+def identify(device, timeout = 0.2):
+    """
+    Returns the ``*IDN?`` response of the instrument on the serial port device,
+    or None if the port cannot be opened or does not answer within timeout seconds.
+    """
+    try:
+        ser = serial.Serial(port=device, timeout=timeout, write_timeout=timeout)
+    except (serial.SerialException, OSError, ValueError) as e:
+        logging.debug('Could not open %s: %s' % (device, e))
+        return None
+    try:
+        ser.reset_input_buffer()
+        ser.write(b'*IDN?\n')
+        ret = ser.readline().decode('ascii', 'replace').strip()
+    except (serial.SerialException, OSError) as e:
+        logging.debug('Could not query %s: %s' % (device, e))
+        return None
+    finally:
+        ser.close()
+    logging.debug('%s answered %s' % (device, ret))
+    return ret or None
+
 def discover_device(name):
     print('Searching for %s' % (name))
     input('    Unplug the USB/Serial cable connected to %s. Press Enter when unplugged...' %(name))
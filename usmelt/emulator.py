@@ -0,0 +1,433 @@
+"""
+Software stand-in for the TG5012A function generator.
+
+The emulator understands the commands used by ``usmelt.TG5012A``, keeps the
+state of both channels and the error registers, and can be reached through a
+Linux pseudo-terminal (for ``serial_port=``) or a localhost TCP port
+(for ``address=``/``port=``)::
+
+    emu = TG5012AEmulator(latency=1e-3, baudrate=9600)
+    pg = usmelt.TG5012A(serial_port=emu.serve_pty())
+    pg2 = usmelt.TG5012A(address='127.0.0.1', port=emu.serve_tcp())
+
+It is meant for testing and performance work on the driver, not as a
+faithful model of the instrument. Error codes in particular are made up.
+"""
+import copy
+import os
+import re
+import select
+import socket
+import socketserver
+import struct
+import threading
+import time
+from .commands import SETTINGS
+from .arb import ARB_SLOTS, ARB_MIN_POINTS, ARB_MAX_POINTS
+from .error_check import ESR_QUERY_ERROR, ESR_EXECUTION_ERROR, ESR_COMMAND_ERROR
+
+# Error codes reported in the Execution Error Register
+ERR_COMMAND = 102
+ERR_OUT_OF_RANGE = 111
+ERR_CONFLICT = 112
+
+_ON_OFF = ("ON", "OFF")
+
+# Allowed values of the per channel settings, either a tuple of keywords or a numeric range
+CHANNEL_SETTINGS = {m: s.choices or s.limits for m, s in SETTINGS.items() if s.scope == 'channel'}
+
+# The number of points the arbitrary waveform memories can hold
+ARB_POINTS = (ARB_MIN_POINTS, ARB_MAX_POINTS)
+
+# The start of a command carrying a binary block, up to the number of length digits
+_BLOCK = re.compile(rb'\s*ARB([%s])\s+#([1-9])' % ''.join(str(n) for n in ARB_SLOTS).encode('ascii'))
+
+# Allowed values of the settings shared by both channels
+GLOBAL_SETTINGS = {m: s.choices or s.limits for m, s in SETTINGS.items() if s.scope == 'global'}
+
+DEFAULT_CHANNEL = {
+    "WAVE": "SINE", "FREQ": 10e3, "PER": 1e-4, "AMPLRNG": "AUTO", "AMPUNIT": "VPP",
+    "AMPL": 5.0, "DCOFFS": 0.0, "HILVL": 2.5, "LOLVL": -2.5, "OUTPUT": "OFF", "ZLOAD": 50,
+    "SQRSYMM": 50, "RMPSYMM": 50, "SYNCOUT": "OFF", "SYNCTYPE": "AUTO", "PHASE": 0,
+    "PULSFREQ": 1e3, "PULSPER": 1e-3, "PULSWID": 200e-6, "PULSSYMM": 20, "PULSEDGE": 0,
+    "PULSRANGE": 1, "PULSRISE": 10e-9, "PULSFALL": 10e-9, "PULSDLY": 0,
+    "BST": "OFF", "BSTCOUNT": 1, "TRGSRC": "INT", "TRGPER": 1e-3, "ARBLOAD": "SINC",
+}
+
+DEFAULT_GLOBAL = {
+    "AMPLCPLNG": "OFF", "OUTPUTCPLNG": "OFF", "FRQCPLSWT": "OFF", "FRQCPLTYP": "RATIO",
+    "FRQCPLRAT": 1, "FRQCPLOFS": 0, "PLSFRQCPLSWT": "OFF", "PLSFRQCPLTYP": "RATIO",
+    "PLSFRQCPLRAT": 1, "PLSFRQCPLOFS": 0, "TRACKING": "OFF",
+}
+
+
+def _split_message(buffer):
+    """Split the first complete message off buffer, returning it and the rest, or None
+
+    Messages end with a newline, except that binary blocks can contain newlines.
+    """
+    m = _BLOCK.match(buffer)
+    if m:
+        start = m.end() + int(m.group(2))
+        if len(buffer) < start:
+            return None
+        end = start + int(buffer[m.end():start])
+        i = buffer.find(b'\n', end)
+    else:
+        i = buffer.find(b'\n')
+    if i < 0:
+        return None
+    return buffer[:i], buffer[i + 1:]
+
+
+class CommandError(Exception):
+    """Raised internally when a command can not be executed"""
+    def __init__(self, code, esr_bit):
+        self.code = code
+        self.esr_bit = esr_bit
+
+
+class TG5012AEmulator:
+    """
+    Emulates a TG5012A function generator.
+
+    Parameters
+    ----------
+    latency : float or dict
+        Time in seconds the emulator takes to process each command.
+        A dict maps mnemonics to latencies, with the ``None`` key used as default.
+    baudrate : int or None
+        If given, transfers are slowed down to what a serial line at this
+        rate with 10 bits per byte would allow.
+    idn : str
+        The response to ``*IDN?``.
+    """
+    def __init__(self, latency=0.0, baudrate=None, idn="THURLBY THANDAR, TG5012A, 539639, 1.01-1.00-1.00"):
+        self.latency = latency
+        self.baudrate = baudrate
+        self.idn = idn
+        self.lock = threading.Lock()
+        self.stores = {}
+        # Kept through a reset, like the non-volatile memory of the instrument
+        self.arbs = {}
+        self.lines_received = 0
+        self.commands_received = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self._servers = []
+        self._stop = threading.Event()
+        self.reset()
+
+    def reset(self):
+        """Return the instrument to its power-on state"""
+        self.channels = {1: dict(DEFAULT_CHANNEL), 2: dict(DEFAULT_CHANNEL)}
+        self.globals = dict(DEFAULT_GLOBAL)
+        self.channel = 1
+        self.eer = 0
+        self.qer = 0
+        self.esr = 0
+        self.remote = False
+        self.triggers = {1: 0, 2: 0}
+
+    # Instrument side
+
+    def handle_message(self, message):
+        """Process one message in bytes, with a binary block or a line, and return the response line, or None"""
+        m = _BLOCK.match(message)
+        if m is None:
+            return self.handle(message.decode('ascii').strip())
+        start = m.end() + int(m.group(2))
+        with self.lock:
+            self.lines_received += 1
+            self.commands_received += 1
+            self.bytes_received += len(message) + 1
+            self._wait_transfer(len(message) + 1)
+            self.remote = True
+            slot = self.arbs.get(int(m.group(1)))
+            data = message[start:start + int(message[m.end():start])]
+            if slot is None or len(data) != 2 * slot['points']:
+                self.eer = ERR_CONFLICT
+                self.esr |= ESR_EXECUTION_ERROR
+                return None
+            slot['data'] = list(struct.unpack('>%dh' % (slot['points']), data))
+        return None
+
+    def handle(self, line):
+        """Process one line received from the host and return the response line, or None"""
+        with self.lock:
+            self.lines_received += 1
+            self.bytes_received += len(line) + 1
+            self._wait_transfer(len(line) + 1)
+            responses = []
+            for cmd in line.split(';'):
+                cmd = cmd.strip()
+                if not cmd:
+                    continue
+                self.commands_received += 1
+                self._wait_latency(cmd)
+                try:
+                    ret = self.execute(cmd)
+                except CommandError as e:
+                    if e.esr_bit == ESR_QUERY_ERROR:
+                        self.qer = e.code
+                    else:
+                        self.eer = e.code
+                    self.esr |= e.esr_bit
+                    continue
+                if ret is not None:
+                    responses.append(ret)
+            if not responses:
+                return None
+            ret = ';'.join(responses)
+            self.bytes_sent += len(ret) + 1
+            self._wait_transfer(len(ret) + 1)
+            return ret
+
+    def execute(self, cmd):
+        """Execute a single command, returning the response of queries"""
+        if cmd != "LOCAL":
+            self.remote = True
+        parts = cmd.split(None, 1)
+        mnemonic = parts[0].upper()
+        arg = parts[1].strip() if len(parts) > 1 else None
+        if mnemonic.endswith('?'):
+            return self._query(mnemonic[:-1], arg)
+        if mnemonic == "CHN":
+            value = self._parse_number(arg, (1, 2))
+            self.channel = int(value)
+        elif mnemonic in CHANNEL_SETTINGS:
+            self._set_channel(self.channel, mnemonic, self._parse(mnemonic, arg, CHANNEL_SETTINGS[mnemonic]))
+        elif mnemonic in GLOBAL_SETTINGS:
+            self.globals[mnemonic] = self._parse(mnemonic, arg, GLOBAL_SETTINGS[mnemonic])
+        elif re.fullmatch(r'ARB[1-4]DEF', mnemonic):
+            fields = (arg or '').split(',')
+            if len(fields) != 3 or fields[1].strip().upper() not in _ON_OFF:
+                raise CommandError(ERR_COMMAND, ESR_COMMAND_ERROR)
+            points = int(self._parse_number(fields[2], ARB_POINTS))
+            self.arbs[int(mnemonic[3])] = {'name': fields[0].strip(), 'interpolation': fields[1].strip().upper(),
+                                           'points': points, 'data': [0] * points}
+        elif mnemonic == "*TRG":
+            self.triggers[self.channel] += 1
+            if self.channels[3 - self.channel]["TRGSRC"] == "CRC":
+                self.triggers[3 - self.channel] += 1
+        elif mnemonic == "*RST":
+            self.reset()
+            self.remote = True
+        elif mnemonic == "*SAV":
+            self.stores[int(self._parse_number(arg, (0, 9)))] = copy.deepcopy((self.channels, self.globals))
+        elif mnemonic == "*RCL":
+            store = int(self._parse_number(arg, (0, 9)))
+            if store not in self.stores:
+                raise CommandError(ERR_CONFLICT, ESR_EXECUTION_ERROR)
+            self.channels, self.globals = copy.deepcopy(self.stores[store])
+        elif mnemonic == "*CLS":
+            self.eer = 0
+            self.qer = 0
+            self.esr = 0
+        elif mnemonic == "LOCAL":
+            self.remote = False
+        elif mnemonic in ("BEEP", "ALIGN", "*WAI"):
+            pass
+        else:
+            raise CommandError(ERR_COMMAND, ESR_COMMAND_ERROR)
+        return None
+
+    def _query(self, mnemonic, arg):
+        if mnemonic == "*IDN":
+            return self.idn
+        if mnemonic == "EER":
+            ret, self.eer = self.eer, 0
+            return str(ret)
+        if mnemonic == "QER":
+            ret, self.qer = self.qer, 0
+            return str(ret)
+        if mnemonic == "*ESR":
+            ret, self.esr = self.esr, 0
+            return str(ret)
+        if mnemonic == "*STB":
+            return str(0x20 if self.esr else 0)
+        if mnemonic == "*OPC":
+            return "1"
+        if mnemonic == "CHN":
+            return str(self.channel)
+        if mnemonic in CHANNEL_SETTINGS:
+            return self._format(self.channels[self.channel][mnemonic])
+        if mnemonic in GLOBAL_SETTINGS:
+            return self._format(self.globals[mnemonic])
+        raise CommandError(ERR_COMMAND, ESR_COMMAND_ERROR)
+
+    def _set_channel(self, channel, mnemonic, value):
+        state = self.channels[channel]
+        new = dict(state)
+        new[mnemonic] = value
+        # Keep the settings which depend on each other consistent
+        if mnemonic in ("HILVL", "LOLVL"):
+            new["AMPL"] = new["HILVL"] - new["LOLVL"]
+            new["DCOFFS"] = (new["HILVL"] + new["LOLVL"]) / 2
+        elif mnemonic in ("AMPL", "DCOFFS"):
+            new["HILVL"] = new["DCOFFS"] + new["AMPL"] / 2
+            new["LOLVL"] = new["DCOFFS"] - new["AMPL"] / 2
+        elif mnemonic in ("FREQ", "PER", "PULSFREQ", "PULSPER"):
+            if mnemonic == "FREQ":
+                new["PER"] = 1 / value
+            elif mnemonic == "PER":
+                new["FREQ"] = 1 / value
+            elif mnemonic == "PULSFREQ":
+                new["PULSPER"] = 1 / value
+            else:
+                new["PULSFREQ"] = 1 / value
+        if new["HILVL"] <= new["LOLVL"]:
+            raise CommandError(ERR_CONFLICT, ESR_EXECUTION_ERROR)
+        if new["PULSWID"] + new["PULSDLY"] > new["PULSPER"] and mnemonic in ("PULSWID", "PULSPER", "PULSFREQ", "PULSDLY"):
+            raise CommandError(ERR_CONFLICT, ESR_EXECUTION_ERROR)
+        state.update(new)
+        if self.globals["TRACKING"] != "OFF":
+            # With tracking on the instrument keeps the channels identical. Which
+            # settings it copies is not documented, so the trigger source and
+            # burst settings are copied too, the worst case for the driver.
+            # usmelt.planner only plans tracking for channels already identical.
+            self.channels[3 - channel].update(new)
+
+    def _parse(self, mnemonic, arg, allowed):
+        if arg is None:
+            raise CommandError(ERR_COMMAND, ESR_COMMAND_ERROR)
+        if isinstance(allowed[0], str):
+            if arg.upper() not in allowed:
+                raise CommandError(ERR_OUT_OF_RANGE, ESR_EXECUTION_ERROR)
+            return arg.upper()
+        if arg.upper() in SETTINGS[mnemonic].keywords:
+            return arg.upper()
+        return self._parse_number(arg, allowed)
+
+    def _parse_number(self, arg, limits):
+        try:
+            value = float(arg)
+        except (TypeError, ValueError):
+            raise CommandError(ERR_COMMAND, ESR_COMMAND_ERROR)
+        if value < limits[0] or value > limits[1]:
+            raise CommandError(ERR_OUT_OF_RANGE, ESR_EXECUTION_ERROR)
+        return value
+
+    def _format(self, value):
+        if isinstance(value, str):
+            return value
+        return '%.10g' % (value)
+
+    def _wait_latency(self, cmd):
+        latency = self.latency
+        if isinstance(latency, dict):
+            mnemonic = cmd.split(None, 1)[0].upper()
+            latency = latency.get(mnemonic, latency.get(None, 0.0))
+        if latency > 0:
+            time.sleep(latency)
+
+    def _wait_transfer(self, nbytes):
+        if self.baudrate:
+            time.sleep(nbytes * 10.0 / self.baudrate)
+
+    def front_panel(self, mnemonic, value, channel=None):
+        """Change a setting as an operator would on the front panel.
+
+        Only possible while the instrument is in local mode.
+        """
+        with self.lock:
+            if self.remote:
+                raise RuntimeError("Front panel is locked while in remote mode")
+            if mnemonic in GLOBAL_SETTINGS:
+                self.globals[mnemonic] = value
+            else:
+                self._set_channel(channel or self.channel, mnemonic, value)
+
+    # Transports
+
+    def serve_tcp(self, host='127.0.0.1', port=0):
+        """Serve the emulator on a TCP port, like the LAN interface on port 9221.
+
+        Returns the port number, which is chosen by the OS when port is 0.
+        """
+        emulator = self
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                buffer = b''
+                while True:
+                    data = self.rfile.read1(65536)
+                    if not data:
+                        break
+                    buffer += data
+                    while True:
+                        split = _split_message(buffer)
+                        if split is None:
+                            break
+                        message, buffer = split
+                        ret = emulator.handle_message(message)
+                        if ret is not None:
+                            self.wfile.write(ret.encode('ascii') + b'\n')
+        server = socketserver.ThreadingTCPServer((host, port), Handler, bind_and_activate=False)
+        server.daemon_threads = True
+        server.allow_reuse_address = True
+        server.server_bind()
+        server.server_activate()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self._servers.append(server)
+        return server.server_address[1]
+
+    def serve_pty(self):
+        """Serve the emulator on a Linux pseudo-terminal.
+
+        Returns the device name of the terminal, e.g. ``/dev/pts/3``, to pass to ``TG5012A(serial_port=...)``.
+        """
+        import tty
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        name = os.ttyname(slave)
+        thread = threading.Thread(target=self._serve_fd, args=(master, slave), daemon=True)
+        thread.start()
+        return name
+
+    def _serve_fd(self, master, slave):
+        buffer = b''
+        try:
+            while not self._stop.is_set():
+                readable, _, _ = select.select([master], [], [], 0.1)
+                if not readable:
+                    continue
+                try:
+                    data = os.read(master, 4096)
+                except OSError:
+                    break
+                buffer += data
+                while True:
+                    split = _split_message(buffer)
+                    if split is None:
+                        break
+                    message, buffer = split
+                    ret = self.handle_message(message)
+                    if ret is not None:
+                        os.write(master, ret.encode('ascii') + b'\n')
+        finally:
+            os.close(master)
+            os.close(slave)
+
+    def close(self):
+        """Stop serving"""
+        self._stop.set()
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        self._servers = []
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Serve a TG5012A emulator.')
+    parser.add_argument('--port', type=int, default=9221, help='TCP port to serve on')
+    parser.add_argument('--latency', type=float, default=0.0, help='processing time per command, in seconds')
+    parser.add_argument('--baudrate', type=int, default=None, help='serial line rate to emulate')
+    args = parser.parse_args()
+    emu = TG5012AEmulator(latency=args.latency, baudrate=args.baudrate)
+    print('Serving on 127.0.0.1:%d and %s' % (emu.serve_tcp(port=args.port), emu.serve_pty()))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        emu.close()
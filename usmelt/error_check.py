@@ -0,0 +1,225 @@
+"""
+Strategies used by ``TG5012A`` to check the instrument for errors.
+
+The instrument reports errors through the Execution Error Register (``EER?``),
+the Query Error Register (``QER?``) and the Standard Event Status Register (``*ESR?``).
+Reading them costs a round trip, so the strategies trade how soon an error
+is detected against how many of those round trips are made.
+"""
+
+# Bits of the Standard Event Status Register
+ESR_QUERY_ERROR = 0x04
+ESR_DEVICE_ERROR = 0x08
+ESR_EXECUTION_ERROR = 0x10
+ESR_COMMAND_ERROR = 0x20
+
+
+class InstrumentError(ValueError):
+    """Raised when the instrument reports an error.
+
+    Attributes
+    ----------
+    kind : str
+        Either ``'execution'`` or ``'query'``.
+    error : int
+        Error code returned by the instrument.
+    commands : list of str
+        The commands which could have caused the error, oldest first.
+    """
+    def __init__(self, kind, error, commands, msg=None):
+        self.kind = kind
+        self.error = error
+        self.commands = list(commands)
+        if msg is None:
+            msg = "Instrument returned %s error %d" % (kind, error)
+            if len(self.commands) == 1:
+                msg += " for %s" % (self.commands[0])
+            elif len(self.commands) > 1:
+                msg += " for one of the commands from %s to %s" % (self.commands[0], self.commands[-1])
+        super().__init__(msg)
+
+
+class InstrumentTimeout(TimeoutError):
+    """Raised when the instrument does not answer a command in time.
+
+    Attributes
+    ----------
+    command : str
+        The command which timed out.
+    timeout : float
+        The time allowed for it, in seconds.
+    """
+    def __init__(self, command, timeout):
+        self.command = command
+        self.timeout = timeout
+        super().__init__("No response from the instrument to %s within %g s" % (command, timeout))
+
+
+class BatchError(InstrumentError):
+    """Raised when a command sent as part of a batch fails on the instrument.
+
+    Attributes
+    ----------
+    command : str
+        The queued command that caused the error.
+    index : int
+        Position of the command in the batch.
+    error : int
+        Error code returned by the instrument.
+    """
+    def __init__(self, command, index, error):
+        self.command = command
+        self.index = index
+        super().__init__('execution', error, [command],
+                         "Instrument returned execution error %d for batched command %d (%s)" % (error, index, command))
+
+
+class ErrorCheck:
+    """
+    Base class for the error checking strategies.
+
+    ``TG5012A`` calls ``after_set`` and ``after_query`` after each command
+    and ``flush`` whenever all pending errors should be reported.
+    Batches are formatted with ``format_batch`` and checked with ``after_batch``,
+    and pipelined queries are checked with ``after_queries``.
+    """
+    def after_set(self, pg, cmd):
+        pass
+
+    def after_query(self, pg, cmd):
+        pass
+
+    def flush(self, pg):
+        pass
+
+    def format_batch(self, cmds):
+        return ';'.join(cmds)
+
+    def after_batch(self, pg, cmds):
+        for cmd in cmds:
+            self.after_set(pg, cmd)
+
+    def after_queries(self, pg, cmds):
+        for cmd in cmds:
+            self.after_query(pg, cmd)
+
+
+class EveryCommand(ErrorCheck):
+    """Read ``EER?`` after every set and ``QER?`` after every query.
+
+    Errors are always attributed to a single command, at the cost of one
+    extra round trip per command.
+    """
+    def after_set(self, pg, cmd):
+        err = int(pg.execution_error())
+        if err != 0:
+            raise InstrumentError('execution', err, [cmd])
+
+    def after_query(self, pg, cmd):
+        err = int(pg.query_error())
+        if err != 0:
+            raise InstrumentError('query', err, [cmd])
+
+    def after_queries(self, pg, cmds):
+        # A single check for pipelined queries, attributed to all of them
+        err = int(pg.query_error())
+        if err != 0:
+            raise InstrumentError('query', err, cmds)
+
+    def format_batch(self, cmds):
+        # Interleaving EER? attributes errors to individual commands
+        # while still costing a single round trip.
+        return ';'.join(cmd + ';EER?' for cmd in cmds)
+
+    def after_batch(self, pg, cmds):
+        self.check_batch(cmds, pg._read_responses(len(cmds)))
+
+    def check_batch(self, cmds, errs):
+        """Raise a ``BatchError`` for the first of cmds whose ``EER?`` response in errs is not 0"""
+        for i, (cmd, err) in enumerate(zip(cmds, errs)):
+            if int(err) != 0:
+                raise BatchError(cmd, i, int(err))
+
+
+class Deferred(ErrorCheck):
+    """Read ``EER?`` and ``QER?`` only every ``every`` commands and at flush points.
+
+    An error is reported with the range of commands sent since the previous check.
+    Batches and ``TG5012A.check_errors()`` are flush points.
+    """
+    def __init__(self, every=10):
+        self.every = every
+        self.pending = []
+
+    def after_set(self, pg, cmd):
+        self.pending.append((cmd, False))
+        if len(self.pending) >= self.every:
+            self.flush(pg)
+
+    def after_query(self, pg, cmd):
+        self.pending.append((cmd, True))
+        if len(self.pending) >= self.every:
+            self.flush(pg)
+
+    def after_batch(self, pg, cmds):
+        self.pending += [(cmd, False) for cmd in cmds]
+        self.flush(pg)
+
+    def flush(self, pg):
+        pending = self.pending
+        self.pending = []
+        sets = [cmd for cmd, is_query in pending if not is_query]
+        queries = [cmd for cmd, is_query in pending if is_query]
+        if sets:
+            err = int(pg.execution_error())
+            if err != 0:
+                raise InstrumentError('execution', err, sets)
+        if queries:
+            err = int(pg.query_error())
+            if err != 0:
+                raise InstrumentError('query', err, queries)
+
+
+class StatusByte(Deferred):
+    """Poll ``*ESR?`` and only read ``EER?`` or ``QER?`` when it flags an error.
+
+    One status read covers both execution and query errors of all the commands
+    since the previous check, which is done every ``every`` commands and at flush points.
+    """
+    def __init__(self, every=1):
+        super().__init__(every)
+
+    def format_batch(self, cmds):
+        # Read the status register in the same round trip as the batch
+        return ';'.join(cmds) + ';*ESR?'
+
+    def after_batch(self, pg, cmds):
+        self.pending += [(cmd, False) for cmd in cmds]
+        esr = int(pg._read_responses(1)[0])
+        self._check(pg, esr)
+
+    def flush(self, pg):
+        if not self.pending:
+            return
+        self._check(pg, int(pg.event_status()))
+
+    def _check(self, pg, esr):
+        pending = self.pending
+        self.pending = []
+        if esr & (ESR_EXECUTION_ERROR | ESR_COMMAND_ERROR | ESR_DEVICE_ERROR):
+            sets = [cmd for cmd, is_query in pending if not is_query]
+            raise InstrumentError('execution', int(pg.execution_error()), sets or [cmd for cmd, _ in pending])
+        if esr & ESR_QUERY_ERROR:
+            queries = [cmd for cmd, is_query in pending if is_query]
+            raise InstrumentError('query', int(pg.query_error()), queries or [cmd for cmd, _ in pending])
+
+
+def make_error_check(error_check):
+    """Converts the error_check argument of ``TG5012A`` to an ``ErrorCheck`` or None"""
+    if error_check is True:
+        return EveryCommand()
+    if error_check is False or error_check is None:
+        return None
+    if isinstance(error_check, ErrorCheck):
+        return error_check
+    raise ValueError("Invalid error_check. It should be True, False or an ErrorCheck")
@@ -0,0 +1,166 @@
+"""
+Control of several TG5012A generators as one.
+
+    devices = discover(['jet1', 'jet2', 'delay'], signatures={'jet1': 'TG5012A, 539639', ...})
+    group = TG5012AGroup.open(devices, cache=True)
+    group.arm({'jet1': config1, 'jet2': config2, 'delay': config3})
+    group.fire()
+"""
+import concurrent.futures
+import contextlib
+from .tg5012a import TG5012A, pg_logger
+from .planner import apply_config
+
+
+class GroupError(Exception):
+    """Raised when an operation failed on some of the generators of a group.
+
+    The operation still ran on all the others.
+
+    Attributes
+    ----------
+    errors : dict
+        Maps the name of each generator which failed to its exception.
+    results : dict
+        Maps the name of each generator which succeeded to its result.
+    """
+    def __init__(self, errors, results):
+        self.errors = errors
+        self.results = results
+        super().__init__("Failed on %s: %s" % (', '.join(sorted(errors)),
+                                                '; '.join('%s: %s' % (name, e) for name, e in sorted(errors.items()))))
+
+
+class TG5012AGroup:
+    """
+    Runs commands on several TG5012A generators at once.
+
+    Each operation runs on all the generators concurrently, one thread each,
+    so configuring N generators takes about as long as configuring one.
+    Operations return a dict with the result of each generator. If some of
+    them fail the others still complete, and a ``GroupError`` with the errors
+    and the results is raised at the end.
+
+    ``fire()`` triggers generators armed with ``arm()``. It takes the locks of
+    all of them first and then writes the triggers back to back, so the skew
+    between the units is about the time of one write per unit. For skews
+    below a microsecond chain the trigger outputs to the trigger inputs instead.
+
+    Parameters
+    ----------
+    units: dict
+        Maps a name to each ``TG5012A``.
+    """
+    def __init__(self, units):
+        self.units = dict(units)
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(self.units)))
+
+    @classmethod
+    def open(cls, devices, **kwargs):
+        """
+        Connects to the generators on the serial ports of devices, as returned by ``discover()``,
+        passing kwargs to ``TG5012A``.
+
+        If some fail to connect, a ``GroupError`` is raised whose results are
+        the ones which did connect, so that a group of those can still be made.
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(devices))) as pool:
+            futures = {name: pool.submit(TG5012A, serial_port=getattr(d, 'device', d), **kwargs)
+                       for name, d in devices.items()}
+        return cls(cls._collect(futures))
+
+    @staticmethod
+    def _collect(futures):
+        results = {}
+        errors = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                pg_logger.warning("TG5012A %s failed: %s" % (name, e))
+                errors[name] = e
+        if errors:
+            raise GroupError(errors, results)
+        return results
+
+    def __len__(self):
+        return len(self.units)
+
+    def __getitem__(self, name):
+        return self.units[name]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Close all the generators"""
+        try:
+            self.map(lambda pg: pg.close())
+        finally:
+            self._pool.shutdown()
+
+    def map(self, fn, *args):
+        """Calls fn(pg, *args) for each generator pg, concurrently, and returns the results by name"""
+        futures = {name: self._pool.submit(fn, pg, *args) for name, pg in self.units.items()}
+        return self._collect(futures)
+
+    def _each(self, fn, values):
+        """Calls fn(pg, value) for each generator with its value from values, a dict by name"""
+        futures = {name: self._pool.submit(fn, self.units[name], value) for name, value in values.items()}
+        return self._collect(futures)
+
+    def _by_name(self, values):
+        """values by generator name. A dict without the names of the generators is used for all of them."""
+        if isinstance(values, dict) and set(values) <= set(self.units) and values:
+            return values
+        return {name: values for name in self.units}
+
+    def apply(self, configs, end_channel=None):
+        """Applies configs with ``apply_config()``, one per generator by name or the same for all"""
+        return self._each(lambda pg, config: apply_config(pg, config, end_channel), self._by_name(configs))
+
+    def arm(self, configs=None, channel=1):
+        """Arms the generators with ``TG5012A.arm()``, with configs by name or the same for all"""
+        return self._each(lambda pg, config: pg.arm(config, channel), self._by_name(configs))
+
+    def disarm(self):
+        """Disarms all the generators"""
+        return self.map(lambda pg: pg.disarm())
+
+    def check_errors(self):
+        """Raises the errors of any of the generators"""
+        return self.map(lambda pg: pg.check_errors())
+
+    def fire(self):
+        """
+        Triggers all the armed generators, as close together as possible.
+
+        Returns the ``time.monotonic()`` each one was triggered at, by name.
+        """
+        results = {}
+        errors = {}
+        seconds = {}
+        with contextlib.ExitStack() as stack:
+            # Nothing else gets between the writes
+            for pg in self.units.values():
+                stack.enter_context(pg._lock)
+            for name, pg in self.units.items():
+                try:
+                    seconds[name] = pg._fire()
+                    results[name] = pg.last_fire
+                except Exception as e:
+                    errors[name] = e
+        for name, s in seconds.items():
+            self.units[name]._fired(s)
+        if errors:
+            for name, e in errors.items():
+                pg_logger.warning("TG5012A %s failed to fire: %s" % (name, e))
+            raise GroupError(errors, results)
+        return results
+
+    def skew(self, times):
+        """The time between the first and the last trigger of the times returned by fire(), in seconds"""
+        return max(times.values()) - min(times.values()) if times else 0.0
@@ -0,0 +1,134 @@
+"""
+A binary journal of the messages exchanged with the instrument.
+
+    pg = TG5012A(serial_port='/dev/ttyACM0', journal='session.usj')
+    ...
+    pg.close()
+
+records every message with its timing. ``usmelt.replay`` plays journals back.
+
+The file starts with a header of ``JOURNAL_MAGIC``, the format version and
+the wall clock and monotonic times the journal was opened at, in nanoseconds.
+Each message follows as a ``_RECORD`` struct, with the times it was sent
+and its last response read, in nanoseconds from the opening of the journal
+(-1 when nothing was read), the channel selected when it was sent (0 when
+not known), and the lengths of the bytes sent and received, followed by those
+bytes.
+"""
+import collections
+import re
+import struct
+import time
+
+JOURNAL_MAGIC = b'USMJ'
+JOURNAL_VERSION = 1
+_HEADER = struct.Struct('<4sHqq')
+_RECORD = struct.Struct('<qqBII')
+
+_CHN = re.compile(rb'(?:^|;)\s*CHN\s+([12])\b', re.IGNORECASE)
+
+# A message of a journal. Times are in seconds from the opening of the journal,
+# with received None for messages without a response.
+Entry = collections.namedtuple('Entry', 'sent received data response channel')
+
+
+class Journal:
+    """
+    Records the messages exchanged with the instrument to path.
+
+    ``TG5012A`` calls ``sent()`` with the bytes of every write and
+    ``received()`` with every line read. Responses are attached to the
+    message written before them, which is saved once the next one is sent, so
+    the cost to each command is packing a struct into a buffered file.
+
+    Parameters
+    ----------
+    path: str
+        The file to write to. It is overwritten.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = 0
+        self._file = open(path, 'wb', buffering=1 << 16)
+        self._start = time.monotonic_ns()
+        self._file.write(_HEADER.pack(JOURNAL_MAGIC, JOURNAL_VERSION, time.time_ns(), self._start))
+        self._channel = 0
+        self._pending = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def sent(self, data):
+        """Record the bytes data written to the instrument"""
+        now = time.monotonic_ns() - self._start
+        if self._pending is not None:
+            self._save()
+        self._pending = [now, -1, self._channel, data, b'']
+        if b'CHN' in data or b'chn' in data:
+            selected = _CHN.findall(data)
+            if selected:
+                self._channel = int(selected[-1])
+
+    def received(self, data):
+        """Record the line data read from the instrument, with its terminator"""
+        now = time.monotonic_ns() - self._start
+        if self._pending is None:
+            # Read without a write first, when draining stale responses
+            self._pending = [now, -1, self._channel, b'', b'']
+        self._pending[1] = now
+        self._pending[4] += data
+
+    def _save(self):
+        sent, received, channel, data, response = self._pending
+        self._file.write(_RECORD.pack(sent, received, channel, len(data), len(response)))
+        self._file.write(data)
+        self._file.write(response)
+        self._pending = None
+        self.entries += 1
+
+    def flush(self):
+        """Write out everything recorded so far"""
+        if self._pending is not None:
+            self._save()
+        self._file.flush()
+
+    def close(self):
+        if self._file.closed:
+            return
+        self.flush()
+        self._file.close()
+
+
+def read_journal(path):
+    """
+    Reads the journal at path.
+
+    Returns a dict with the ``'time'`` the journal was opened, in seconds since
+    the epoch, and the list of its ``'entries'``.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            raise ValueError("%s is not a journal" % (path))
+        magic, version, wall, start = _HEADER.unpack(header)
+        if magic != JOURNAL_MAGIC:
+            raise ValueError("%s is not a journal" % (path))
+        if version != JOURNAL_VERSION:
+            raise ValueError("%s has journal version %d, not %d" % (path, version, JOURNAL_VERSION))
+        entries = []
+        while True:
+            record = f.read(_RECORD.size)
+            if len(record) < _RECORD.size:
+                # A journal which was not closed can end in the middle of a record
+                break
+            sent, received, channel, n_data, n_response = _RECORD.unpack(record)
+            data = f.read(n_data)
+            response = f.read(n_response)
+            if len(response) < n_response or len(data) < n_data:
+                break
+            entries.append(Entry(sent * 1e-9, None if received < 0 else received * 1e-9,
+                                 data, response, channel))
+    return {'time': wall * 1e-9, 'entries': entries}
@@ -0,0 +1,157 @@
+"""
+Logging of the commands sent to the instruments.
+
+Nothing is logged until ``configure_logging()`` is called, apart from warnings,
+which go to the console through the standard ``logging`` fallback::
+
+    import usmelt
+    usmelt.configure_logging('usmelt.log')
+
+Records are handed to a background thread through a queue, so writing the
+log file never delays the commands themselves.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+
+# Attributes which every LogRecord has. Anything else was passed with extra=
+_RECORD_ATTRIBUTES = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime'}
+
+_listener = None
+_handler = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as compact JSON objects, one per line.
+
+    Each object has the time ``t`` in seconds since the epoch, the ``level``,
+    the ``logger`` name and the message ``msg``, followed by the fields given
+    with ``extra=``, such as ``kind`` and ``seconds`` for instrument commands.
+    """
+    def format(self, record):
+        ret = {'t': round(record.created, 6), 'level': record.levelname,
+               'logger': record.name, 'msg': record.getMessage()}
+        for k, v in record.__dict__.items():
+            if k not in _RECORD_ATTRIBUTES and not k.startswith('_'):
+                ret[k] = v
+        if record.exc_info:
+            ret['exc'] = self.formatException(record.exc_info)
+        return json.dumps(ret, separators=(',', ':'), default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Leave all the formatting to the writer thread
+        return record
+
+
+class _Writer(threading.Thread):
+    """Writes the queued records to the handlers every interval seconds.
+
+    Unlike ``logging.handlers.QueueListener`` it does not wake up for each
+    record, which would compete with the instrument I/O for the interpreter.
+    """
+    def __init__(self, queue, handlers, interval):
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.handlers = handlers
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        """Write out the records queued so far"""
+        while True:
+            try:
+                record = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def configure_logging(path='usmelt.log', level=logging.INFO, max_bytes=10000000, backup_count=5,
+                      when=None, console_level=logging.WARNING, loggers=('pg_logger',), interval=0.2):
+    """
+    Log to a rotating JSON Lines file, written by a background thread.
+
+    Calling it again replaces the previous configuration.
+
+    Parameters
+    ----------
+    path: str or None
+        The log file. None logs to the console only.
+    level: int
+        The lowest level written to the file.
+    max_bytes: int
+        Rotate the file once it reaches this size.
+    backup_count: int
+        Number of rotated files kept.
+    when: str or None
+        Rotate at these time intervals instead of by size, e.g. ``'midnight'``
+        or ``'H'``, see ``logging.handlers.TimedRotatingFileHandler``.
+    console_level: int or None
+        The lowest level also printed on the console. None prints nothing.
+    loggers: list of str
+        The loggers to configure.
+    interval: float
+        How often, in seconds, the background thread writes out the queued records.
+    """
+    global _listener, _handler
+    stop_logging()
+    handlers = []
+    if path is not None:
+        if when is not None:
+            file_handler = logging.handlers.TimedRotatingFileHandler(path, when=when, backupCount=backup_count)
+        else:
+            file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+        file_handler.setLevel(level)
+        file_handler.setFormatter(JsonFormatter())
+        handlers.append(file_handler)
+    if console_level is not None:
+        console_handler = logging.StreamHandler()
+        console_handler.setLevel(console_level)
+        console_handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+        handlers.append(console_handler)
+    q = queue.SimpleQueue()
+    _listener = _Writer(q, handlers, interval)
+    _handler = _QueueHandler(q)
+    for name in loggers:
+        logger = logging.getLogger(name)
+        logger.setLevel(min([level] + ([console_level] if console_level is not None else [])))
+        logger.addHandler(_handler)
+        logger.propagate = False
+    _handler.loggers = loggers
+    _listener.start()
+
+
+def stop_logging():
+    """Write out the pending records and undo ``configure_logging()``"""
+    global _listener, _handler
+    if _listener is None:
+        return
+    for name in _handler.loggers:
+        logger = logging.getLogger(name)
+        logger.removeHandler(_handler)
+        logger.propagate = True
+        logger.setLevel(logging.NOTSET)
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = None
+    _handler = None
+
+
+atexit.register(stop_logging)
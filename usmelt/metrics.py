@@ -0,0 +1,159 @@
+"""
+Lightweight instrumentation of the traffic with an instrument.
+
+Counting is done with plain integer and float updates, so it is cheap
+enough to stay enabled all the time.
+"""
+import bisect
+import contextlib
+import threading
+import time
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (1e-5, 3e-5, 1e-4, 3e-4, 1e-3, 3e-3, 1e-2, 3e-2, 0.1, 0.3, 1.0, 3.0, float('inf'))
+
+
+class Histogram:
+    """Latency histogram with fixed buckets"""
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.sum, 'max': self.max,
+                'buckets': dict(zip(self.buckets, self.counts))}
+
+
+class Metrics:
+    """
+    Counters and latency histograms of the commands sent to an instrument.
+
+    Every ``write()`` to the instrument counts as a wire round trip.
+    High-level calls are measured with ``operation()``, which counts the
+    round trips made by the calling thread while it is active::
+
+        with pg.metrics.operation('melt'):
+            ...
+    """
+    def __init__(self):
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        """Zero all the counters"""
+        self.commands = {}
+        self.skipped = {}
+        self.operations = {}
+        self.writes = 0
+        self.reads = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def observe(self, kind, mnemonic, seconds):
+        """Record the latency of a command of the given kind, e.g. ``'set'`` or ``'query'``"""
+        key = (kind, mnemonic)
+        hist = self.commands.get(key)
+        if hist is None:
+            hist = self.commands[key] = Histogram()
+        hist.observe(seconds)
+
+    def skip(self, mnemonic):
+        """Record a command which did not have to be sent"""
+        self.skipped[mnemonic] = self.skipped.get(mnemonic, 0) + 1
+
+    def record_write(self, nbytes):
+        self.writes += 1
+        self.bytes_sent += nbytes
+        for op in getattr(self._local, 'operations', ()):
+            op[0] += 1
+
+    def record_read(self, nbytes):
+        self.reads += 1
+        self.bytes_received += nbytes
+
+    @contextlib.contextmanager
+    def operation(self, name):
+        """Measure the duration and the round trips of a high-level call"""
+        stack = getattr(self._local, 'operations', None)
+        if stack is None:
+            stack = self._local.operations = []
+        op = [0]
+        stack.append(op)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            stack.remove(op)
+            stats = self.operations.get(name)
+            if stats is None:
+                stats = self.operations[name] = {'count': 0, 'round_trips': 0, 'latency': Histogram()}
+            stats['count'] += 1
+            stats['round_trips'] += op[0]
+            stats['latency'].observe(seconds)
+
+    def snapshot(self):
+        """Returns a copy of all the metrics as plain dictionaries"""
+        return {
+            'writes': self.writes,
+            'reads': self.reads,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'commands': {'%s %s' % k: h.snapshot() for k, h in list(self.commands.items())},
+            'skipped': dict(self.skipped),
+            'operations': {name: {'count': s['count'], 'round_trips': s['round_trips'],
+                                  'latency': s['latency'].snapshot()}
+                           for name, s in list(self.operations.items())},
+        }
+
+    def prometheus(self, prefix='usmelt', labels=None):
+        """Returns the metrics in the Prometheus text exposition format"""
+        base = ''.join('%s="%s",' % (k, v) for k, v in (labels or {}).items())
+        lines = []
+        def braces(labels):
+            labels = labels.rstrip(',')
+            return '{%s}' % (labels) if labels else ''
+        def counter(name, value, help, extra=''):
+            lines.append('# HELP %s_%s %s' % (prefix, name, help))
+            lines.append('# TYPE %s_%s counter' % (prefix, name))
+            lines.append('%s_%s%s %s' % (prefix, name, braces(base + extra), value))
+        counter('writes_total', self.writes, 'Writes to the instrument, each one a wire round trip.')
+        counter('reads_total', self.reads, 'Responses read from the instrument.')
+        counter('bytes_sent_total', self.bytes_sent, 'Bytes written to the instrument.')
+        counter('bytes_received_total', self.bytes_received, 'Bytes read from the instrument.')
+
+        def histogram(name, help, items):
+            lines.append('# HELP %s_%s %s' % (prefix, name, help))
+            lines.append('# TYPE %s_%s histogram' % (prefix, name))
+            for extra, hist in items:
+                cumulative = 0
+                for le, count in zip(hist.buckets, hist.counts):
+                    cumulative += count
+                    lines.append('%s_%s_bucket{%s%sle="%s"} %d' % (prefix, name, base, extra,
+                                                                  '+Inf' if le == float('inf') else repr(le), cumulative))
+                lines.append('%s_%s_sum%s %r' % (prefix, name, braces(base + extra), hist.sum))
+                lines.append('%s_%s_count%s %d' % (prefix, name, braces(base + extra), hist.count))
+        histogram('command_seconds', 'Latency of the commands sent to the instrument.',
+                  [('kind="%s",mnemonic="%s",' % k, h) for k, h in sorted(self.commands.items())])
+        histogram('operation_seconds', 'Latency of high-level operations.',
+                  [('operation="%s",' % name, s['latency']) for name, s in sorted(self.operations.items())])
+
+        lines.append('# HELP %s_operation_round_trips_total Wire round trips made by high-level operations.' % (prefix))
+        lines.append('# TYPE %s_operation_round_trips_total counter' % (prefix))
+        for name, s in sorted(self.operations.items()):
+            lines.append('%s_operation_round_trips_total{%soperation="%s"} %d' % (prefix, base, name, s['round_trips']))
+        lines.append('# HELP %s_skipped_commands_total Commands not sent because they would not change anything.' % (prefix))
+        lines.append('# TYPE %s_skipped_commands_total counter' % (prefix))
+        for mnemonic, count in sorted(self.skipped.items()):
+            lines.append('%s_skipped_commands_total{%smnemonic="%s"} %d' % (prefix, base, mnemonic, count))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,231 @@
+"""
+Live state of the instrument, polled in the background.
+
+    monitor = Monitor(pg, interval=0.5)
+    monitor.subscribe(lambda key, old, new: print(key, old, new))
+    ...
+    monitor.stop()
+"""
+import threading
+import time
+from .tg5012a import pg_logger, _same_value
+
+# Output and burst mode of both channels, and the status byte
+DEFAULT_PARAMETERS = [(1, 'OUTPUT'), (2, 'OUTPUT'), (1, 'BST'), (2, 'BST'), ('global', '*STB')]
+
+
+class Monitor:
+    """
+    Polls parameters of a TG5012A and reports the ones which change.
+
+    Parameters are (channel, mnemonic) pairs, with ``'global'`` as the channel
+    of those which do not depend on it, such as ``('global', '*STB')``. All the
+    parameters of all the subscribers are read with a single compound query, so
+    a poll costs one round trip whatever their number. The channel selected on
+    the instrument is restored within the same message when it is known from the
+    shadow state cache. Otherwise it is read with ``CHN?``, and then recorded in
+    the cache when pg has one, or restored with one extra write when it has not.
+
+    Polls only go out in the gaps between the commands of the application. A
+    poll is put off while the lock of pg is held, a batch is being queued or
+    a command was written less than idle seconds ago, so a command of the
+    application waits for a poll at most rarely, and then for a single round
+    trip. When ``auto_local`` has already returned the instrument to local mode
+    the poll ends with ``LOCAL``, so it does not leave the front panel locked,
+    unless pg is armed. Error registers are not read, which leaves any error
+    to the checks of the command that caused it.
+
+    Parameters
+    ----------
+    pg: TG5012A
+        The instrument.
+    parameters: list of (channel, str)
+        The parameters to poll, on top of those of the subscribers.
+    interval: float
+        Time between polls, in seconds.
+    idle: float
+        How long the application must not have sent anything before a poll, in seconds.
+    """
+    def __init__(self, pg, parameters=DEFAULT_PARAMETERS, interval=0.5, idle=0.05):
+        self.pg = pg
+        self.interval = interval
+        self.idle = idle
+        # The last value read of each parameter
+        self.values = {}
+        self.polls = 0
+        self.deferred = 0
+        self._initial = list(parameters)
+        self._parameters = self._initial
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def stop(self):
+        """Stop polling"""
+        self._stopped.set()
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+
+    def subscribe(self, callback, keys=None):
+        """
+        Calls callback(key, old, new) from the monitor thread whenever one of keys changes.
+
+        keys are added to the parameters polled. With keys None the callback
+        gets the changes of all of them. The first value read of each parameter
+        is reported with old None.
+        """
+        keys = None if keys is None else [(ch, m.upper().rstrip('?')) for ch, m in keys]
+        with self._lock:
+            self._subscribers.append((callback, keys))
+            self._update_parameters()
+        return callback
+
+    def unsubscribe(self, callback):
+        """Stop calling callback. Parameters added for it only are no longer polled."""
+        with self._lock:
+            self._subscribers = [(c, k) for c, k in self._subscribers if c is not callback]
+            self._update_parameters()
+
+    def _update_parameters(self):
+        parameters = list(self._initial)
+        for callback, keys in self._subscribers:
+            parameters += [key for key in keys or [] if key not in parameters]
+        self._parameters = parameters
+
+    def get(self, channel, mnemonic):
+        """The last value read of mnemonic on channel, or None"""
+        return self.values.get((channel, mnemonic))
+
+    def _busy(self):
+        pg = self.pg
+        if pg._batch is not None:
+            return True
+        if pg._supervisor is not None and not pg._supervisor.connected:
+            return True
+        return pg._last_write is not None and time.monotonic() - pg._last_write < self.idle
+
+    def _message(self, keys):
+        """
+        The queries of one poll, the keys of their responses, with None for
+        CHN?, and the channel they leave selected.
+        """
+        pg = self.pg
+        wire = pg._wire_channel if pg.cache else None
+        channels = {}
+        for ch, m in keys:
+            if ch != 'global':
+                channels.setdefault(str(ch), []).append(m)
+        cmds = []
+        order = []
+        current = wire
+        if channels and wire is None:
+            cmds.append("CHN?")
+            order.append(None)
+        # End on the selected channel, so that it need not be selected again
+        for ch in sorted(channels, key=lambda ch: ch == wire):
+            if ch != current:
+                cmds.append("CHN %s" % (ch))
+                current = ch
+            for m in channels[ch]:
+                cmds.append(m + "?")
+                order.append((int(ch), m))
+        for ch, m in keys:
+            if ch == 'global':
+                cmds.append(m + "?")
+                order.append((ch, m))
+        return cmds, order, current
+
+    def poll(self):
+        """
+        Reads all the parameters now, if the instrument is idle, and reports the changes.
+
+        Returns the changes as a dict of key and (old, new) value, or None if
+        the poll was put off because the instrument was busy.
+        """
+        keys = self._parameters
+        if not keys:
+            return {}
+        pg = self.pg
+        if not pg._lock.acquire(blocking=False):
+            return None
+        try:
+            if self._busy():
+                return None
+            responses = pg._with_deadline("MONITOR", pg.timeout, False, self._read, keys)
+        finally:
+            pg._lock.release()
+        self.polls += 1
+        changes = {}
+        for key, value in responses.items():
+            old = self.values.get(key)
+            if old is None or not _same_value(key[1], old, value):
+                changes[key] = (old, value)
+                self.values[key] = value
+        if changes:
+            self._notify(changes)
+        return changes
+
+    def _read(self, keys):
+        pg = self.pg
+        start = time.perf_counter()
+        cmds, order, current = self._message(keys)
+        wire = pg._wire_channel if pg.cache else None
+        if wire is not None and current != wire:
+            cmds.append("CHN %s" % (wire))
+        # Back to local mode, where the driver had already left the instrument.
+        # While armed it is kept in remote mode, for fire() to work.
+        local = (pg.auto_local and pg._armed is None
+                 and (pg.local_delay <= 0 or pg._idle_timer is None or not pg._idle_timer.pending()))
+        if local:
+            cmds.append("LOCAL")
+        message = ';'.join(cmds)
+        pg.write(message)
+        ret = pg._read_responses(len(order))
+        responses = dict(zip(order, ret))
+        selected = responses.pop(None, None)
+        if selected is not None and pg.cache:
+            # The cache selects the channel again before the next command which needs it
+            if pg._channel is None:
+                pg._channel = selected
+            pg._wire_channel = current
+        elif selected is not None and selected != current:
+            pg.write("CHN %s;LOCAL" % (selected) if local else "CHN %s" % (selected))
+        seconds = time.perf_counter() - start
+        pg.metrics.observe('query', 'MONITOR', seconds)
+        pg_logger.debug("%s returned %s", message, ';'.join(ret), extra={'kind': 'query', 'seconds': seconds})
+        return responses
+
+    def _notify(self, changes):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for key, (old, new) in changes.items():
+            for callback, keys in subscribers:
+                if keys is not None and key not in keys:
+                    continue
+                try:
+                    callback(key, old, new)
+                except Exception as e:
+                    pg_logger.warning("Monitor callback failed: %s" % (e))
+
+    def run(self):
+        wait = 0
+        while not self._stopped.wait(wait):
+            try:
+                changes = self.poll()
+            except Exception as e:
+                pg_logger.warning("Monitor poll failed: %s" % (e))
+                changes = {}
+            if changes is None:
+                # Try again once the instrument may be idle
+                self.deferred += 1
+                wait = min(self.idle, self.interval)
+            else:
+                wait = self.interval
@@ -0,0 +1,169 @@
+"""
+Plan the commands needed to bring the instrument to a desired configuration.
+
+Configurations use the same format as ``RecipeStore``: a dict mapping the
+channel number to a dict of mnemonic and value pairs, with the settings shared
+by the channels under ``'global'``::
+
+    config = {1: {'OUTPUT': 'ON', 'PULSWID': 20e-6, 'HILVL': 5},
+              2: {'OUTPUT': 'ON', 'PULSWID': 10e-6, 'HILVL': 5}}
+    apply_config(pg, config, end_channel=1)
+    pg.trigger()
+"""
+from .tg5012a import _same_value
+from .commands import SETTINGS
+
+# Coupling switches, the settings needed to make the coupling an exact copy,
+# the settings they couple between the channels, and the sets of those which
+# fully determine the coupled state. Coupling is only used when the configuration
+# gives one of these sets, so that it cannot copy a setting left out of it.
+COUPLINGS = [
+    ("AMPLCPLNG", [], ("AMPL", "DCOFFS", "HILVL", "LOLVL"),
+     [{"AMPL", "DCOFFS"}, {"HILVL", "LOLVL"}]),
+    ("FRQCPLSWT", [("FRQCPLTYP", "RATIO"), ("FRQCPLRAT", 1)], ("FREQ", "PER"),
+     [{"FREQ"}, {"PER"}]),
+    ("PLSFRQCPLSWT", [("PLSFRQCPLTYP", "RATIO"), ("PLSFRQCPLRAT", 1)], ("PULSFREQ", "PULSPER"),
+     [{"PULSFREQ"}, {"PULSPER"}]),
+]
+
+CHANNELS = (1, 2)
+
+# Tracking copies every one of these from channel 1 to channel 2
+_CHANNEL_SETTINGS = [m for m, s in SETTINGS.items() if s.scope == 'channel']
+
+
+def _is_known(known, ch, mnemonic, value):
+    return mnemonic in known.get(ch, {}) and _same_value(mnemonic, known[ch][mnemonic], value)
+
+
+def _identical_channels(known, per_channel):
+    """
+    True if both channels end up with the same value for every channel setting,
+    so that tracking, which copies all of them, changes nothing else.
+    """
+    states = []
+    for ch in CHANNELS:
+        state = dict(known.get(ch, {}))
+        state.update(per_channel[ch])
+        if any(m not in state for m in _CHANNEL_SETTINGS):
+            return False
+        states.append(state)
+    return all(_same_value(m, states[0][m], states[1][m]) for m in _CHANNEL_SETTINGS)
+
+
+def plan(config, known=None, channel=None, end_channel=None, use_coupling=True):
+    """
+    Computes a short ordered list of commands which applies config.
+
+    Parameters
+    ----------
+    config: dict
+        The desired configuration.
+    known: dict
+        The settings known to be in place, in the same format as config.
+        These are not sent again. Coupling switches which are not known are assumed OFF.
+    channel: int or None
+        The channel currently selected on the instrument, if known.
+    end_channel: int or None
+        The channel which must be selected once the plan is done, e.g. to trigger.
+    use_coupling: bool
+        If True, settings with the same value on both channels are sent once,
+        with the corresponding coupling switched on, when that saves commands.
+        ``TRACKING EQUAL`` is used when both channels are configured identically
+        and the rest of their settings are known to be identical too, as tracking
+        copies the whole of channel 1, ``TRGSRC`` included, onto channel 2.
+
+    Returns
+    -------
+    list of (str, value)
+        The commands to send, in order, with ``('CHN', n)`` for channel switches.
+    """
+    known = known or {}
+    globals_wanted = dict(config.get('global', {}))
+    per_channel = {ch: dict(config.get(ch, {})) for ch in CHANNELS}
+    known_globals = known.get('global', {})
+    glob = []
+
+    def needed(ch):
+        return [m for m, v in per_channel[ch].items() if not _is_known(known, ch, m, v)]
+
+    # Send settings which are the same on both channels only once, through coupling
+    tracking = str(known_globals.get("TRACKING", "OFF")).upper()
+    tracked = False
+    if "TRACKING" not in globals_wanted:
+        if (use_coupling and per_channel[1] and per_channel[1] == per_channel[2]
+                and _identical_channels(known, per_channel)):
+            cost = (0 if tracking == "EQUAL" else 1) + len(needed(1))
+            tracked = cost < len(needed(1)) + len(needed(2)) + (0 if tracking == "OFF" else 1)
+        if tracked:
+            if tracking != "EQUAL":
+                glob.append(("TRACKING", "EQUAL"))
+            per_channel[2] = {}
+        elif tracking != "OFF" and (per_channel[1] or per_channel[2]):
+            glob.append(("TRACKING", "OFF"))
+
+    for switch, setup, coupled, complete in COUPLINGS if not tracked else []:
+        if switch in globals_wanted:
+            continue
+        on = str(known_globals.get(switch, "OFF")).upper() == "ON"
+        shared = [m for m in coupled if m in per_channel[1] and m in per_channel[2]]
+        shareable = (use_coupling and any(c <= set(shared) for c in complete)
+                     and all(m not in per_channel[1] or m in shared for m in coupled)
+                     and all(m not in per_channel[2] or m in shared for m in coupled)
+                     and all(_same_value(m, per_channel[1][m], per_channel[2][m]) for m in shared))
+        missing = {ch: [m for m in shared if not _is_known(known, ch, m, per_channel[ch][m])] for ch in CHANNELS}
+        if shareable:
+            setup_needed = [(m, v) for m, v in setup if not _is_known(known, 'global', m, v)]
+            cost_coupled = (0 if on else 1 + len(setup_needed)) + len(set(missing[1]) | set(missing[2]))
+            cost_plain = len(missing[1]) + len(missing[2]) + (1 if on else 0)
+            if cost_coupled < cost_plain:
+                if not on:
+                    glob += setup_needed + [(switch, "ON")]
+                if missing[1]:
+                    # Channel 2 gets the values through the coupling
+                    for m in shared:
+                        per_channel[2].pop(m)
+                continue
+        if on and any(m in per_channel[1] or m in per_channel[2] for m in coupled):
+            glob.append((switch, "OFF"))
+
+    for m, v in globals_wanted.items():
+        if not _is_known(known, 'global', m, v):
+            glob.append((m, v))
+
+    # Drop what is already in place
+    work = {}
+    for ch in CHANNELS:
+        cmds = [(m, v) for m, v in per_channel[ch].items()
+                if not _is_known(known, ch, m, v)]
+        if cmds:
+            work[ch] = cmds
+
+    # Visit every channel once, starting at the selected one and ending at end_channel
+    order = sorted(work, key=lambda ch: (ch == end_channel, ch != channel))
+    ret = list(glob)
+    current = channel
+    for ch in order:
+        if ch != current:
+            ret.append(("CHN", ch))
+            current = ch
+        ret += work[ch]
+    if end_channel is not None and current != end_channel:
+        ret.append(("CHN", end_channel))
+    return ret
+
+
+def apply_config(pg, config, end_channel=None, use_coupling=True):
+    """
+    Plans and sends the commands which bring pg to config, as one batch.
+
+    What is known about the instrument comes from its shadow state cache,
+    so enabling the cache on pg lets the plan skip settings already in place.
+    Returns the list of commands sent.
+    """
+    known = pg.known_state()
+    cmds = plan(config, known, known.get('channel'), end_channel, use_coupling)
+    with pg.batch():
+        for mnemonic, value in cmds:
+            pg.set(mnemonic, value)
+    return cmds
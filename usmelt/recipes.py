@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+import time
+from .planner import apply_config
+from .tg5012a import pg_logger
+
+
+def _normalize(value):
+    """Canonical string form of a setting, so equal configurations hash equally"""
+    try:
+        return '%.9g' % (float(value))
+    except (TypeError, ValueError):
+        return str(value).strip().upper()
+
+
+def config_hash(config):
+    """
+    Returns a hash identifying a full instrument configuration.
+
+    Parameters
+    ----------
+    config: dict
+        Maps the channel number (1 or 2) to a dict of mnemonic and value pairs,
+        e.g. ``{1: {'WAVE': 'PULSE', 'PULSWID': 20e-6}, 2: {...}}``.
+        Settings common to both channels go under the ``'global'`` key.
+    """
+    canonical = {str(ch): [[m.upper(), _normalize(v)] for m, v in settings.items()]
+                 for ch, settings in config.items()}
+    data = json.dumps(canonical, sort_keys=True).encode('ascii')
+    return hashlib.sha1(data).hexdigest()[:16]
+
+
+class RecipeStore:
+    """
+    Named instrument configurations kept in the non-volatile stores of the instrument.
+
+    The first time a configuration is applied it is sent command by command and then
+    saved with ``*SAV`` into one of the given store slots. A local index, kept per
+    instrument ``*IDN?`` string, maps the hash of the configuration to the slot and to
+    a checksum of the settings read back from the instrument. Applying a known
+    configuration again only needs ``*RCL`` and a checksum readback, which catches
+    slots overwritten from the front panel or by other software.
+
+    Parameters
+    ----------
+    pg: TG5012A
+        The instrument to use.
+    index_file: str
+        Path of the JSON file with the index from configuration hash to slot.
+    slots: list of int
+        The store slots this class may overwrite. Slot 0 and the lower slots are
+        left alone by default, for the power-on settings and for manual use.
+    """
+    def __init__(self, pg, index_file='usmelt_recipes.json', slots=(5, 6, 7, 8, 9)):
+        self.pg = pg
+        self.index_file = index_file
+        self.slots = list(slots)
+        self.recipes = {}
+        self._idn = None
+        self.index = self._load_index()
+
+    def add(self, name, config):
+        """Registers a configuration under the given name"""
+        self.recipes[name] = config
+
+    def apply(self, recipe):
+        """
+        Applies a configuration, given by name or as a dict, to the instrument.
+
+        Returns True if it was recalled from an instrument store and False if
+        it had to be sent command by command.
+        """
+        config = self.recipes[recipe] if isinstance(recipe, str) else recipe
+        key = config_hash(config)
+        entries = self.index.setdefault(self.idn(), {})
+        entry = entries.get(key)
+        if entry is not None:
+            self.pg.recall(entry['slot'])
+            if self.checksum(config) == entry['checksum']:
+                entry['used'] = time.time()
+                self._save_index()
+                return True
+            pg_logger.warning('Recipe %s in store %d does not match, sending it again' % (key, entry['slot']))
+            del entries[key]
+        self.send(config)
+        slot = self._pick_slot(entries)
+        self.pg.save(slot)
+        entries[key] = {'slot': slot, 'checksum': self.checksum(config), 'used': time.time(),
+                        'name': recipe if isinstance(recipe, str) else None}
+        self._save_index()
+        return False
+
+    def send(self, config):
+        """Sends a configuration command by command"""
+        # Coupling would add switches to the stored state that the recipe does not have
+        apply_config(self.pg, config, use_coupling=False)
+
+    def checksum(self, config):
+        """Reads back the settings of config from the instrument and hashes them"""
+        readback = {}
+        for ch, settings in config.items():
+            if ch != 'global':
+                self.pg.channel(ch)
+            mnemonics = list(settings)
+            values = self.pg.query_many([m + '?' for m in mnemonics])
+            readback[ch] = dict(zip(mnemonics, values))
+        return config_hash(readback)
+
+    def idn(self):
+        """The ID string of the instrument, which keys the index"""
+        if self._idn is None:
+            self._idn = self.pg.id()
+        return self._idn
+
+    def _pick_slot(self, entries):
+        used = {e['slot']: k for k, e in entries.items()}
+        for slot in self.slots:
+            if slot not in used:
+                return slot
+        # Reuse the least recently used slot
+        key = min(entries, key=lambda k: entries[k]['used'])
+        return entries.pop(key)['slot']
+
+    def _load_index(self):
+        if not os.path.exists(self.index_file):
+            return {}
+        try:
+            with open(self.index_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            pg_logger.warning('Could not read recipe index %s' % (self.index_file))
+            return {}
+
+    def _save_index(self):
+        with open(self.index_file, 'w') as f:
+            json.dump(self.index, f, indent=1)
@@ -0,0 +1,149 @@
+"""
+Firing at a repetition rate timed by the instrument, rather than by triggers sent from the host.
+
+    run = RepetitionRate(pg, rate=2000, shots=10000)
+    run.start()
+    run.wait()
+    run.stop()
+"""
+import time
+from .planner import apply_config
+from .sweep import LIMITS
+
+
+class RepetitionRate:
+    """
+    Fires pulses at rate Hz, either shots of them or until stopped.
+
+    Each channel plays a burst of pulses with a period of 1/rate. The first
+    channel is the trigger channel and the others are triggered from it
+    (``TRGSRC CRC``), which keeps the delays between the channels.
+
+    With shots given, a single ``*TRG`` starts a burst of that many pulses,
+    counted by the instrument. Otherwise the internal trigger generator of
+    the trigger channel (``TRGSRC INT``) fires one pulse every 1/rate seconds
+    until ``stop()``.
+
+    The instrument does not report how many pulses it fired, so
+    ``estimated_count()`` is exact once a burst of shots is done. While running,
+    and for continuous runs, it is worked out from the time the start and stop
+    commands completed, so it is off by about the command latency times the rate.
+
+    The pulse width, levels and delays are left as they are, so set them first.
+    ``stop()`` returns the channels to single pulses on a manual trigger, with
+    the pulse period and output they had before ``start()``.
+
+    Parameters
+    ----------
+    pg: TG5012A
+        The instrument.
+    rate: float
+        The repetition rate, in Hz.
+    shots: int or None
+        The number of pulses to fire, or None to fire until stopped.
+    channels: list of int
+        The channels to fire, starting with the trigger channel.
+    """
+    def __init__(self, pg, rate, shots=None, channels=(1, 2)):
+        if rate <= 0:
+            raise ValueError("The repetition rate must be positive")
+        period = 1.0 / rate
+        lo, hi = LIMITS["PULSPER"] if shots is not None else LIMITS["TRGPER"]
+        if not lo <= period <= hi:
+            raise ValueError("The repetition rate must be between %g and %g Hz" % (1 / hi, 1 / lo))
+        if shots is not None and not LIMITS["BSTCOUNT"][0] <= shots <= LIMITS["BSTCOUNT"][1]:
+            raise ValueError("The number of shots must be between %d and %d" % LIMITS["BSTCOUNT"])
+        self.pg = pg
+        self.rate = rate
+        self.shots = shots
+        self.channels = list(channels)
+        self._started = None
+        self._stopped = None
+        self._saved = None
+
+    def config(self):
+        """The settings which fire at the rate, in the configuration format of ``usmelt.planner``"""
+        period = 1.0 / self.rate
+        ret = {}
+        for ch in self.channels:
+            ret[ch] = {'PULSPER': period, 'BST': 'NCYC', 'BSTCOUNT': self.shots or 1, 'TRGSRC': 'CRC'}
+        trigger = ret[self.channels[0]]
+        if self.shots is None:
+            # Switching to the internal trigger starts firing, so it comes last
+            trigger['TRGPER'] = period
+            trigger['TRGSRC'] = 'INT'
+        else:
+            trigger['TRGSRC'] = 'MAN'
+        return ret
+
+    def _save(self):
+        """The pulse period and output of the channels, from the shadow state cache or else read back"""
+        known = self.pg.known_state()
+        saved = {}
+        for ch in self.channels:
+            values = {m: known[ch].get(m) for m in ('PULSPER', 'OUTPUT')}
+            missing = [m for m, v in values.items() if v is None]
+            if missing:
+                self.pg.set("CHN", ch)
+                values.update(zip(missing, self.pg.query_many([m + "?" for m in missing])))
+            saved[ch] = values
+        return saved
+
+    def start(self):
+        """Start firing"""
+        self._saved = self._save()
+        with self.pg.batch():
+            apply_config(self.pg, self.config(), end_channel=self.channels[0], use_coupling=False)
+            if self.shots is not None:
+                self.pg.trigger()
+        self._started = time.monotonic()
+        self._stopped = None
+
+    def stop(self):
+        """Stop firing, if still running, and go back to single pulses on a manual trigger"""
+        if self._started is None:
+            return
+        first = None
+        if self.shots is None:
+            # Stop the internal trigger before changing the pulses it fires
+            first = {self.channels[0]: {'TRGSRC': 'MAN'}}
+        elif self._stopped is None and not self.done():
+            # A burst can not be interrupted, but its output can. The output
+            # is switched back once the burst count is back to 1.
+            first = {ch: {'OUTPUT': 'OFF'} for ch in self.channels}
+        config = {ch: dict({'BSTCOUNT': 1}, **self._saved[ch]) for ch in self.channels}
+        with self.pg.batch():
+            if first is not None:
+                apply_config(self.pg, first, end_channel=self.channels[0], use_coupling=False)
+            apply_config(self.pg, config, end_channel=self.channels[0], use_coupling=False)
+        if self._stopped is None:
+            self._stopped = time.monotonic()
+
+    def running(self):
+        """True from start() until stop(), or until the burst of shots is done"""
+        return self._started is not None and self._stopped is None and not self.done()
+
+    def done(self):
+        """True once all the shots have been fired. Never True without shots."""
+        return self.shots is not None and self.estimated_count() >= self.shots
+
+    def estimated_count(self):
+        """The number of pulses fired since start(), estimated from the time elapsed"""
+        if self._started is None:
+            return 0
+        end = self._stopped if self._stopped is not None else time.monotonic()
+        # The first pulse goes out with the trigger
+        n = int((end - self._started) * self.rate) + 1
+        return n if self.shots is None else min(n, self.shots)
+
+    def wait(self, timeout=None):
+        """Wait for the burst of shots to be done, at most timeout seconds. Returns done()."""
+        if self.shots is None or self._started is None:
+            return self.done()
+        end = self._started + self.shots / self.rate
+        if timeout is not None:
+            end = min(end, time.monotonic() + timeout)
+        remaining = end - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+        return self.done()
@@ -0,0 +1,126 @@
+"""
+Replay of the journals recorded by ``TG5012A(journal=...)``, to reproduce a
+session offline or to use it as a performance workload::
+
+    python -m usmelt.replay session.usj --list
+    python -m usmelt.replay session.usj
+    python -m usmelt.replay session.usj --fast --serial-port /dev/ttyACM0
+
+Without a serial port or an address the journal is replayed into the emulator.
+"""
+import statistics
+import sys
+import time
+from .journal import read_journal
+from .tg5012a import TG5012A, pg_logger
+from .error_check import InstrumentTimeout
+from .emulator import TG5012AEmulator
+
+
+def replay(entries, pg, fast=False):
+    """
+    Sends the messages of entries to pg, a ``TG5012A``, and reads as many
+    responses as were recorded.
+
+    Messages are sent at the times they were recorded, relative to the first,
+    unless fast is True, in which case each one is sent as soon as the
+    responses to the one before are read. Error checks and the return to local
+    mode are those of the journal, so pg should have them off.
+
+    Returns a dict with the number of ``'messages'`` sent, the ``'seconds'``
+    the replay and the original took, the median ``'latency'`` of the
+    messages with a response in both, and the indices of the messages whose
+    responses differ from the recorded ones as ``'mismatches'``. Messages
+    which time out count as mismatches, and are also listed as ``'timeouts'``.
+    """
+    mismatches = []
+    timeouts = []
+    latencies = []
+    original = []
+    start = time.monotonic()
+    first = entries[0].sent if entries else 0.0
+    with pg._lock:
+        for i, entry in enumerate(entries):
+            if not fast:
+                wait = start + entry.sent - first - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+            sent = time.monotonic()
+            n = entry.response.count(pg.terminator)
+            try:
+                responses = pg._with_deadline("REPLAY", None, False, _exchange, pg, entry.data, n)
+            except InstrumentTimeout as e:
+                pg_logger.warning("Replaying message %d: %s" % (i, e))
+                timeouts.append(i)
+                mismatches.append(i)
+                continue
+            if n:
+                latencies.append(time.monotonic() - sent)
+                original.append(entry.received - entry.sent)
+            if responses != [r.decode('ascii').strip() for r in entry.response.split(pg.terminator)[:n]]:
+                mismatches.append(i)
+    seconds = time.monotonic() - start
+    return {'messages': len(entries), 'seconds': seconds,
+            'original_seconds': entries[-1].sent - first if entries else 0.0,
+            'latency': statistics.median(latencies) if latencies else None,
+            'original_latency': statistics.median(original) if original else None,
+            'mismatches': mismatches, 'timeouts': timeouts}
+
+
+def _exchange(pg, data, n):
+    if data:
+        pg._write_bytes(data, data[:40].decode('ascii', 'replace').strip())
+    return [pg.read() for i in range(n)]
+
+
+def _show(journal):
+    print("Journal opened %s" % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(journal['time']))))
+    for entry in journal['entries']:
+        took = '' if entry.received is None else '%9.3f ms' % ((entry.received - entry.sent) * 1e3)
+        line = entry.data.decode('ascii', 'replace').strip()
+        if '#' in line and not line.isprintable():
+            # A waveform upload
+            line = '%s<%d bytes>' % (line[:line.index('#')], len(entry.data))
+        if len(line) > 80:
+            line = line[:77] + '...'
+        response = entry.response.decode('ascii', 'replace').strip().replace('\n', ' | ')
+        print('%12.6f CH%s %-12s %s%s' % (entry.sent, entry.channel or '?', took, line,
+                                         ' -> ' + response if response else ''))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Replay a journal of TG5012A commands.')
+    parser.add_argument('path')
+    parser.add_argument('--list', action='store_true', help='print the journal instead of replaying it')
+    parser.add_argument('--fast', action='store_true', help='replay as fast as possible, not at the original pace')
+    parser.add_argument('--serial-port', default=None, help='replay to the instrument on this serial port')
+    parser.add_argument('--address', default=None, help='replay to the instrument at this LAN address')
+    parser.add_argument('--port', type=int, default=9221)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='processing time per command of the emulator replayed to otherwise, in seconds')
+    args = parser.parse_args()
+    journal = read_journal(args.path)
+    if args.list:
+        _show(journal)
+        sys.exit(0)
+    emulator = None
+    if args.serial_port is None and args.address is None:
+        emulator = TG5012AEmulator(latency=args.latency)
+        args.address = '127.0.0.1'
+        args.port = emulator.serve_tcp()
+    pg = TG5012A(serial_port=args.serial_port, address=args.address, port=args.port,
+                 auto_local=False, error_check=False)
+    try:
+        result = replay(journal['entries'], pg, fast=args.fast)
+    finally:
+        pg.close()
+        if emulator is not None:
+            emulator.close()
+    print('%d messages in %.3f s, originally %.3f s' % (result['messages'], result['seconds'],
+                                                        result['original_seconds']))
+    if result['latency'] is not None:
+        print('Median response time %.3f ms, originally %.3f ms' % (result['latency'] * 1e3,
+                                                                  result['original_latency'] * 1e3))
+    print('%d responses differ from the journal, %d timed out' % (len(result['mismatches']),
+                                                                  len(result['timeouts'])))
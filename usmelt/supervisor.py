@@ -0,0 +1,182 @@
+import collections
+import threading
+import serial
+import serial.tools.list_ports as list_ports
+from .tg5012a import pg_logger, _GLOBAL_SETTINGS
+from .error_check import InstrumentError
+from .planner import apply_config
+
+
+class Supervisor:
+    """
+    Keeps a serially connected TG5012A working when its USB cable is unplugged and plugged back.
+
+    The port list is watched for the ``hwid`` of device_info. When the device
+    disappears, or a command fails on the port, the instrument is marked as
+    disconnected. Once the device shows up again, under whatever name it gets,
+    the port is reopened and the last known configuration is sent again.
+
+    Commands issued while disconnected are held, and sent in order once the
+    connection is back. At most max_pending commands are held, and each one
+    waits at most deadline seconds, after which it raises a ``ConnectionError``.
+    The command which was on the wire when the connection was lost raises
+    a ``ConnectionError`` right away, as it is not known whether it took effect.
+
+    The configuration sent on reconnection starts as config, in the format of
+    ``usmelt.planner``, and follows the settings sent through pg. A ``*RCL`` is
+    remembered and replayed before the settings sent after it.
+
+    Parameters
+    ----------
+    pg: TG5012A
+        The instrument to supervise, connected through a serial port.
+    device_info: DeviceInfo
+        The port of pg, e.g. from ``discover()``. Its device is updated on reconnection.
+    config: dict
+        The configuration to send on reconnection.
+    poll_interval: float
+        How often, in seconds, the port list is checked.
+    deadline: float
+        How long, in seconds, a command is held while disconnected.
+    max_pending: int
+        How many commands can be held at once.
+    on_reconnect: callable
+        Called with device_info after each reconnection, from the supervisor thread.
+    """
+    def __init__(self, pg, device_info, config=None, poll_interval=0.1, deadline=2.0, max_pending=32, on_reconnect=None):
+        self.pg = pg
+        self.device_info = device_info
+        self.config = {1: {}, 2: {}, 'global': {}}
+        for key, settings in (config or {}).items():
+            self.config[key].update(settings)
+        self.poll_interval = poll_interval
+        self.deadline = deadline
+        self.max_pending = max_pending
+        self.on_reconnect = on_reconnect
+        self.connected = True
+        self.reconnects = 0
+        self._recalled = None
+        self._channel = None
+        self._replaying = False
+        self._stopped = False
+        self._waiting = collections.deque()
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        pg._supervisor = self
+        self._thread.start()
+
+    def stop(self):
+        """Stop supervising pg"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self.pg._supervisor is self:
+            self.pg._supervisor = None
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+
+    def hold(self, lock):
+        """Wait for the connection to come back before a command.
+
+        Returns False right away if connected. Otherwise returns True once
+        reconnected, holding lock, which is handed to the held commands in order.
+        """
+        if self.connected or threading.current_thread() is self._thread:
+            return False
+        waiter = object()
+        with self._cond:
+            if self.connected:
+                return False
+            if len(self._waiting) >= self.max_pending:
+                raise ConnectionError("TG5012A disconnected with %d commands already waiting" % (len(self._waiting)))
+            self._waiting.append(waiter)
+            try:
+                ready = self._cond.wait_for(lambda: self._stopped or (self.connected and self._waiting[0] is waiter),
+                                            self.deadline)
+                if not ready or not self.connected:
+                    raise ConnectionError("TG5012A not reconnected within %g s" % (self.deadline))
+            except BaseException:
+                self._waiting.remove(waiter)
+                self._cond.notify_all()
+                raise
+        # Take the lock before letting the next held command go
+        lock.acquire()
+        with self._cond:
+            self._waiting.remove(waiter)
+            self._cond.notify_all()
+        return True
+
+    def lost(self):
+        """Mark the instrument as disconnected"""
+        with self._cond:
+            if self.connected:
+                pg_logger.warning("TG5012A on %s disconnected" % (self.device_info.device))
+                self.connected = False
+                self._cond.notify_all()
+
+    def record(self, cmd, value, channel):
+        """Remember a command sent to the instrument, to replay the configuration"""
+        if self._replaying:
+            return
+        if cmd in ("*RST", "*RCL"):
+            self.config = {1: {}, 2: {}, 'global': {}}
+            self._recalled = value if cmd == "*RCL" else None
+        elif cmd == "CHN":
+            self._channel = int(value)
+        elif value is None or cmd.startswith('*'):
+            return
+        elif cmd in _GLOBAL_SETTINGS:
+            self._remember('global', cmd, value)
+        elif channel is not None:
+            self._remember(int(channel), cmd, value)
+
+    def _remember(self, key, cmd, value):
+        # Keep the settings in the order they were last sent, as some adjust others
+        settings = self.config[key]
+        settings.pop(cmd, None)
+        settings[cmd] = value
+
+    def run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._stopped, self.poll_interval)
+                if self._stopped:
+                    return
+            try:
+                device = next((p.device for p in list_ports.comports() if p.hwid == self.device_info.hwid), None)
+            except OSError as e:
+                pg_logger.warning("Could not list the serial ports: %s" % (e))
+                continue
+            if device is None:
+                self.lost()
+            elif not self.connected:
+                self._reconnect(device)
+
+    def _reconnect(self, device):
+        with self.pg._lock:
+            try:
+                self.pg.reopen(device)
+            except (serial.SerialException, OSError, ValueError) as e:
+                # The port might not be ready yet, try again on the next poll
+                pg_logger.warning("Reopening TG5012A on %s failed: %s" % (device, e))
+                return
+            self._replaying = True
+            try:
+                if self._recalled is not None:
+                    self.pg.recall(self._recalled)
+                apply_config(self.pg, self.config, end_channel=self._channel, use_coupling=False)
+            except InstrumentError as e:
+                pg_logger.warning("Restoring the TG5012A configuration failed: %s" % (e))
+            except (serial.SerialException, OSError) as e:
+                pg_logger.warning("Restoring the TG5012A configuration failed: %s" % (e))
+                return
+            finally:
+                self._replaying = False
+            self.device_info.device = device
+            self.reconnects += 1
+            with self._cond:
+                self.connected = True
+                self._cond.notify_all()
+        pg_logger.warning("TG5012A reconnected on %s" % (device))
+        if self.on_reconnect is not None:
+            self.on_reconnect(self.device_info)
@@ -0,0 +1,339 @@
+"""
+Parameter sweeps, firing one shot for each point of a grid or list of settings.
+
+Shots use the configuration format of ``usmelt.planner``::
+
+    sweep = Sweep.grid(pg, {1: {'PULSWID': [10e-6, 20e-6, 30e-6], 'HILVL': [3, 4, 5]}},
+                       base={1: {'OUTPUT': 'ON'}})
+    results = sweep.run()
+
+The whole schedule is computed and checked against ``LIMITS`` and the keywords
+of ``SETTINGS`` before the first shot, using NumPy when it is installed.
+"""
+import itertools
+import threading
+import time
+from .planner import apply_config, CHANNELS
+from .commands import SETTINGS
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Range of the values accepted by the instrument, from its specifications
+LIMITS = {m: s.limits for m, s in SETTINGS.items() if s.limits is not None}
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _column(values):
+    """A column of the schedule, as a NumPy array when possible"""
+    if np is not None and all(_is_number(v) for v in values):
+        return np.asarray(values, dtype=float)
+    return list(values)
+
+
+def _changed(column):
+    """Which shots change the value of column from the shot before"""
+    if np is not None and isinstance(column, np.ndarray):
+        ret = np.ones(len(column), dtype=bool)
+        ret[1:] = column[1:] != column[:-1]
+        return ret.tolist()
+    return [i == 0 or column[i] != column[i - 1] for i in range(len(column))]
+
+
+def _gray_indices(shape):
+    """
+    The indices of a grid of the given shape, ordered so that consecutive
+    points differ in a single index by one step (a reflected Gray code).
+    The last axis changes fastest.
+    """
+    if np is not None:
+        digits = np.indices(shape).reshape(len(shape), -1)
+        ret = np.empty_like(digits)
+        parity = np.zeros(digits.shape[1], dtype=int)
+        for j, n in enumerate(shape):
+            ret[j] = np.where(parity % 2 == 1, n - 1 - digits[j], digits[j])
+            parity += ret[j]
+        return ret.T.tolist()
+    ret = []
+    for digits in itertools.product(*[range(n) for n in shape]):
+        parity = 0
+        point = []
+        for d, n in zip(digits, shape):
+            g = n - 1 - d if parity % 2 else d
+            point.append(g)
+            parity += g
+        ret.append(point)
+    return ret
+
+
+class ShotResult:
+    """
+    What happened in one shot of a sweep.
+
+    Attributes
+    ----------
+    index : int
+        Position of the shot in the schedule.
+    settings : dict
+        All the settings of the shot, in the configuration format.
+    sent : list of (str, value)
+        The commands sent to get from the previous shot to this one.
+    time : float
+        When the shot was triggered, in seconds since the epoch, or None if it was not.
+    seconds : float
+        Time taken to send the settings and trigger.
+    error : Exception
+        The error raised by the shot, or None.
+    """
+    def __init__(self, index, settings):
+        self.index = index
+        self.settings = settings
+        self.sent = []
+        self.time = None
+        self.seconds = None
+        self.error = None
+
+    def __repr__(self):
+        return 'ShotResult(index=%d, time=%s, sent=%d, error=%r)' % (self.index, self.time, len(self.sent), self.error)
+
+
+class Sweep:
+    """
+    Fires a sequence of shots, changing the settings of the instrument between them.
+
+    Only the settings which differ from the previous shot are sent, together
+    with the trigger in a single batch. The next shot starts as soon as the
+    pulses of the previous one are over, as given by ``duration()``, and at
+    least interval seconds after it. After a shot which failed all the settings
+    of the next one are sent, as the instrument may have been left anywhere.
+
+    ``run()`` blocks until the sweep is done. ``pause()``, ``resume()`` and
+    ``abort()`` can be called from other threads, and take effect between shots.
+
+    Parameters
+    ----------
+    pg: TG5012A
+        The instrument, with its trigger source set to ``MAN``.
+    shots: list of dict
+        The settings of each shot, in the configuration format. Settings left
+        out of a shot keep the value they had in the shot before.
+    base: dict
+        Settings sent before the first shot, e.g. to switch the outputs on.
+    interval: float
+        Minimum time between shots, in seconds.
+    trigger_channel: int
+        The channel selected when triggering.
+    limits: dict
+        Maps mnemonics to the (minimum, maximum) values allowed. Defaults to ``LIMITS``.
+    progress: callable
+        Called with the ``ShotResult`` of each shot, from the thread running the sweep.
+    stop_on_error: bool
+        If True, a shot which fails stops the sweep and its error is raised.
+        Otherwise it is recorded in the result and the sweep carries on.
+    """
+    def __init__(self, pg, shots, base=None, interval=0, trigger_channel=1, limits=None,
+                 progress=None, stop_on_error=True):
+        self.pg = pg
+        self.base = base or {}
+        self.interval = interval
+        self.trigger_channel = trigger_channel
+        self.limits = LIMITS if limits is None else limits
+        self.progress = progress
+        self.stop_on_error = stop_on_error
+        self.results = []
+        self._running = threading.Event()
+        self._running.set()
+        self._aborted = False
+        self._schedule(list(shots))
+        self.validate()
+
+    @classmethod
+    def grid(cls, pg, axes, serpentine=True, **kwargs):
+        """
+        A sweep over every combination of the given values.
+
+        axes maps each channel, or ``'global'``, to a dict of mnemonics and the
+        list of values to sweep, e.g. ``{1: {'PULSWID': [1e-5, 2e-5], 'HILVL': [3, 4]}}``.
+        The last setting given changes fastest. With serpentine the order of each
+        setting is reversed every other pass, so that only one setting changes
+        between consecutive shots. The other arguments are those of ``Sweep``.
+        """
+        keys = [(ch, m) for ch, settings in axes.items() for m in settings]
+        values = [list(axes[ch][m]) for ch, m in keys]
+        shape = [len(v) for v in values]
+        if serpentine:
+            indices = _gray_indices(shape)
+        else:
+            indices = itertools.product(*[range(n) for n in shape])
+        shots = []
+        for point in indices:
+            shot = {}
+            for (ch, m), v, i in zip(keys, values, point):
+                shot.setdefault(ch, {})[m] = v[i]
+            shots.append(shot)
+        return cls(pg, shots, **kwargs)
+
+    def _schedule(self, shots):
+        """Turn the shots into one column of values per setting, carrying values forward"""
+        self.n_shots = len(shots)
+        keys = []
+        for shot in [self.base] + shots:
+            for ch, settings in shot.items():
+                for m in settings:
+                    if (ch, m) not in keys:
+                        keys.append((ch, m))
+        self.columns = {}
+        for ch, m in keys:
+            value = self.base.get(ch, {}).get(m)
+            values = []
+            for shot in shots:
+                value = shot.get(ch, {}).get(m, value)
+                values.append(value)
+            self.columns[(ch, m)] = values if None in values else _column(values)
+        self._changes = {key: _changed(column) for key, column in self.columns.items()}
+
+    def validate(self):
+        """Raises a ValueError if a shot has settings the instrument does not accept"""
+        for (ch, m), column in self.columns.items():
+            setting = SETTINGS.get(m)
+            if setting is not None and setting.choices is not None:
+                # apply_config sends values as they are, without the checks of the setting methods
+                bad = next((i for i, v in enumerate(column) if v is not None and v not in setting.choices), None)
+                if bad is not None:
+                    raise ValueError("Shot %d sets %s of %s to %s, not one of %s"
+                                     % (bad, m, ch, column[bad], list(setting.choices)))
+                continue
+            if m not in self.limits:
+                continue
+            lo, hi = self.limits[m]
+            if np is not None and isinstance(column, np.ndarray):
+                bad = np.flatnonzero((column < lo) | (column > hi))
+                bad = int(bad[0]) if len(bad) else None
+            else:
+                keywords = SETTINGS[m].keywords if m in SETTINGS else ()
+                bad = next((i for i, v in enumerate(column)
+                            if v is not None and v not in keywords and not lo <= float(v) <= hi), None)
+            if bad is not None:
+                raise ValueError("Shot %d sets %s of %s to %s, outside of [%g, %g]" % (bad, m, ch, column[bad], lo, hi))
+        for ch in CHANNELS:
+            self._check_order(ch, "LOLVL", "HILVL")
+            self._check_order(ch, "PULSWID", "PULSPER")
+
+    def _check_order(self, ch, low, high):
+        a = self.columns.get((ch, low))
+        b = self.columns.get((ch, high))
+        if a is None or b is None:
+            return
+        for i in range(self.n_shots):
+            if a[i] is not None and b[i] is not None and not float(a[i]) < float(b[i]):
+                raise ValueError("Shot %d sets %s of %s to %s, not below %s %s" % (i, low, ch, a[i], high, b[i]))
+
+    def settings(self, index):
+        """The settings of shot index, in the configuration format"""
+        ret = {}
+        for (ch, m), column in self.columns.items():
+            value = column[index]
+            if value is not None:
+                ret.setdefault(ch, {})[m] = value.item() if hasattr(value, 'item') else value
+        return ret
+
+    def changes(self, index):
+        """The settings which shot index changes from the shot before"""
+        ret = {}
+        for (ch, m), changed in self._changes.items():
+            value = self.columns[(ch, m)][index]
+            if changed[index] and value is not None:
+                ret.setdefault(ch, {})[m] = value.item() if hasattr(value, 'item') else value
+        return ret
+
+    def duration(self, index, known=None):
+        """
+        How long the pulses of shot index last after the trigger, in seconds.
+
+        That is ``PULSDLY`` plus ``PULSWID``, or plus ``PULSPER`` times
+        ``BSTCOUNT`` for a burst of pulses (``BST NCYC``). Settings which the
+        schedule leaves out are taken from known, in the format of
+        ``TG5012A.known_state()``.
+        """
+        ret = 0.0
+        for ch in CHANNELS:
+            delay, width, period, count, burst = [self._value(ch, m, index, known)
+                                                  for m in ("PULSDLY", "PULSWID", "PULSPER", "BSTCOUNT", "BST")]
+            total = float(delay) if delay is not None else 0.0
+            if str(burst).upper() == "NCYC" and period is not None and count is not None:
+                total += float(period) * float(count)
+            elif width is not None:
+                total += float(width)
+            ret = max(ret, total)
+        return ret
+
+    def _value(self, ch, m, index, known):
+        """The value of m on channel ch in shot index, from the schedule or else from known"""
+        column = self.columns.get((ch, m))
+        if column is not None and column[index] is not None:
+            return column[index]
+        return (known or {}).get(ch, {}).get(m)
+
+    def pause(self):
+        """Stop before the next shot, until resume() is called"""
+        self._running.clear()
+
+    def resume(self):
+        """Carry on with a paused sweep"""
+        self._running.set()
+
+    def abort(self):
+        """Stop before the next shot, for good"""
+        self._aborted = True
+        self._running.set()
+
+    def run(self):
+        """
+        Fires the shots in order.
+
+        Returns the list of ``ShotResult``, also kept in ``results``, which is
+        shorter than the schedule if the sweep was aborted.
+        """
+        self.results = []
+        self._aborted = False
+        ready = 0
+        failed = False
+        for i in range(self.n_shots):
+            self._running.wait()
+            if self._aborted:
+                break
+            result = ShotResult(i, self.settings(i))
+            if failed:
+                # Part of the failed shot might not have been applied
+                config = self.settings(i)
+            else:
+                config = self.changes(i)
+            if i == 0:
+                for ch, settings in self.base.items():
+                    config[ch] = dict(settings, **config.get(ch, {}))
+            wait = ready - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            start = time.perf_counter()
+            try:
+                with self.pg.batch():
+                    result.sent = apply_config(self.pg, config, end_channel=self.trigger_channel, use_coupling=False)
+                    self.pg.trigger()
+                result.time = time.time()
+            except Exception as e:
+                result.error = e
+            end = time.perf_counter()
+            result.seconds = end - start
+            failed = result.error is not None
+            ready = end + max(self.interval, self.duration(i, self.pg.known_state()))
+            self.results.append(result)
+            if self.progress is not None:
+                self.progress(result)
+            if result.error is not None and self.stop_on_error:
+                raise result.error
+        return self.results
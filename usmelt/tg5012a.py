@@ -1,90 +1,147 @@
-
-
 import socket
 import serial
 import logging
+import contextlib
+import contextvars
+import functools
+import threading
+import time
+from .error_check import InstrumentError, InstrumentTimeout, make_error_check
+from .metrics import Metrics
+from .arb import ARB_SLOTS
+from .commands import SETTINGS, format_value
+from .journal import Journal
 
+# Handlers are set up by the application, see usmelt.configure_logging()
 pg_logger = logging.getLogger('pg_logger')
-pg_logger.setLevel(logging.INFO)
-# 2. Create a handler for the terminal (console).
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.WARNING) # Set the level for this specific handler.
-pg_logger.addHandler(console_handler)
-
-handler = logging.FileHandler('usmelt.log')
-formatter = logging.Formatter('%(asctime)s - %(message)s')
-handler.setFormatter(formatter)
-pg_logger.addHandler(handler)
-pg_logger.propagate = False
-
-class TG5012A:
-    """
-    Control of the Aim TTi TG5012A function generator.
 
-    Based on the manual found at 
-    https://resources.aimtti.com/manuals/TG5012A_2512A_5011A+2511A_Instructions-Iss8.pdf
-    """
-    def __init__(self, serial_port = None, address='t539639.local', port=9221, auto_local=True, error_check=True):
-        """Connects to a TF5012A function generator using the given serial_port or LAN address and port
-        
-        If auto_local is true (default), the instrument will be set to local mode after each command.
-        if error_check is true (default), the instrument will check for errors after each command.
-        """
-        self.terminator = b'\n'
-        self.ser = None
-        self.sock = None
-        self.auto_local = auto_local
-        self.error_check = error_check
-        if serial_port is not None:
-            # Prefer serial over LAN communication        
-            ser = serial.Serial(port = serial_port)
-            if(ser.is_open != True):
-                raise ConnectionError("Serial port failed to open")
-            try:
-                self.ser = ser
-                pg_logger.info(self.id())
-                pg_logger.info("Successfully connected to TG5012A on %s" % (serial_port))
-            except:
-                ser.close()
-                raise
-        else:
-            # Open LAN connection
-            self.sock = socket.socket()
-            self.sock.connect((address, port))
-            try:
-                pg_logger.info(self.id())
-                pg_logger.info("Successfully connected to TG5012A on %s:%d" % (address, port))
-            except:
-                self.sock.close()
-                raise
-        
-    def close(self):
-        """Close the serial connection."""
-        self.ser.close()
+# Resolution used to compare values in the shadow state cache.
+# These are at or below the resolution of the instrument, so a change
+# that the instrument would see is never suppressed.
+CACHE_RESOLUTION = {m: s.resolution for m, s in SETTINGS.items() if s.resolution is not None}
 
-    def reopen(self):
-        """Reopen the serial connection."""
-        self.ser.open()
-        if(self.ser.is_open != True):
-            raise ConnectionError("Serial port failed to open")
-        pg_logger.info("Successfully connected to %s" % (self.ser.port))
-        pg_logger.info(self.id())  
+# Settings which the instrument adjusts when one of the others in the group changes
+_LINKED_SETTINGS = [
+    {"AMPL", "DCOFFS", "HILVL", "LOLVL", "AMPUNIT", "AMPLRNG", "ZLOAD"},
+    {"FREQ", "PER", "PULSFREQ", "PULSPER", "PULSWID", "PULSSYMM"},
+    {"PULSEDGE", "PULSRISE", "PULSFALL", "PULSRANGE"},
+]
 
-    # Convenience functions
-    def pulse(self, freq=1, width=0.1, rise = 0.001, fall = 0.001, high=1, low=0, delay = 0, phase=0, output = "ON"):
-        """Sets the output to a pulse with the given parameters"""
-        self.wave("PULSE")
-        self.frequency(freq)
-        self.pulse_width(width)
-        self.pulse_rise(rise)
-        self.pulse_fall(fall)
-        self.pulse_delay(delay)
-        self.high(high)
-        self.low(low)
-        self.phase(phase)
-        self.output(output)
+# Settings which are not tied to the selected channel
+_GLOBAL_SETTINGS = {m for m, s in SETTINGS.items() if s.scope == 'global'} | {"CHN"}
 
-    
+# Commands which do not depend on the selected channel
+_CHANNEL_INDEPENDENT = _GLOBAL_SETTINGS | {"LOCAL", "BEEP", "ALIGN", "*RST", "*RCL", "*SAV", "*CLS", "EER?", "QER?", "*ESR?", "*STB?", "*IDN?", "*OPC?"}
+# The arbitrary waveform memories are shared by the channels too
+_CHANNEL_INDEPENDENT |= {"ARB%d" % n for n in ARB_SLOTS} | {"ARB%dDEF" % n for n in ARB_SLOTS}
+
+# Queries used to check for errors, which are never checked themselves
+_ERROR_QUERIES = ("EER?", "QER?", "*ESR?")
+
+# Time allowed, in seconds, for the commands slower than the default timeout
+COMMAND_TIMEOUTS = {"*RST": 5.0, "*RCL": 3.0, "*SAV": 3.0, "*OPC?": 10.0}
+
+# Settings which copy values from one channel to the other when not OFF
+_COUPLING_SWITCHES = ["AMPLCPLNG", "OUTPUTCPLNG", "FRQCPLSWT", "PLSFRQCPLSWT", "TRACKING"]
+
+def _split_responses(line):
+    """The responses on a line read from the instrument, which separates them with ';'"""
+    return [r.strip() for r in line.split(';')]
+
+def _same_value(cmd, a, b):
+    """Compare two values of cmd using the resolution of the instrument"""
+    try:
+        a = float(a)
+        b = float(b)
+    except ValueError:
+        return str(a).upper() == str(b).upper()
+    res = CACHE_RESOLUTION.get(cmd)
+    if res is None:
+        return a == b
+    return round(a / res) == round(b / res)
+
+def _config_key(config):
+    """A key identifying config, in the format of ``usmelt.planner``, by the values sent"""
+    if not config:
+        return ()
+    return tuple(sorted((str(ch), tuple(sorted((m, format_value(v)) for m, v in settings.items())))
+                        for ch, settings in config.items()))
+
+def _locked(method):
+    """Run method holding the instrument lock, so that commands from different threads do not interleave"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self._acquire()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._lock.release()
+    return wrapper
+
+class _IdleTimer(threading.Thread):
+    """Calls function once touch() has not been called for interval seconds"""
+    def __init__(self, interval, function):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.function = function
+        self._cond = threading.Condition()
+        self._deadline = None
+        self._stopped = False
+
+    def touch(self):
+        """Cancel any pending call and start waiting for the interval again"""
+        with self._cond:
+            self._deadline = time.monotonic() + self.interval
+            self._cond.notify()
+
+    def cancel(self):
+        """Cancel any pending call"""
+        with self._cond:
+            self._deadline = None
+            self._cond.notify()
+
+    def pending(self):
+        """Returns True if a call is scheduled"""
+        with self._cond:
+            return self._deadline is not None
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def run(self):
+        with self._cond:
+            while not self._stopped:
+                if self._deadline is None:
+                    self._cond.wait()
+                    continue
+                remaining = self._deadline - time.monotonic()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+                self._deadline = None
+                self._cond.release()
+                try:
+                    self.function()
+                except Exception as e:
+                    pg_logger.warning("Idle timer failed: %s" % (e))
+                finally:
+                    self._cond.acquire()
+
+class TG5012ACommands:
+    """
+    The commands of the Aim TTi TG5012A function generator.
+
+    Each method sends a single command through ``self.set()`` or ``self.query()``,
+    which the classes using it provide, apart from the convenience functions
+    ``pulse()`` and ``deadline()``. This lets the blocking ``TG5012A`` and the
+    asyncio based ``AsyncTG5012A`` share the same command surface.
+
+    The methods which change a setting, such as ``pulse_width()``, are generated
+    from ``usmelt.commands.SETTINGS`` and raise a ValueError for values the
+    instrument would not accept.
+    """
     # Channel Selection
     def channel(self, set = None):
         """Queries or sets the active channel"""
@@ -92,230 +149,18 @@ class TG5012A:
             return self.query("CHN?")        
         return self.set("CHN", str(set))
 
-    # Continuous Carrier Wave Commands
-    def wave(self, set = "PULSE"):
-        """Sets the output waveform"""
-        valid_waveforms = ["SINE", "SQUARE", "TRIANG", "RAMP", "PULSE", "NOISE", "ARB"]
-        if set not in valid_waveforms:
-            raise ValueError("Invalid waveform. It should be one of %s" % (valid_waveforms))
-        return self.set("WAVE", str(set))
-    
-    def frequency(self, set = 1):
-        """Sets the output frequency in Hz"""
-        return self.set("FREQ", str(set))
-    
-    def period(self, set = 1):
-        """Sets the output period in seconds"""
-        return self.set("PER", str(set))
-    
-    def amplitude_range(self, set = "AUTO"):
-        """Sets the output amplitude range"""
-        valid = ["AUTO", "HOLD"]
-        if set not in valid:
-            raise ValueError("Invalid amplitude range. It should be one of %s" % (valid))
-        return self.set("AMPLRNG", str(set))
-    
-    def amplitude_unit(self, set = "VPP"):
-        """Sets the output amplitude unit"""
-        valid = ["VPP", "VRMS", "DBM"]
-        if set not in valid:
-            raise ValueError("Invalid amplitude unit. It should be one of %s" % (valid))
-        return self.set("AMPUNIT", str(set))    
-
-    def amplitude(self, set = 1):
-        """Sets the output amplitude, in volts"""
-        return self.set("AMPL", str(set))
-        
-    def offset(self, set = 0):
-        """Sets the DC offset, in volts"""
-        return self.set("DCOFFS", str(set))
-    
-    def high(self, set = 1):
-        """Sets the amplitude high level, in volts"""
-        return self.set("HILVL", str(set))
-    
-    def low(self, set = 0):
-        """Sets the amplitude low level, in volts"""
-        return self.set("LOLVL", str(set))
-    
-    def output(self, set = "ON"):
-        """Sets the output on, off, normal or invert"""
-        valid = ["ON", "OFF", "NORMAL", "INVERT"]
-        if set not in valid:
-            raise ValueError("Invalid output. It should be one of %s" % (valid))
-        return self.set("OUTPUT", set)
-    
-    def output_load(self, set = 50):
-        """Sets the output load, in Ohms"""
-        if set != 'OPEN' and (set < 1 or set > 10000):
-            raise ValueError("Invalid output load. It should be between 1 and 10000 or OPEN")
-        return self.set("ZLOAD", str(set))
-
-    def square_symmetry(self, set = 50):
-        """Sets the square wave symmetry, in percent"""
-        if set < 0 or set > 100:
-            raise ValueError("Invalid square symmetry. It should be between 0 and 100")
-        return self.set("SQRSYMM", str(set))
-    
-    def ramp_symmetry(self, set = 50):
-        """Sets the ramp wave symmetry, in percent"""
-        if set < 0 or set > 100:
-            raise ValueError("Invalid ramp symmetry. It should be between 0 and 100")
-        return self.set("RMPSYMM", str(set))
-    
-    def sync_output(self, set = "OFF"):
-        """Sets the sync output on or off"""
-        valid = ["ON", "OFF"]
-        if set not in valid:
-            raise ValueError("Invalid sync output. It should be one of %s" % (valid))
-        return self.set("SYNCOUT", set)
-    
-    def sync_type(self, set = "AUTO"):
-        """Sets the sync type"""
-        valid = ["AUTO", "CARRIER", "MODULATION", "SWEEP", "BURST", "TRIGGER"]
-        if set not in valid:
-            raise ValueError("Invalid sync type. It should be one of %s" % (valid))
-        return self.set("SYNCTYPE", set)
-        
-    def phase(self, set = 0):
-        """Sets the output phase, in degrees"""
-        return self.set("PHASE", str(set))
-    
     def align(self):
         """Sends signal to align zero phase reference of both channels"""
         return self.set("ALIGN")
-    
-    # Pulse Generator Commands
 
-    def pulse_frequency(self, set = 1):
-        """Sets the pulse frequency, in Hz"""
-        return self.set("PULSFREQ", str(set))
-    
-    def pulse_period(self, set = 1):
-        """Sets the pulse period, in seconds"""
-        return self.set("PULSPER", str(set))
-    
-    def pulse_width(self, set = 1):
-        """Sets the pulse width, in seconds"""
-        return self.set("PULSWID", str(set))
-    
-    def pulse_symmetry(self, set = 50):
-        """Sets the pulse symmetry, in percent"""
-        if set < 0 or set > 100:
-            raise ValueError("Invalid pulse symmetry. It should be between 0 and 100")
-        return self.set("PULSSYMM", str(set))
-    
-    def pulse_edge(self, set = 0):
-        """Set the pulse waveform edges (positive and negative edge) in seconds. 
-        Value zero sets to the minimum value allowed."""
-        return self.set("PULSEDGE", str(set))
-
-    def pulse_range(self, set = 1):
-        """Set the pulse rise and fall range to 1, 2 or 3.
-        1 - sets the range from 5ns to 99.9ns
-        2 - sets the range from 100ns to 1.999us
-        3 - sets the range from 2us to 40us"""
-        if set not in [1,2,3]:
-            raise ValueError("Invalid pulse range. It should be 1,2 or 3")
-        return self.set("PULSRANGE", str(set))
-
-    def pulse_rise(self, set = 0.001):
-        """Sets the pulse rise time, in seconds"""
-        return self.set("PULSRISE", str(set))
-    
-    def pulse_fall(self, set = 0.001):
-        """Sets the pulse fall time, in seconds"""
-        return self.set("PULSFALL", str(set))
-    
-    def pulse_delay(self, set = 0):
-        """Sets the pulse delay, in seconds"""
-        return self.set("PULSDLY", str(set))
-    
-    # Dual-channel Function Commands
-
-    def amplitude_coupling(self, set = "ON"):
-        """Sets the amplitude coupling"""
-        valid = ["ON", "OFF"]
-        if set not in valid:
-            raise ValueError("Invalid amplitude coupling. It should be one of %s" % (valid))
-        return self.set("AMPLCPLNG", set)
-    
-    def output_coupling(self, set = "ON"):
-        """Sets the output coupling"""
-        valid = ["ON", "OFF"]
-        if set not in valid:
-            raise ValueError("Invalid output coupling. It should be one of %s" % (valid))
-        return self.set("OUTPUTCPLNG", set)
-    
-    def frequency_coupling(self, set = "ON"):
-        """Sets the frequency coupling"""
-        valid = ["ON", "OFF"]
-        if set not in valid:
-            raise ValueError("Invalid frequency coupling. It should be one of %s" % (valid))
-        return self.set("FRQCPLSWT", set)
-    
-    def frequency_coupling_type(self, set = "RATIO"):
-        """Sets the frequency coupling type"""
-        valid = ["RATIO", "OFFSET"]
-        if set not in valid:
-            raise ValueError("Invalid frequency coupling type. It should be one of %s" % (valid))
-        return self.set("FRQCPLTYP", set)
-
-    def frequency_coupling_ratio(self, set = 1):
-        """Sets the frequency coupling ratio"""
-        return self.set("FRQCPLRAT", str(set))
-    
-    def frequency_coupling_offset(self, set = 0):
-        """Sets the frequency coupling offset in Hz"""
-        return self.set("FRQCPLOFS", str(set))
-    
-    def pulse_frequency_coupling(self, set = "ON"):
-        """Sets the pulse frequency coupling"""
-        valid = ["ON", "OFF"]
-        if set not in valid:
-            raise ValueError("Invalid pulse frequency coupling. It should be one of %s" % (valid))
-        return self.set("PLSFRQCPLSWT", set)
-    
-    def pulse_frequency_coupling_type(self, set = "RATIO"):
-        """Sets the pulse frequency coupling type"""
-        valid = ["RATIO", "OFFSET"]
-        if set not in valid:
-            raise ValueError("Invalid pulse frequency coupling type. It should be one of %s" % (valid))
-        return self.set("PLSFRQCPLTYP", set)
-    
-    def pulse_frequency_coupling_ratio(self, set = 1):
-        """Sets the pulse frequency coupling ratio"""
-        return self.set("PLSFRQCPLRAT", str(set))
-    
-    def pulse_frequency_coupling_offset(self, set = 0):
-        """Sets the pulse frequency coupling offset in Hz"""
-        return self.set("PLSFRQCPLOFS", str(set))
-    
-    def tracking(self, set = "EQUAL"):
-        """Set channel tracking to OFF, EQUAL or INVERT"""
-        valid = ["OFF", "EQUAL", "INVERT"]
-        if set not in valid:
-            raise ValueError("Invalid tracking. It should be one of %s" % (valid))
-        return self.set("TRACKING", set)
-
-    def burst(self, set = "OFF"):
-        """Set burst to OFF, NCYC, GATED or INFINITE"""
-        valid = ["OFF", "NCYC", "GATED", "INFINITE"]
-        if set not in valid:
-            raise ValueError("Invalid tracking. It should be one of %s" % (valid))
-        return self.set("BST", set)
-
-    def burst_count(self, set = 1):
-        """Set burst count"""
-        return self.set("BSTCOUNT", str(set))
-
-    def trigger_src(self, set = 1):
-        """Set trigger source to INT, EXT, CRC or MAN"""
-        valid = ["INT", "EXT", "CRC", "MAN"]
-        if set not in valid:
-            raise ValueError("Invalid source. It should be one of %s" % (valid))
-        return self.set("TRGSRC", set)
-    
+    # Arbitrary Waveform Commands
+
+    def arb_define(self, slot = 1, name = "ARB1", interpolation = "OFF", points = 8192):
+        """Names the arbitrary waveform memory slot and sets its number of points"""
+        if slot not in ARB_SLOTS:
+            raise ValueError("Invalid slot. It should be one of %s" % (list(ARB_SLOTS)))
+        return self.set("ARB%dDEF" % (slot), "%s,%s,%d" % (name, interpolation, points))
+
     def trigger(self):
         """Press the trigger key"""
         return self.set("*TRG")
@@ -329,6 +174,14 @@ class TG5012A:
         """Query and clear Execution Error Register"""
         return self.query("EER?")
     
+    def event_status(self):
+        """Query and clear the Standard Event Status Register"""
+        return self.query("*ESR?")
+
+    def status_byte(self):
+        """Query the Status Byte Register"""
+        return self.query("*STB?")
+
     def clear_status(self):
         """Clears the status registers"""
         return self.set("*CLS")
@@ -359,55 +212,797 @@ class TG5012A:
     
     def local(self):
         """Sets the instrument to local mode"""
-        return self.set("LOCAL")    
+        return self.set("LOCAL")
+
+    # Convenience functions
+    def pulse(self, freq=1, width=0.1, rise = 10e-9, fall = 10e-9, high=1, low=0, delay = 0, phase=0, output = "ON"):
+        """Sets the output to a pulse with the given parameters"""
+        with self.metrics.operation('pulse'), self.batch():
+            self.wave("PULSE")
+            self.frequency(freq)
+            self.pulse_width(width)
+            self.pulse_rise(rise)
+            self.pulse_fall(fall)
+            self.pulse_delay(delay)
+            self.high(high)
+            self.low(low)
+            self.phase(phase)
+            self.output(output)
+
+    @contextlib.contextmanager
+    def deadline(self, seconds):
+        """Bound the time taken by each command sent from this thread or task in the with block
+
+        Commands still fail sooner if their own timeout is shorter. Nested blocks
+        can only shorten the deadline.
+        """
+        end = time.monotonic() + seconds
+        outer = self._user_deadline.get()
+        token = self._user_deadline.set(end if outer is None else min(outer, end))
+        try:
+            yield self
+        finally:
+            self._user_deadline.reset(token)
+
 
-    def query(self, cmd):
+for _setting in SETTINGS.values():
+    setattr(TG5012ACommands, _setting.name, _setting.method())
+
+
+class TG5012A(TG5012ACommands):
+    """
+    Control of the Aim TTi TG5012A function generator.
+
+    Based on the manual found at 
+    https://resources.aimtti.com/manuals/TG5012A_2512A_5011A+2511A_Instructions-Iss8.pdf
+    """
+    def __init__(self, serial_port = None, address='t539639.local', port=9221, auto_local=True, error_check=True, cache=False, local_delay=0.5,
+                 timeout=1.0, retries=0, journal=None):
+        """Connects to a TF5012A function generator using the given serial_port or LAN address and port
+        
+        If auto_local is true (default), the instrument will be set to local mode once no command
+        has been sent for local_delay seconds, so bursts of commands pay for a single LOCAL.
+        With local_delay set to 0 it is set to local mode after each command.
+        if error_check is true (default), the instrument will check for errors after each command.
+        error_check can also be an ``ErrorCheck`` strategy, such as ``Deferred`` or
+        ``StatusByte``, to check for errors less often.
+        If cache is true, the last value set for each setting is remembered and
+        set commands which would not change anything are not sent.
+        The cache is cleared by reset(), recall(), any error, and by returning
+        the instrument to local mode, as the front panel can then change the settings.
+        It is therefore most effective with auto_local set to false or with commands
+        sent closer together than local_delay.
+        Channel coupling and tracking are assumed to be off unless set through this object.
+        With the cache enabled, channel() only selects the channel for the following
+        commands and CHN is sent when a command for that channel has to be sent.
+        Each command must complete within timeout seconds, or the time given in
+        ``COMMAND_TIMEOUTS`` for the slow ones, or ``InstrumentTimeout`` is raised.
+        The time allowed can be changed per call with the timeout argument of set(),
+        query() and query_many(), or for a block of calls with ``deadline()``.
+        Commands which can safely be sent again, settings and queries which do not
+        clear anything, are retried up to retries times after a timeout.
+        If journal is given, a path or a ``Journal``, every message exchanged with the
+        instrument is recorded to it with its timing, see ``usmelt.journal``.
+        """
+        self.terminator = b'\n'
+        self.ser = None
+        self.sock = None
+        self._rbuf = bytearray()
+        self.auto_local = auto_local
+        self.local_delay = local_delay
+        self.error_check = error_check
+        self.cache = cache
+        self._lock = threading.RLock()
+        self._idle_timer = None
+        self.metrics = Metrics()
+        self._batch = None
+        # The thread queuing the current batch, which holds the lock until it is sent
+        self._batch_owner = None
+        self._channel = None
+        self._wire_channel = None
+        self._shadow = {}
+        # Coupling and tracking switches set through this object, kept even without the cache
+        self._couplings = {}
+        self._supervisor = None
+        self.timeout = timeout
+        self.retries = retries
+        self._deadline = None
+        self._command = None
+        self._user_deadline = contextvars.ContextVar('deadline', default=None)
+        self._resync_needed = False
+        self._idn_pending = 0
+        self._allowed = timeout
+        self._idn = None
+        # Digest of the waveform uploaded to each ARB slot, and the slots from least to most recently used
+        self._arbs = {}
+        self._arb_order = list(ARB_SLOTS)
+        # The bytes sent by fire(), and what arm() was called with
+        self._armed = None
+        self._armed_key = None
+        self.last_fire = None
+        # time.monotonic() of the last write, to find when the instrument is idle
+        self._last_write = None
+        self._own_journal = isinstance(journal, str)
+        self.journal = Journal(journal) if self._own_journal else journal
+        if serial_port is not None:
+            # Prefer serial over LAN communication        
+            ser = serial.Serial(port = serial_port, timeout = timeout, write_timeout = timeout)
+            if(ser.is_open != True):
+                raise ConnectionError("Serial port failed to open")
+            try:
+                self.ser = ser
+                self._idn = self.id()
+                pg_logger.info(self._idn)
+                pg_logger.info("Successfully connected to TG5012A on %s" % (serial_port))
+            except:
+                ser.close()
+                raise
+        else:
+            # Open LAN connection
+            self.sock = socket.socket()
+            self.sock.settimeout(timeout)
+            self.sock.connect((address, port))
+            # Commands are small and each waits for the previous one, so don't let Nagle delay them
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            try:
+                self._idn = self.id()
+                pg_logger.info(self._idn)
+                pg_logger.info("Successfully connected to TG5012A on %s:%d" % (address, port))
+            except:
+                self.sock.close()
+                raise
+        
+    def close(self):
+        """Close the serial connection."""
+        if self._supervisor is not None:
+            self._supervisor.stop()
+        if self._idle_timer is not None:
+            self._idle_timer.stop()
+            self._idle_timer = None
+        with self._lock:
+            if self.sock:
+                self.sock.close()
+            else:
+                self.ser.close()
+            if self.journal is not None:
+                if self._own_journal:
+                    self.journal.close()
+                else:
+                    self.journal.flush()
+
+    def reopen(self, serial_port=None):
+        """Reopen the serial connection, optionally on a different serial_port.
+
+        Settings remembered by the shadow state cache are forgotten.
+        """
+        with self._lock:
+            if serial_port is not None:
+                try:
+                    self.ser.close()
+                except (serial.SerialException, OSError):
+                    pass
+                self.ser = serial.Serial(port = serial_port, timeout = self.timeout, write_timeout = self.timeout)
+            elif not self.ser.is_open:
+                self.ser.open()
+            if(self.ser.is_open != True):
+                raise ConnectionError("Serial port failed to open")
+            # The instrument might have been power cycled
+            self.invalidate_cache()
+            self._couplings = {}
+            self._arbs = {}
+            self._resync_needed = False
+            self._idn_pending = 0
+            pg_logger.info("Successfully connected to %s" % (self.ser.port))
+            self._idn = self.id()
+            pg_logger.info(self._idn)
+
+    def stats(self):
+        """Returns a snapshot of the command counters and latencies, see ``Metrics.snapshot()``"""
+        return self.metrics.snapshot()
+
+    def stats_prometheus(self):
+        """Returns the command counters and latencies in the Prometheus text format"""
+        return self.metrics.prometheus(prefix='usmelt_tg5012a')
+
+    @property
+    def error_check(self):
+        """The ``ErrorCheck`` strategy in use, or None if errors are not checked"""
+        return self._error_check
+
+    @error_check.setter
+    def error_check(self, error_check):
+        self._error_check = make_error_check(error_check)
+
+    def check_errors(self):
+        """Raise any error which the error checking strategy has not yet reported"""
+        if self._error_check is not None:
+            try:
+                self._error_check.flush(self)
+            except InstrumentError:
+                self.invalidate_cache()
+                raise
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Queue set commands and send them to the instrument in one go.
+
+        Inside a ``with pg.batch():`` block set commands are not sent immediately
+        but queued. When the block exits they are written as a single
+        semicolon-separated line, followed by a single error check and a single
+        ``LOCAL``. If one of the commands fails a ``BatchError`` identifying it is raised.
+
+        Queries issued inside the block first send the commands queued so far.
+        Nested batches are merged into the outermost one.
+        If the block raises, the queued commands are discarded.
+
+        The block holds the instrument lock, so commands from other threads
+        wait for the batch to be sent instead of joining or flushing it.
+        """
+        self._acquire()
+        try:
+            if self._batch is not None:
+                yield self
+                return
+            self._batch = []
+            self._batch_owner = threading.get_ident()
+            try:
+                yield self
+                self._flush_batch()
+            except BaseException:
+                # Part of the batch might not have been applied
+                self.invalidate_cache()
+                raise
+            finally:
+                self._batch = None
+                self._batch_owner = None
+        finally:
+            self._lock.release()
+
+    def _acquire(self):
+        """Take the instrument lock, after the connection is back if the supervisor is reconnecting"""
+        if (self._supervisor is not None and self._batch_owner != threading.get_ident()
+                and self._supervisor.hold(self._lock)):
+            # Held while reconnecting, and given the lock in the order the commands came.
+            # Not from inside a batch, as reconnecting needs the lock the batch holds.
+            return
+        self._lock.acquire()
+
+    @_locked
+    def _flush_batch(self):
+        """Send the commands queued in the current batch"""
+        if not self._batch:
+            return
+        # The batch gets the time of its slow commands on top of the default
+        timeout = self.timeout + sum(COMMAND_TIMEOUTS.get(cmd.split(' ')[0], 0) for cmd in self._batch)
+        self._with_deadline("BATCH", timeout, False, self._send_batch)
+
+    def _send_batch(self):
+        cmds = self._batch
+        if not cmds:
+            return
+        start = time.perf_counter()
+        self._batch = []
+        if self._error_check is not None:
+            self.write(self._error_check.format_batch(cmds))
+        else:
+            self.write(';'.join(cmds))
+        if self._error_check is not None:
+            self._error_check.after_batch(self, cmds)
+        seconds = time.perf_counter() - start
+        self.metrics.observe('batch', 'BATCH', seconds)
+        if pg_logger.isEnabledFor(logging.INFO):
+            pg_logger.info(';'.join(cmds), extra={'kind': 'batch', 'seconds': seconds})
+        if self.auto_local:
+            self._auto_local()
+
+    def invalidate_cache(self):
+        """Forget all the settings remembered by the shadow state cache"""
+        self._shadow = {}
+        self._wire_channel = None
+        self._armed = None
+
+    @_locked
+    def arm(self, config=None, channel=1):
+        """Prepare fire() to trigger channel with a single write
+
+        config, in the format of ``usmelt.planner``, is applied and read back,
+        channel is selected on the instrument and any pending error is raised.
+        While armed the instrument is not returned to local mode, so that its
+        settings cannot change from the front panel, so call disarm() once
+        done firing. Any set command sent after arm(), through set() or any of
+        the command methods, disarms it, as it may change what fire() would do.
+        Arming again with the same settings and channel does nothing, whatever
+        the order or the number type of the values.
+        """
+        from .planner import apply_config
+        key = (_config_key(config), str(channel))
+        if self._armed is not None and self._armed_key == key:
+            return
+        self._armed = None
+        if config:
+            apply_config(self, config, end_channel=channel)
+            for ch, settings in config.items():
+                if ch != 'global':
+                    self.channel(ch)
+                mnemonics = list(settings)
+                values = self.query_many([m + '?' for m in mnemonics])
+                for m, v in zip(mnemonics, values):
+                    if not _same_value(m, settings[m], v):
+                        raise ValueError("%s of channel %s is %s instead of %s" % (m, ch, v, settings[m]))
+        self.channel(channel)
+        if self._wire_channel != str(channel):
+            self._send("CHN", str(channel))
+        self.check_errors()
+        self._armed = "*TRG".encode('ascii') + self.terminator
+        self._armed_key = key
+
+    def disarm(self):
+        """Undo arm(), letting the instrument return to local mode"""
+        with self._lock:
+            self._armed = None
+            if self.auto_local:
+                self._auto_local()
+
+    def fire(self):
+        """Send the trigger prepared by arm() in a single write
+
+        Nothing else is sent, no error check and no ``LOCAL``, so an error
+        caused by the trigger is only reported by a later command. The instrument
+        stays armed for further shots. Returns the ``time.monotonic()`` of
+        the write, also kept in ``last_fire``.
+        """
+        with self._lock:
+            seconds = self._fire()
+        self._fired(seconds)
+        return self.last_fire
+
+    def _fire(self):
+        """The write of fire(), to be called holding the lock. Returns the time it took."""
+        data = self._armed
+        if data is None:
+            raise RuntimeError("TG5012A not armed, call arm() before fire()")
+        if self._supervisor is not None and not self._supervisor.connected:
+            raise ConnectionError("TG5012A disconnected")
+        self.last_fire = time.monotonic()
+        self._write_bytes(data, "*TRG")
+        return time.monotonic() - self.last_fire
+
+    def _fired(self, seconds):
+        """The bookkeeping of fire(), kept out of the way of the write"""
+        self.metrics.observe('set', '*TRG', seconds)
+        pg_logger.info("*TRG", extra={'kind': 'fire', 'seconds': seconds})
+
+    @_locked
+    def known_state(self):
+        """Returns the settings known to be in place, as used by ``usmelt.planner``
+
+        The settings come from the shadow state cache, so without the cache
+        only the selected channel and the coupling switches are known.
+        """
+        # Without the cache only channel switches that really went out can be relied on
+        channel = self._channel if self.cache else self._wire_channel
+        state = {'channel': int(channel) if channel is not None else None,
+                 1: {}, 2: {}, 'global': {}}
+        for (ch, cmd), value in self._shadow.items():
+            state['global' if ch is None else int(ch)][cmd] = value
+        state['global'].update(self._couplings)
+        return state
+
+    def _sync_channel(self, cmd):
+        """Send a deferred channel switch before a command that depends on the channel"""
+        if(self._channel is not None and self._channel != self._wire_channel
+           and cmd not in _CHANNEL_INDEPENDENT):
+            self._send("CHN", self._channel)
+
+    def _cache_key(self, cmd):
+        if cmd in _GLOBAL_SETTINGS:
+            return (None, cmd)
+        if self._channel is None:
+            return None
+        return (self._channel, cmd)
+
+    def _cache_hit(self, cmd, value):
+        """Returns True if setting cmd to value would not change the instrument state"""
+        key = self._cache_key(cmd)
+        if key is None or key not in self._shadow:
+            return False
+        return _same_value(cmd, self._shadow[key], value)
+
+    def _cache_update(self, cmd, value):
+        """Update the shadow state after sending cmd with the given value"""
+        self._armed = None
+        if self._supervisor is not None:
+            self._supervisor.record(cmd, value, self._channel)
+        if cmd in ("*RST", "*RCL"):
+            self.invalidate_cache()
+            self._couplings = {}
+            return
+        if cmd == "LOCAL":
+            # The front panel can now change the settings, but like the rest
+            # of the driver we assume the selected channel is left alone.
+            self._shadow = {}
+            return
+        if value is None or cmd.startswith('*'):
+            # Actions and other commands without a setting to remember
+            return
+        if cmd == "CHN":
+            self._channel = str(value)
+            self._wire_channel = self._channel
+        if cmd in _COUPLING_SWITCHES:
+            self._couplings[cmd] = str(value).upper()
+        if not self.cache:
+            return
+        if cmd in _GLOBAL_SETTINGS and cmd != "CHN":
+            # Coupling can copy settings between the channels
+            self._shadow = {}
+        else:
+            coupled = any(v != "OFF" for v in self._couplings.values())
+            group = next((g for g in _LINKED_SETTINGS if cmd in g), {cmd})
+            for k in list(self._shadow):
+                if k[1] in group and (coupled or k[0] == self._channel):
+                    del self._shadow[k]
+        key = self._cache_key(cmd)
+        if key is not None:
+            self._shadow[key] = str(value).upper()
+
+    def _auto_local(self):
+        """Return the instrument to local mode, immediately or once the bus is idle"""
+        if self.local_delay <= 0:
+            self.local()
+            return
+        if self._idle_timer is None:
+            self._idle_timer = _IdleTimer(self.local_delay, self._idle_local)
+            self._idle_timer.start()
+        self._idle_timer.interval = self.local_delay
+        self._idle_timer.touch()
+
+    def _idle_local(self):
+        with self._lock:
+            # A command sent while we waited for the lock restarts the timer
+            if self._idle_timer is None or self._idle_timer.pending():
+                return
+            if self._supervisor is not None and not self._supervisor.connected:
+                return
+            if self._armed is not None:
+                # Kept in remote mode until disarmed
+                return
+            self.local()
+
+    def _read_responses(self, n):
+        """Read n responses, whether they come on one line separated by ';' or on several lines"""
+        ret = []
+        while len(ret) < n:
+            ret += _split_responses(self.read())
+        return ret
+
+    
+    @_locked
+    def query(self, cmd, timeout=None):
+        """Send the query cmd and return the response
+
+        timeout replaces the default time allowed for the query, in seconds.
+        """
+        return self._with_deadline(cmd, timeout, cmd not in _ERROR_QUERIES, self._query, cmd)
+
+    def _query(self, cmd):
+        start = time.perf_counter()
+        if self.cache:
+            self._sync_channel(cmd)
+        if self._batch:
+            self._flush_batch()
         self.write(cmd)
         ret = self.read()
-        if cmd != "QER?" and cmd != "EER?" and self.error_check:
-            pg_logger.info("{cmd} returned {ret}".format(cmd=cmd, ret=ret))
-            err = self.query_error()
-            if int(err) != 0:
-                raise ValueError("Instrument returned query error %s" % (err))        
-        if(self.auto_local and cmd != "LOCAL" and cmd != "QER?" and cmd != "EER?"):
-            self.local()
+        if cmd not in _ERROR_QUERIES and self._error_check is not None:
+            try:
+                self._error_check.after_query(self, cmd)
+            except InstrumentError:
+                self.invalidate_cache()
+                raise
+        if(self.auto_local and cmd != "LOCAL" and cmd not in _ERROR_QUERIES):
+            self._auto_local()
+        seconds = time.perf_counter() - start
+        self.metrics.observe('query', cmd.split(' ')[0], seconds)
+        if cmd not in _ERROR_QUERIES:
+            pg_logger.info("%s returned %s", cmd, ret, extra={'kind': 'query', 'seconds': seconds})
         return ret
     
-    def set(self, cmd, value=None):        
-        if(value is None):
-            ret = self.write(cmd)
-        else:
-            cmd = cmd + ' ' + str(value)
-            ret = self.write(cmd)
+    @_locked
+    def query_many(self, cmds, timeout=None):
+        """Send several queries back-to-back and return their responses in order.
+
+        The queries are sent as a single compound message and the instrument returns
+        all the responses on one line, so reading back N values costs one round trip
+        instead of N. A query which fails leaves its response out; this raises an
+        ``InstrumentError`` if the instrument reports an error, or a ``ValueError`` otherwise.
+        """
+        cmds = list(cmds)
+        if not cmds:
+            return []
+        if timeout is None:
+            timeout = max(self.command_timeout(cmd) for cmd in cmds)
+        idempotent = not any(cmd in _ERROR_QUERIES for cmd in cmds)
+        return self._with_deadline(';'.join(cmds), timeout, idempotent, self._query_many, cmds)
+
+    def _query_many(self, cmds):
+        start = time.perf_counter()
+        if self.cache:
+            for cmd in cmds:
+                self._sync_channel(cmd)
+        if self._batch:
+            self._flush_batch()
+        self.write(';'.join(cmds))
+        ret = _split_responses(self.read())
+        if len(ret) != len(cmds):
+            if self._error_check is not None:
+                # Unknown queries are reported as command errors in EER?
+                kind, err = 'execution', int(self.execution_error())
+                if err == 0:
+                    kind, err = 'query', int(self.query_error())
+                if err != 0:
+                    self.invalidate_cache()
+                    raise InstrumentError(kind, err, cmds)
+            raise ValueError("Expected %d responses to %s but got %d" % (len(cmds), ';'.join(cmds), len(ret)))
+        if self._error_check is not None:
+            try:
+                self._error_check.after_queries(self, cmds)
+            except InstrumentError:
+                self.invalidate_cache()
+                raise
+        if self.auto_local:
+            self._auto_local()
+        seconds = time.perf_counter() - start
+        self.metrics.observe('query', 'MANY', seconds)
+        if pg_logger.isEnabledFor(logging.INFO):
+            pg_logger.info("%s returned %s", ';'.join(cmds), ';'.join(ret), extra={'kind': 'query', 'seconds': seconds})
+        return ret
+
+    @_locked
+    def set(self, cmd, value=None, timeout=None):
+        """Send the set command cmd with the given value, if any
+
+        timeout replaces the default time allowed for the command, in seconds.
+        """
+        return self._with_deadline(cmd, timeout, value is not None, self._set, cmd, value)
+
+    def _set(self, cmd, value):
+        if self.cache:
+            if cmd == "CHN" and value is not None:
+                # Only switch once a command for this channel is sent
+                self._channel = str(value)
+                return None
+            if value is not None and self._cache_hit(cmd, value):
+                self.metrics.skip(cmd)
+                return None
+            self._sync_channel(cmd)
+        return self._send(cmd, value)
+
+    def _send(self, cmd, value=None):
+        """Send a set command, bypassing the shadow state cache"""
+        start = time.perf_counter()
+        mnemonic = cmd
+        if(value is not None):
+            cmd = cmd + ' ' + format_value(value)
+        if self._batch is not None and cmd != "LOCAL":
+            self._batch.append(cmd)
+            self._cache_update(mnemonic, value)
+            return None
+        ret = self.write(cmd)
+        self._cache_update(mnemonic, value)
+        # Reading the error registers after LOCAL would put the instrument back
+        # in remote mode. Errors still pending are reported by the next check.
+        if self._error_check is not None and cmd != "LOCAL":
+            try:
+                self._error_check.after_set(self, cmd)
+            except InstrumentError:
+                self.invalidate_cache()
+                raise
+        if(self.auto_local and cmd != "LOCAL"):
+            self._auto_local()
+        seconds = time.perf_counter() - start
+        self.metrics.observe('set', mnemonic, seconds)
         if(cmd != "LOCAL"):
             # Don't log all the LOCAL commands to avoid flooding the log file
-            pg_logger.info(cmd)
-        if self.error_check:
-            err = self.execution_error()
-            if int(err) != 0:
-                raise ValueError("Instrument returned execution error %s" % (err))
-        if(self.auto_local and cmd != "LOCAL"):
-            self.local()
-                    
+            pg_logger.info(cmd, extra={'kind': 'set', 'seconds': seconds})
         return ret
     
+    @_locked
+    def upload_waveform(self, waveform, slot=None, timeout=None):
+        """Upload a ``Waveform`` to an arbitrary waveform memory and return its slot
+
+        Waveforms are recognized by the hash of their samples, so one already
+        uploaded through this object is not sent again. Without slot the one
+        least recently used is overwritten. Changes made to the memories by
+        other programs or from the front panel are not noticed.
+        The transfer gets timeout seconds, by default enough for the serial line.
+        """
+        digest = waveform.digest()
+        if slot is None:
+            slot = next((s for s, d in self._arbs.items() if d == digest), self._arb_order[0])
+        elif slot not in ARB_SLOTS:
+            raise ValueError("Invalid slot. It should be one of %s" % (list(ARB_SLOTS)))
+        self._arb_order.remove(slot)
+        self._arb_order.append(slot)
+        if self._arbs.get(slot) == digest:
+            self.metrics.skip("ARB%d" % (slot))
+            return slot
+        if self._batch:
+            self._flush_batch()
+        data = waveform.data()
+        if timeout is None:
+            rate = self.ser.baudrate / 10.0 if self.ser else 1e6
+            timeout = self.timeout + len(data) / rate
+        # Unknown until the upload is complete
+        self._arbs.pop(slot, None)
+        self.arb_define(slot, "USMELT%d" % (slot), "OFF", len(waveform))
+        self._with_deadline("ARB%d" % (slot), timeout, False, self._send_block, "ARB%d" % (slot), data)
+        self._arbs[slot] = digest
+        return slot
+
+    def _send_block(self, cmd, data):
+        """Send cmd with data as an IEEE 488.2 definite length binary block"""
+        start = time.perf_counter()
+        length = str(len(data))
+        if self.ser:
+            # The default write timeout is too short for a whole waveform
+            self.ser.write_timeout = self._remaining()
+        try:
+            self._write_bytes(('%s #%d%s' % (cmd, len(length), length)).encode('ascii') + data + self.terminator, cmd)
+        finally:
+            if self.ser:
+                self.ser.write_timeout = self.timeout
+        if self._error_check is not None:
+            self._error_check.after_set(self, cmd)
+        if self.auto_local:
+            self._auto_local()
+        seconds = time.perf_counter() - start
+        self.metrics.observe('set', cmd, seconds)
+        pg_logger.info("%s with %d bytes", cmd, len(data), extra={'kind': 'set', 'seconds': seconds})
+
+    def command_timeout(self, cmd):
+        """The time allowed by default for cmd, in seconds"""
+        return max(self.timeout, COMMAND_TIMEOUTS.get(cmd.split(' ')[0], 0))
+
+    def _with_deadline(self, command, timeout, idempotent, fn, *args):
+        """Run fn(*args) as one command, which has to complete within timeout seconds"""
+        if self._deadline is not None:
+            # Part of a command which already has a deadline
+            return fn(*args)
+        if self._resync_needed:
+            self._resync()
+        if timeout is None:
+            timeout = self.command_timeout(command)
+        user_end = self._user_deadline.get()
+        attempts = 1 + (self.retries if idempotent else 0)
+        for attempt in range(attempts):
+            now = time.monotonic()
+            end = now + timeout if user_end is None else min(now + timeout, user_end)
+            if end <= now:
+                raise InstrumentTimeout(command, 0)
+            self._deadline = end
+            self._command = command
+            self._allowed = end - now
+            try:
+                return fn(*args)
+            except InstrumentTimeout as timed_out:
+                self._deadline = None
+                if "*IDN?" in command:
+                    # Its late response would end the resynchronization too early
+                    self._idn_pending += 1
+                # We no longer know what the instrument has applied
+                self.invalidate_cache()
+                try:
+                    self._resync()
+                except InstrumentTimeout as e:
+                    # Tried again before the next command
+                    pg_logger.warning("Could not resynchronize with the instrument: %s" % (e))
+                    raise timed_out
+                if attempt == attempts - 1:
+                    raise
+                pg_logger.warning("Retrying %s after a timeout" % (command))
+            finally:
+                self._deadline = None
+
+    def _resync(self):
+        """Discard late responses, so that the next response read belongs to the next command
+
+        An ``*IDN?`` is sent and responses are read until it is answered. As responses
+        come back in order, nothing else is then pending. If this times out too,
+        the ``*IDN?`` responses still expected are counted, so that the next
+        attempt does not stop at the response to an earlier one.
+        """
+        self._resync_needed = True
+        if self._idn is None:
+            # Not connected yet, nothing to compare with
+            self._resync_needed = False
+            return
+        self._deadline = time.monotonic() + self.timeout
+        self._command = "*IDN?"
+        self._allowed = self.timeout
+        try:
+            self.write("*IDN?")
+            self._idn_pending += 1
+            while self._idn_pending > 0:
+                if self.read() == self._idn:
+                    self._idn_pending -= 1
+            self._resync_needed = False
+        finally:
+            self._deadline = None
+
+    def _remaining(self):
+        """Seconds left to the deadline of the current command"""
+        if self._deadline is None:
+            return self.timeout
+        remaining = self._deadline - time.monotonic()
+        if remaining <= 0:
+            raise InstrumentTimeout(self._command or "read", self._allowed)
+        return remaining
+
+    def _connection_lost(self, error):
+        pg_logger.warning("Lost connection to TG5012A: %s" % (error))
+        if self._supervisor is not None:
+            self._supervisor.lost()
+
     def write(self, str):
         """Write str to the instrument encoded as ascii as terminated"""
         pg_logger.debug(str)
-        bytes = str.encode('ascii') + self.terminator
+        return self._write_bytes(str.encode('ascii') + self.terminator, str)
+
+    def _write_bytes(self, bytes, str):
+        """Write bytes to the instrument, naming them str in errors"""
+        self.metrics.record_write(len(bytes))
+        self._last_write = time.monotonic()
+        if self.journal is not None:
+            self.journal.sent(bytes)
         if self.sock:
-            return self.sock.send(bytes)
+            self.sock.settimeout(self._remaining())
+            try:
+                # Waveforms do not fit in a single send
+                self.sock.sendall(bytes)
+                return len(bytes)
+            except socket.timeout:
+                raise InstrumentTimeout(self._command or str, self._allowed) from None
         elif self.ser:
-            return self.ser.write(bytes)
+            try:
+                return self.ser.write(bytes)
+            except serial.SerialTimeoutException:
+                raise InstrumentTimeout(self._command or str, self._allowed) from None
+            except (serial.SerialException, OSError) as e:
+                self._connection_lost(e)
+                raise
         else:
             raise ConnectionError("No connection to instrument")
         
     def read(self):
         """Read line from the instrument"""
         if self.sock:
-            recv = self.sock.recv(1024)
-            return recv.decode('ascii').strip()
+            # Responses can arrive split over several packets or several in one
+            while True:
+                i = self._rbuf.find(self.terminator)
+                if i >= 0:
+                    break
+                self.sock.settimeout(self._remaining())
+                try:
+                    data = self.sock.recv(4096)
+                except socket.timeout:
+                    raise InstrumentTimeout(self._command or "read", self._allowed) from None
+                if not data:
+                    raise ConnectionError("Connection closed by instrument")
+                self._rbuf += data
+            recv = bytes(self._rbuf[:i + len(self.terminator)])
+            del self._rbuf[:i + len(self.terminator)]
         elif self.ser:
-            return self.ser.readline().decode('ascii').strip()
+            remaining = self._remaining()
+            try:
+                self.ser.timeout = remaining
+                recv = self.ser.readline()
+            except (serial.SerialException, OSError) as e:
+                self._connection_lost(e)
+                raise
+            if not recv.endswith(self.terminator):
+                raise InstrumentTimeout(self._command or "read", self._allowed)
         else:
             raise ConnectionError("No connection to instrument")
+        self.metrics.record_read(len(recv))
+        if self.journal is not None:
+            self.journal.received(recv)
+        return recv.decode('ascii').strip()
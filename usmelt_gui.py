@@ -6,6 +6,83 @@ import configparser
 import os
 import simpleaudio
 import pathlib
+import threading
+import queue
+import concurrent.futures
+import serial.tools.list_ports
+
+class InstrumentWorker:
+    """Runs instrument jobs on a background thread, one at a time and in order.
+
+    A job submitted with a key replaces the arguments of the job with the same key
+    that is still waiting in the queue, so only the latest one is run.
+    """
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.waiting = {}
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, fn, *args, key=None):
+        """Queue fn(*args) and return a Future with its result"""
+        with self.lock:
+            if key is not None and key in self.waiting:
+                job = self.waiting[key]
+                job[1] = fn
+                job[2] = args
+                return job[0]
+            job = [concurrent.futures.Future(), fn, args, key]
+            if key is not None:
+                self.waiting[key] = job
+        self.queue.put(job)
+        return job[0]
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            with self.lock:
+                future, fn, args, key = job
+                if key is not None:
+                    self.waiting.pop(key, None)
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+# Pulse generator configuration used by the app
+PG_CONFIG = {
+    # --- Channel 1 settings ---
+    1: {
+        'WAVE': 'PULSE',
+        'PULSPER': 10e-3, # Short period for quick repetition
+        'HILVL': 1, # Nominal high value
+        'LOLVL': 0,
+        'PULSRISE': 10e-9,
+        'PULSFALL': 10e-9,
+        'PULSDLY': 0,
+        'BST': 'NCYC',
+        'BSTCOUNT': 1,
+        'TRGSRC': 'MAN',
+        'OUTPUT': 'OFF',
+    },
+    # --- Channel 2 settings ---
+    2: {
+        'WAVE': 'PULSE',
+        'PULSPER': 10e-3,
+        'HILVL': 1,
+        'LOLVL': 0,
+        'PULSRISE': 10e-9,
+        'PULSFALL': 10e-9,
+        'PULSDLY': 0,
+        'BST': 'NCYC',
+        'BSTCOUNT': 1,
+        'TRGSRC': 'CRC', # Take trigger from channel 1
+        'OUTPUT': 'OFF',
+    },
+}
 
 class MelterApp:
     def __init__(self, master):
@@ -13,12 +90,19 @@ class MelterApp:
         master.title("Melter Control")
         self.config = configparser.ConfigParser()
         self.config.read('usmelt.ini')
+        self.worker = InstrumentWorker()
+        self.busy = set()
+        self.pg = None
+        self.supervisor = None
+        self.device_name = ""
 
+        # Load the sound once instead of on every shot
         try:
-            self.find_and_init_pg()  # Initialize the pulse generator
+            sound_effect_path = pathlib.Path(__file__).parent / 'sounds' / 'short-laser-sfx.wav'
+            self.melt_sound = simpleaudio.WaveObject.from_wave_file(str(sound_effect_path))
         except Exception as e:
-            messagebox.showerror("Device Error", f"Could not connect to device: {e}",icon='error')
-            self.pg = None
+            print(f"Could not load melt sound: {e}")
+            self.melt_sound = None
 
         # --- Title Label ---
         self.title_label = ttk.Label(master, text="Melting laser (ch1)", font=("Helvetica", 10, "bold"))
@@ -119,9 +203,39 @@ class MelterApp:
         self.melt_button = ttk.Button(master, text="Melt! (single pulse)", command=self.melt)
         self.melt_button.grid(row=5, column=0, columnspan=4, pady=10)
 
+        # --- Repetition Rate ---
+        self.rate_label = ttk.Label(master, text="Rate (Hz):")
+        self.rate_label.grid(row=6, column=0, sticky="w", padx=5, pady=5)
+
+        self.rate_var = tk.StringVar(value="1000")  # Default value
+        self.rate_entry = ttk.Entry(master, textvariable=self.rate_var, width=10)
+        self.rate_entry.grid(row=6, column=1, sticky="e", padx=5, pady=5)
+
+        self.shots_label = ttk.Label(master, text="Shots (0 = until stopped):")
+        self.shots_label.grid(row=6, column=2, sticky="w", padx=5, pady=5)
+
+        self.shots_var = tk.StringVar(value="0")  # Default value
+        self.shots_entry = ttk.Entry(master, textvariable=self.shots_var, width=10)
+        self.shots_entry.grid(row=6, column=3, sticky="e", padx=5, pady=5)
+
+        self.run_button = ttk.Button(master, text="Start (repetition rate)", command=self.toggle_run)
+        self.run_button.grid(row=7, column=0, columnspan=4, pady=10)
+        self.repetition = None
+
+        # --- Status ---
+        self.status_var = tk.StringVar(value="Idle")
+        self.status_label = ttk.Label(master, textvariable=self.status_var)
+        self.status_label.grid(row=8, column=0, columnspan=4, pady=5)
+
         self.toggle_ch1_elements()
         self.toggle_ch2_elements()
 
+        try:
+            self.find_and_init_pg()  # Initialize the pulse generator
+        except Exception as e:
+            messagebox.showerror("Device Error", f"Could not connect to device: {e}",icon='error')
+            self.pg = None
+
 
     def toggle_ch1_elements(self):
         """Enable or disable channel 1 widgets based on the checkbox."""
@@ -143,44 +257,71 @@ class MelterApp:
         with open('usmelt.ini', 'w') as configfile:
             self.config.write(configfile)
 
+    def run_in_worker(self, fn, *args, text="Busy", key=None):
+        """Runs fn(*args) on the instrument worker and shows its progress in the status bar."""
+        future = self.worker.submit(fn, *args, key=key)
+        if future not in self.busy:
+            self.busy.add(future)
+            self.status_var.set(f"{text}...")
+            self.master.after(20, self.check_done, future, text)
+        return future
+
+    def check_done(self, future, text):
+        """Polls a job from the Tk main loop, as Tk must not be used from the worker thread."""
+        if not future.done():
+            self.master.after(20, self.check_done, future, text)
+            return
+        self.busy.discard(future)
+        e = future.exception()
+        if e is not None:
+            self.status_var.set(f"{text} failed")
+            messagebox.showerror("Device Error", f"{text} failed: {e}")
+        elif not self.busy:
+            self.status_var.set(f"{text} done")
+
     def find_and_init_pg(self):
         """Finds and initializes the pulse generator."""
         self.device_name = ""
         # First find the USB device that corresponds to the pulse generator
         device = usmelt.discover(['TG5012A'])
         self.device_name = device['TG5012A'].device  # Store the device name
-        self.pg = usmelt.TG5012A(serial_port=self.device_name)
-        self.init_pg()        
+        self.pg = usmelt.TG5012A(serial_port=self.device_name, cache=True)
+        self.recipes = usmelt.RecipeStore(self.pg)
+        self.supervise(device['TG5012A'])
+        self.run_in_worker(self.init_pg, text="Initializing")
+
+    def connect_pg(self, device_name):
+        """Connects to and initializes the pulse generator on device_name."""
+        if self.supervisor is not None:
+            self.supervisor.stop()
+            self.supervisor = None
+        try:
+            self.pg = usmelt.TG5012A(serial_port=device_name, cache=True)
+            self.recipes = usmelt.RecipeStore(self.pg)
+            hwid = next((p.hwid for p in serial.tools.list_ports.comports() if p.device == device_name), None)
+            if hwid is not None:
+                self.supervise(usmelt.DeviceInfo(device_name, hwid))
+            self.init_pg()  # Re-initialize the pulse generator
+        except Exception:
+            self.pg = None
+            raise
+
+    def supervise(self, device_info):
+        """Reconnects automatically if the USB cable of the pulse generator is replugged."""
+        self.supervisor = usmelt.Supervisor(self.pg, device_info, on_reconnect=self.on_reconnect)
+
+    def on_reconnect(self, device_info):
+        """Called from the supervisor thread once the pulse generator is back."""
+        self.device_name = device_info.device
 
     def init_pg(self):
-        # --- Channel 1 settings ---
-        self.pg.channel(1)
-        self.pg.wave('PULSE')
-        self.pg.pulse_period(10e-3) # Short period for quick repetition
-        self.pg.high(1) # Nominal high value
-        self.pg.low(0)
-        self.pg.pulse_rise(10e-9)
-        self.pg.pulse_fall(10e-9)
-        self.pg.pulse_delay(0)
-        self.pg.burst("NCYC")
-        self.pg.burst_count(1)
-        self.pg.trigger_src("MAN")
-        self.pg.output("OFF")
-
-        # --- Channel 2 settings ---
-        self.pg.channel(2)
-        self.pg.wave('PULSE')
-        self.pg.pulse_period(10e-3)
-        self.pg.high(1)
-        self.pg.low(0)
-        self.pg.pulse_rise(10e-9)
-        self.pg.pulse_fall(10e-9)
-        self.pg.pulse_delay(0)
-        self.pg.burst("NCYC")
-        self.pg.burst_count(1)
-        # Take trigger from channel 1
-        self.pg.trigger_src("CRC")
-        self.pg.output("OFF")
+        """Applies PG_CONFIG, recalling it from an instrument store when it was saved before."""
+        with self.pg.metrics.operation('init_pg'):
+            try:
+                self.recipes.apply(PG_CONFIG)
+            except Exception as e:
+                print(f"Could not use the recipe store, configuring command by command: {e}")
+                self.recipes.send(PG_CONFIG)
 
     def validate_inputs(self, event=None):
         """Validates all input fields for both channels."""
@@ -216,42 +357,93 @@ class MelterApp:
             return        
         ch1_params, ch2_params = self.validate_inputs()
         if ch1_params and ch2_params:
-            pulse_length1, voltage_high1, delay1 = ch1_params
-            pulse_length2, voltage_high2, delay2 = ch2_params
-            if self.enable_ch1_var.get():
-                print(f"CH1: Pulse: {pulse_length1}µs, Voltage: {voltage_high1}V, Delay: {delay1}µs")
-                # Set parameters for Channel 1
-                self.pg.channel(1)
-                self.pg.output("ON")
-                self.pg.pulse_width(pulse_length1 * 1e-6)
-                self.pg.high(voltage_high1)
-                self.pg.pulse_delay(delay1 * 1e-6)
-            else:
-                self.pg.channel(1)
-                self.pg.output("OFF")
-
-            if self.enable_ch2_var.get():
-                print(f"CH2: Pulse: {pulse_length2}µs, Voltage: {voltage_high2}V, Delay: {delay2}µs")
-                # Set parameters for Channel 2
-                self.pg.channel(2)
-                self.pg.output("ON")
-                self.pg.pulse_width(pulse_length2 * 1e-6)
-                self.pg.high(voltage_high2)
-                self.pg.pulse_delay(delay2 * 1e-6)
-            else:            
-                self.pg.channel(2)
-                self.pg.output("OFF")
+            # Back-to-back clicks replace a melt still waiting for the instrument
+            self.run_in_worker(self.apply_and_trigger, self.enable_ch1_var.get(), ch1_params,
+                               self.enable_ch2_var.get(), ch2_params, self.melt_sound_var.get(),
+                               text="Melting", key="melt")
+
+    def melt_config(self, enable_ch1, ch1_params, enable_ch2, ch2_params):
+        """Returns the channel settings for the melt parameters."""
+        pulse_length1, voltage_high1, delay1 = ch1_params
+        pulse_length2, voltage_high2, delay2 = ch2_params
+        config = {1: {'OUTPUT': 'OFF'}, 2: {'OUTPUT': 'OFF'}}
+        if enable_ch1:
+            print(f"CH1: Pulse: {pulse_length1}µs, Voltage: {voltage_high1}V, Delay: {delay1}µs")
+            config[1] = {'OUTPUT': 'ON', 'PULSWID': pulse_length1 * 1e-6,
+                         'HILVL': voltage_high1, 'PULSDLY': delay1 * 1e-6}
+        if enable_ch2:
+            print(f"CH2: Pulse: {pulse_length2}µs, Voltage: {voltage_high2}V, Delay: {delay2}µs")
+            config[2] = {'OUTPUT': 'ON', 'PULSWID': pulse_length2 * 1e-6,
+                         'HILVL': voltage_high2, 'PULSDLY': delay2 * 1e-6}
+        return config
+
+    def apply_and_trigger(self, enable_ch1, ch1_params, enable_ch2, ch2_params, melt_sound):
+        """Applies the melt parameters and fires. Runs on the instrument worker."""
+        with self.pg.metrics.operation('melt'):
+            config = self.melt_config(enable_ch1, ch1_params, enable_ch2, ch2_params)
+            fire = enable_ch1 or enable_ch2
+            # Trigger from channel 1, even if output is off, so finish the plan on it
+            usmelt.apply_config(self.pg, config, end_channel=1 if fire else None)
 
             # Trigger the pulse (assuming one trigger fires both channels)
-            if self.enable_ch1_var.get() or self.enable_ch2_var.get():
-                if self.melt_sound_var.get():
-                    sound_effect_path = pathlib.Path(__file__).parent / 'sounds' / 'short-laser-sfx.wav'
-                    wave_obj = simpleaudio.WaveObject.from_wave_file(str(sound_effect_path))
-                    wave_obj.play()
-                self.pg.channel(1)  # Trigger from channel 1, even if output is off
+            if fire:
+                if melt_sound and self.melt_sound is not None:
+                    self.melt_sound.play()
                 self.pg.trigger()
 
-
+    def toggle_run(self):
+        """Handles the Start/Stop button of the repetition rate mode."""
+        if self.repetition is not None:
+            self.stop_run()
+            return
+        if self.pg is None:
+            messagebox.showerror("Device Error", "Pulse generator not initialized.")
+            return
+        ch1_params, ch2_params = self.validate_inputs()
+        if not (ch1_params and ch2_params):
+            return
+        try:
+            rate = float(self.rate_var.get())
+            shots = int(self.shots_var.get())
+            if shots < 0: raise ValueError("Shots must be >= 0.")
+            repetition = usmelt.RepetitionRate(self.pg, rate, shots or None)
+        except ValueError as e:
+            messagebox.showerror("Input Error", str(e))
+            return
+        self.repetition = repetition
+        self.run_button.config(text="Stop")
+        future = self.run_in_worker(self.start_run, repetition, self.enable_ch1_var.get(), ch1_params,
+                                    self.enable_ch2_var.get(), ch2_params, text="Starting")
+        self.master.after(100, self.update_run, future)
+
+    def start_run(self, repetition, enable_ch1, ch1_params, enable_ch2, ch2_params):
+        """Applies the melt parameters and starts firing at the repetition rate. Runs on the instrument worker."""
+        with self.pg.metrics.operation('run'):
+            usmelt.apply_config(self.pg, self.melt_config(enable_ch1, ch1_params, enable_ch2, ch2_params))
+            repetition.start()
+
+    def update_run(self, future):
+        """Shows the number of shots fired, and stops once they are all done."""
+        repetition = self.repetition
+        if repetition is None:
+            return
+        if future.done() and future.exception() is not None:
+            # check_done reports the error
+            self.repetition = None
+            self.run_button.config(text="Start (repetition rate)")
+            return
+        if future.done():
+            self.status_var.set(f"Fired {repetition.estimated_count()} shots")
+        if repetition.done():
+            self.stop_run()
+        else:
+            self.master.after(100, self.update_run, future)
+
+    def stop_run(self):
+        """Stops firing at the repetition rate."""
+        repetition, self.repetition = self.repetition, None
+        self.run_button.config(text="Start (repetition rate)")
+        self.run_in_worker(repetition.stop, text="Stopping")
 
     def set_device(self):
         """Opens a dialog to set the device name."""
@@ -260,14 +452,10 @@ class MelterApp:
         )
         if new_device is not None:  # Check if the user clicked Cancel
             self.device_name = new_device
-            try:
-                self.pg = usmelt.TG5012A(serial_port=new_device)
-                self.init_pg()  # Re-initialize the pulse generator
-            except Exception as e:
-                messagebox.showerror("Device Error", f"Could not connect to device: {e}")
-                self.pg = None
+            self.run_in_worker(self.connect_pg, new_device, text="Connecting")
 
 
+usmelt.configure_logging('usmelt.log')
 root = tk.Tk()
 app = MelterApp(root)
 root.mainloop()